@@ -9,11 +9,22 @@ import json
 import numpy as np
 import csv
 import collections
+import itertools
+import multiprocessing
+import copy
+import hashlib
+import codecs
+import zipfile
+import sqlite3
+import time
 import xml.etree.cElementTree as ET
-from bs4 import BeautifulSoup
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
 import datetime
 
 from scilifelab.log import minimal_logger
+from scilifelab.io.picard import PicardMetrics
+from scilifelab.bcbio.qc.interop import InterOpMetrics, InterOpError
 LOG = minimal_logger("bcbio")
 
 from bcbio.broad.metrics import PicardMetricsParser
@@ -94,86 +105,26 @@ class ExtendedPicardMetricsParser(PicardMetricsParser):
     def __init__(self):
         PicardMetricsParser.__init__(self)
 
-    def _get_command(self, in_handle):
-        while 1:
-            line = in_handle.readline()
-            if line.startswith("# net.sf.picard.analysis") or line.startswith("# net.sf.picard.sam"):
-                break
-        return line.rstrip("\n")
-
-    def _read_off_header(self, in_handle):
-        while 1:
-            line = in_handle.readline()
-            if line.startswith("## METRICS"):
-                break
-        return in_handle.readline().rstrip("\n").split("\t")
-
-    def _read_vals_of_interest(self, header, info):
-        want_indexes = [header.index(w) for w in header]
-        vals = dict()
-        for i in want_indexes:
-            vals[header[i]] = info[i]
-        return vals
-
     def _parse_align_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        d = dict([[x, []] for x in header])
-        res = dict(command=command, FIRST_OF_PAIR = d, SECOND_OF_PAIR = d, PAIR = d)
-        while 1:
-            info = in_handle.readline().rstrip("\n").split("\t")
-            category = info[0]
-            if len(info) <= 1:
-                break
-            vals = self._read_vals_of_interest(header, info)
-            res[category] = vals
+        metrics = PicardMetrics().parse(in_handle)
+        d = dict([[x, []] for x in metrics.metrics_header])
+        res = dict(command=metrics.command, FIRST_OF_PAIR = d, SECOND_OF_PAIR = d, PAIR = d)
+        for row, vals in zip(metrics.metrics_rows, metrics.metrics_dicts()):
+            res[row[0]] = vals
         return res
 
     def _parse_dup_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        info = in_handle.readline().rstrip("\n").split("\t")
-        vals = self._read_vals_of_interest(header, info)
-        histvals = self._read_histogram(in_handle)
-        return dict(command=command, metrics = vals, hist = histvals)
+        metrics = PicardMetrics().parse(in_handle)
+        vals = (metrics.metrics_dicts() or [{}])[0]
+        return dict(command=metrics.command, metrics = vals, hist = metrics.histogram_dict())
 
     def _parse_insert_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        info = in_handle.readline().rstrip("\n").split("\t")
-        vals = self._read_vals_of_interest(header, info)
-        histvals = self._read_histogram(in_handle)
-        return dict(command=command, metrics = vals, hist = histvals)
+        return self._parse_dup_metrics(in_handle)
 
     def _parse_hybrid_metrics(self, in_handle):
-        command = self._get_command(in_handle)
-        header = self._read_off_header(in_handle)
-        info = in_handle.readline().rstrip("\n").split("\t")
-        vals = self._read_vals_of_interest(header, info)
-        return dict(command=command, metrics = vals)
-
-    def _read_histogram(self, in_handle):
-        labels = self._read_to_histogram(in_handle)
-        if labels is None:
-            return None
-        vals = dict([[x, []] for x in labels])
-        while 1:
-            line = in_handle.readline()
-            info = line.rstrip("\n").split("\t")
-            if len(info) < len(labels):
-                break
-            for i in range(0, len(labels)):
-                vals[labels[i]].append(info[i])
-        return vals
-
-    def _read_to_histogram(self, in_handle):
-        while 1:
-            line = in_handle.readline()
-            if line.startswith("## HISTOGRAM"):
-                break
-            if not line:
-                return None
-        return in_handle.readline().rstrip("\n").split("\t")
+        metrics = PicardMetrics().parse(in_handle)
+        vals = (metrics.metrics_dicts() or [{}])[0]
+        return dict(command=metrics.command, metrics = vals)
 
 class RunInfoParser():
     """RunInfo parser"""
@@ -249,6 +200,98 @@ class DemultiplexConfigParser():
 
         return self.data
 
+class DemultiplexStatsParser(HTMLParser):
+    """Demultiplex_Stats.htm parser. Collects the th and td cells of the table rows in
+    a single pass over the document. The text of a cell is that of its only child, as
+    for the string of a BeautifulSoup tag, or 'None' if the cell has no or several children.
+    """
+    void_elements = set(["area", "base", "br", "col", "embed", "hr", "img", "input",
+                         "link", "meta", "param", "source", "track", "wbr"])
+    block_size = 1024*1024
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        ## The th cells of the rows having th cells, in document order
+        self.header_rows = []
+        ## The td cells of the rows in each table, in document order
+        self.tables = []
+        self._open_tables = []
+        self._row = None
+        self._cell = None
+
+    def parse(self, fh):
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        for block in iter(lambda: fh.read(self.block_size), ""):
+            self.feed(decoder.decode(block))
+        self.feed(decoder.decode("", final=True))
+        self.close()
+        return self
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "table":
+            self._open_tables.append(len(self.tables))
+            self.tables.append([])
+        elif tag == "tr":
+            self._row = ([], [])
+            for i in self._open_tables:
+                self.tables[i].append(self._row[1])
+        elif tag in ("th", "td"):
+            self._cell = [[tag, []]]
+            return
+        if self._cell is not None:
+            node = [tag, []]
+            self._cell[-1][1].append(node)
+            if tag not in self.void_elements:
+                self._cell.append(node)
+
+    def handle_startendtag(self, tag, attrs):
+        if self._cell is not None:
+            self._cell[-1][1].append([tag, []])
+
+    def handle_endtag(self, tag):
+        if tag in ("th", "td") and self._cell is not None:
+            if self._row is not None:
+                self._row[0 if self._cell[0][0] == "th" else 1].append(self._string(self._cell[0]))
+            self._cell = None
+        elif tag == "tr":
+            if self._row is not None and self._row[0]:
+                self.header_rows.append(self._row[0])
+            self._row = None
+        elif tag == "table" and self._open_tables:
+            self._open_tables.pop()
+        if self._cell is not None and tag in [node[0] for node in self._cell[1:]]:
+            while self._cell.pop()[0] != tag:
+                pass
+
+    def handle_data(self, data):
+        if self._cell is None:
+            return
+        children = self._cell[-1][1]
+        if children and isinstance(children[-1], basestring):
+            children[-1] += data
+        else:
+            children.append(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data(u"&{}".format(name))
+
+    def handle_charref(self, name):
+        if name[0] in "xX":
+            self.handle_data(unichr(int(name[1:], 16)))
+        else:
+            self.handle_data(unichr(int(name)))
+
+    def _string(self, node):
+        children = node[1]
+        if len(children) != 1:
+            return "None"
+        if isinstance(children[0], basestring):
+            return children[0].encode("utf-8")
+        return self._string(children[0])
+
 # Generic XML to dict parsing
 # See http://code.activestate.com/recipes/410469-xml-as-dictionary/
 class XmlToList(list):
@@ -318,140 +361,178 @@ class XmlToDict(dict):
             else:
                 self.update({element.tag: element.text})
 
-class IlluminaXMLParser():
-    """Illumina xml data parser. Parses xml files in flowcell directory."""
-    def __init__(self):
-        self._data = {}
-        self._element = None
-        self._tmp = None
-        self._header = None
-
-    def _chart_start_element(self, name, attrs):
-        self._element = name
-        if name == "FlowCellData":
-            self._header = attrs
-        if name == "Layout":
-            n_tiles_per_lane = int(attrs['RowsPerLane']) * int(attrs['ColsPerLane'])
-            if self._tmp is None:
-                self._tmp = self._header
-                self._tmp.update(attrs)
-                for i in range(1,int(attrs['NumLanes'])+1):
-                    for j in range(1,n_tiles_per_lane+1):
-                        key = "%s_%s" % (i,j)
-                        self._tmp[key] = {}
-
-        if name == "TL":
-            self._tmp[attrs["Key"]][self._index] = {}
-            for k in attrs.keys():
-                if k == "Key":
-                    continue
-                if attrs[k] == "NaN":
-                    v = None
-                else:
-                    v = float(attrs[k])
+class RTAChartMetrics(object):
+    """Per-tile values of an RTA chart type, e.g. ErrorRate, with one column per chart.
+    The values of each lane are held in a NumPy array of shape (tiles per lane, charts),
+    with NaN for tiles that have no value.
+    """
+    def __init__(self, header, charts, lanes):
+        ## The attributes of the FlowCellData and Layout elements of the first chart
+        self.header = header
+        ## The chart indexes, e.g. the cycles, in column order
+        self.charts = charts
+        ## The arrays of tile values, by lane number
+        self.lanes = lanes
+
+    @classmethod
+    def from_charts(cls, charts):
+        """Create the metrics from the charts parsed by _read_rta_chart"""
+        if len(charts) == 0:
+            return None
+        header = charts[0][1]
+        ntiles = int(header['RowsPerLane']) * int(header['ColsPerLane'])
+        lanes = {}
+        for i in range(1, int(header['NumLanes'])+1):
+            lanes[i] = np.empty((ntiles, len(charts)))
+            lanes[i].fill(np.nan)
+        for j, (index, h, lane, tile, values) in enumerate(charts):
+            for i in np.unique(lane):
+                mask = lane == i
+                lanes[i][tile[mask] - 1, j] = values[mask]
+        return cls(header, [c[0] for c in charts], lanes)
+
+    def as_dict(self):
+        """Return the metrics as a json serialisable dict, with the header attributes and
+        the values keyed by 'lane_tile' and chart index. NaN values are None.
+        """
+        data = dict(self.header)
+        for lane, values in self.lanes.items():
+            for t in range(values.shape[0]):
+                data["{}_{}".format(lane, t+1)] = {index: (None if np.isnan(v) else float(v)) for index, v in zip(self.charts, values[t])}
+        return data
 
-                self._tmp[attrs["Key"]][self._index] = v
+def _read_rta_chart(f):
+    """Read the tile values of an RTA chart, returning the chart index, the header
+    attributes and arrays of the lane, tile and value of each tile
+    """
+    header = {}
+    keys = []
+    values = []
+    def start_element(name, attrs):
+        if name in ("FlowCellData", "Layout"):
+            header.update(attrs)
+        elif name == "TL":
+            for k, v in attrs.items():
+                if k != "Key":
+                    keys.append(attrs["Key"])
+                    values.append(v)
+                    break
+    p = xml.parsers.expat.ParserCreate()
+    p.StartElementHandler = start_element
+    with open(f) as fp:
+        p.ParseFile(fp)
+    index = os.path.basename(f).rstrip(".xml").lstrip("Chart_")
+    lane_tile = np.array([k.split("_") for k in keys], dtype=int).reshape(-1, 2)
+    return index, header, lane_tile[:,0], lane_tile[:,1], np.array(values, dtype=float)
+
+def _read_rta_lanes(f, element):
+    """Read the attributes of the RTA element, with the attributes of each Lane
+    element keyed by lane, returning the file index and the attributes
+    """
+    data = {}
+    def start_element(name, attrs):
+        if name == element:
+            data.update(attrs)
+        if name == "Lane":
+            data[attrs['key']] = attrs
+    p = xml.parsers.expat.ParserCreate()
+    p.StartElementHandler = start_element
+    with open(f) as fp:
+        p.ParseFile(fp)
+    return os.path.basename(f).rstrip(".xml"), data
 
-    def _chart_end_element(self, name):
-        self._element = None
-    def _chart_char_data(self, data):
-        pass
+def _read_rta_file(args):
+    kind, f = args
+    if kind == "chart":
+        return _read_rta_chart(f)
+    return _read_rta_lanes(f, kind)
 
-    def _parse_charts(self, files):
-        for f in files:
-            self._index = os.path.basename(f).rstrip(".xml").lstrip("Chart_")
-            p = xml.parsers.expat.ParserCreate()
-            p.StartElementHandler = self._chart_start_element
-            p.EndElementHandler = self._chart_end_element
-            p.CharacterDataHandler = self._chart_char_data
-            fp = open(f)
-            p.ParseFile(fp)
-            fp.close()
+class IlluminaXMLParser():
+    """Illumina xml data parser. Parses the RTA xml files in the flowcell directory."""
+    ## The types of charts, with a function selecting their files
+    chart_types = [("ErrorRate", lambda x: os.path.dirname(x).endswith("ErrorRate")),
+                   ("FWHM", lambda x: os.path.dirname(x).endswith("FWHM")),
+                   ("Intensity", lambda x: os.path.dirname(x).endswith("Intensity")),
+                   ("NumGT30", lambda x: os.path.dirname(x).endswith("NumGT30")),
+                   ("Charts", lambda x: os.path.basename(x).endswith("_Chart.xml"))]
 
-    def _summary_start_element(self, name, attrs):
-        self._element = name
-        if name == "Summary":
-            self._tmp[self._index] = attrs
-        if name == "Lane":
-            self._tmp[self._index][attrs['key']] = attrs
-    def _summary_end_element(self, name):
-        self._element = None
-    def _summary_char_data(self, data):
-        pass
+    def __init__(self):
+        self._data = {}
 
-    def _parse_summary(self, files):
-        for f in files:
-            self._index = os.path.basename(f).rstrip(".xml")
-            p = xml.parsers.expat.ParserCreate()
-            p.StartElementHandler = self._summary_start_element
-            p.EndElementHandler = self._summary_end_element
-            p.CharacterDataHandler = self._summary_char_data
-            fp = open(f)
-            p.ParseFile(fp)
-            fp.close()
+    def _map(self, tasks, processes):
+        if processes > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                return pool.map(_read_rta_file, tasks, max(1, len(tasks)/(4*processes)))
+            finally:
+                pool.close()
+                pool.join()
+        return map(_read_rta_file, tasks)
 
-    def _clusters_start_element(self, name, attrs):
-        self._element = name
-        if name == "Data":
-            self._tmp[self._index] = attrs
-        if name == "Lane":
-            self._tmp[self._index][attrs['key']] = attrs
-    def _clusters_end_element(self, name):
-        self._element = None
-    def _clusters_char_data(self, data):
-        pass
+    ## Caution: no assert statements for file existence
+    def parse(self, files, fullRTA=False, processes=1):
+        """Parse the Summary and NumClusters files. Full parsing includes all RTA files,
+        with the tile values of the charts as RTAChartMetrics.
 
-    def _parse_clusters(self, files):
-        for f in files:
-            self._index = os.path.basename(f).rstrip(".xml")
-            p = xml.parsers.expat.ParserCreate()
-            p.StartElementHandler = self._clusters_start_element
-            p.EndElementHandler = self._clusters_end_element
-            p.CharacterDataHandler = self._clusters_char_data
-            fp = open(f)
-            p.ParseFile(fp)
-            fp.close()
+        :param files: the RTA xml files
+        :param fullRTA: parse the charts
+        :param processes: the number of processes parsing the files
 
-    ## Caution: no assert statements for file existence
-    def parse(self, files, fullRTA=False):
-        """Full parsing includes all RTA files"""
+        :returns: the parsed data, by type
+        """
+        tasks = []
         if fullRTA:
-            error_files = filter(lambda x: os.path.dirname(x).endswith("ErrorRate"), files)
-            self._parse_charts(error_files)
-            self._data["ErrorRate"] = self._tmp
-            self._tmp = None
-            FWHM_files = filter(lambda x: os.path.dirname(x).endswith("FWHM"), files)
-            self._parse_charts(FWHM_files)
-            self._data["FWHM"] = self._tmp
-            self._tmp = None
-            intensity_files = filter(lambda x: os.path.dirname(x).endswith("Intensity"), files)
-            self._parse_charts(intensity_files)
-            self._data["Intensity"] = self._tmp
-            self._tmp = None
-            numgt30_files = filter(lambda x: os.path.dirname(x).endswith("NumGT30"), files)
-            self._parse_charts(numgt30_files)
-            self._data["NumGT30"] = self._tmp
-            self._tmp = None
-            chart_files = filter(lambda x: os.path.basename(x).endswith("_Chart.xml"), files)
-            self._parse_charts(chart_files)
-            self._data["Charts"] = self._tmp
-            self._tmp = None
-
-        ## Parse Summary and clusters
-        self._tmp = {}
-        summary_files = filter(lambda x: os.path.dirname(x).endswith("Summary"), files)
-        self._parse_summary(summary_files)
-        self._data["Summary"] = self._tmp
-        self._tmp = {}
-        cluster_files = filter(lambda x: os.path.basename(x).startswith("NumClusters By"), files)
-        self._parse_clusters(cluster_files)
-        self._data["NumClusters"] = self._tmp
+            for name, select in self.chart_types:
+                tasks.extend([(name, ("chart", f)) for f in filter(select, files)])
+        tasks.extend([("Summary", ("Summary", f)) for f in files if os.path.dirname(f).endswith("Summary")])
+        tasks.extend([("NumClusters", ("Data", f)) for f in files if os.path.basename(f).startswith("NumClusters By")])
+        results = self._map([t[1] for t in tasks], processes)
+
+        parsed = collections.defaultdict(list)
+        for (name, task), result in itertools.izip(tasks, results):
+            parsed[name].append(result)
+        if fullRTA:
+            for name, select in self.chart_types:
+                self._data[name] = RTAChartMetrics.from_charts(parsed[name])
+        self._data["Summary"] = dict(parsed["Summary"])
+        self._data["NumClusters"] = dict(parsed["NumClusters"])
 
         return self._data
 
 class ExtendedFastQCParser(FastQCParser):
+    """Parse the fastqc_data.txt of a FastQC output directory, or of a FastQC zip
+    archive without extracting it. The file is read once and a section is split
+    into lines only when it is requested.
+    """
     def __init__(self, base_dir):
         FastQCParser.__init__(self, base_dir)
+        self._base_dir = base_dir
+        self._sections = None
+
+    def _read_fastqc_data(self):
+        if self._base_dir.endswith(".zip"):
+            with zipfile.ZipFile(self._base_dir) as zf:
+                names = [x for x in zf.namelist() if os.path.basename(x) == "fastqc_data.txt"]
+                return zf.read(names[0]) if names else ""
+        data_file = os.path.join(self._base_dir, "fastqc_data.txt")
+        if not os.path.exists(data_file):
+            return ""
+        with open(data_file) as fh:
+            return fh.read()
+
+    def _fastqc_data_sections(self):
+        """Split the data into the unparsed text of each section, by section name"""
+        if self._sections is None:
+            self._sections = {}
+            for section in ("\n" + self._read_fastqc_data()).split("\n>>")[1:]:
+                self._sections.setdefault(section.split("\t", 1)[0].split("\n", 1)[0].rstrip("\r"), section)
+        return self._sections
+
+    def _fastqc_data_section(self, section_name):
+        section = self._fastqc_data_sections().get(section_name)
+        if section is None:
+            return []
+        return [x.rstrip("\r") for x in section.split("\n")[1:]]
 
     def get_fastqc_summary(self):
         metric_labels = ["Per base sequence quality", "Basic Statistics", "Per sequence quality scores",
@@ -465,71 +546,411 @@ class ExtendedFastQCParser(FastQCParser):
         if len(section) == 0:
             return {}
         header = [x.strip("#") for x in section[0].rstrip("\t").split("\t")]
-        d = []
-        for l in section[1:]:
-            d.append(l.split("\t"))
-        data = np.array(d)
-        df = {header[i]:data[:,i].tolist() for i in range(0,len(header))}
+        columns = zip(*[x.split("\t") for x in section[1:]]) or [[] for x in header]
+        df = {header[i]:list(columns[i]) for i in range(0,len(header))}
         return df
 ##############################
 ##  objects
 ##############################
-class RunMetricsParser(dict):
-    """Generic Run Parser class"""
-    _metrics = []
+class RunDirectoryIndex(object):
+    """Snapshot of the files in a run directory. The directory tree is walked once,
+    skipping ignored directories, and the files are indexed by name, by extension
+    and by type and lane, see find_files. One index can be shared by all the
+    flowcell and sample parsers of a run directory.
+    """
     ## Following paths are ignored
     ignore = "|".join(["tmp", "tx", "-split", "log"])
     reignore = re.compile(ignore)
+    ## The types of metrics files, with a regular expression matching the file name.
+    ## The files are indexed by type and by the lane that the file name starts with
+    file_types = [("picard", re.compile(r"\.(align|hs|insert|dup)_metrics$")),
+                  ("fastq_screen", re.compile(r"_screen\.txt$")),
+                  ("filter", re.compile(r"\.filter_metrics$")),
+                  ("bc", re.compile(r"[\._]bc[\._]metrics$")),
+                  ("eval", re.compile(r"\.eval_metrics$")),
+                  ("checkpoint", re.compile(r"^[0-9][0-9]_[^\/]+\.txt"))]
+    relane = re.compile(r"^([0-9]+)_")
 
-    def __init__(self, log=None):
-        super(RunMetricsParser, self).__init__()
+    def __init__(self, path):
+        self.path = path
         self.files = []
-        self.path=None
-        self.log = LOG
-        if log:
-            self.log = log
+        self._file_index = collections.defaultdict(list)
+        self._patterns = {}
+        self._collect_files()
 
     def _collect_files(self):
+        """Walk the directory tree once, pruning the ignored directories"""
         if not self.path:
             return
         if not os.path.exists(self.path):
             raise IOError
-        self.files = []
         for root, dirs, files in os.walk(self.path):
-            if re.search(self.reignore, root):
-                continue
-            self.files = self.files + [os.path.join(root, x) for x in files]
+            # Prune the ignored directories, so that they are not walked
+            dirs[:] = [d for d in dirs if not self.reignore.search(d)]
+            for x in files:
+                self._index_file(root, x)
+
+    def _index_file(self, root, name):
+        f = os.path.join(root, name)
+        self.files.append(f)
+        self._file_index[("name", name)].append(f)
+        self._file_index[("ext", os.path.splitext(name)[1])].append(f)
+        m = self.relane.match(name)
+        lane = m.group(1) if m else None
+        for ftype, regexp in self.file_types:
+            if regexp.search(name):
+                self._file_index[(ftype, None)].append(f)
+                self._file_index[(ftype, lane)].append(f)
+        # FastQC output is found in a directory named by the lane, below the fastqc directory,
+        # or in a zip archive named by the lane, in the fastqc directory
+        parent, fastqc_dir = os.path.split(root)
+        if os.path.basename(parent) == "fastqc":
+            m = self.relane.match(fastqc_dir)
+            self._file_index[("fastqc", None)].append(f)
+            self._file_index[("fastqc", m.group(1) if m else None)].append(f)
+        elif fastqc_dir == "fastqc" and name.endswith("_fastqc.zip"):
+            self._file_index[("fastqc", None)].append(f)
+            self._file_index[("fastqc", lane)].append(f)
+
+    def pattern(self, pattern):
+        """Return the compiled regular expression of pattern"""
+        if pattern not in self._patterns:
+            self._patterns[pattern] = re.compile(pattern)
+        return self._patterns[pattern]
+
+    def find_files(self, ftype=None, lane=None, pattern=None, name=None, ext=None):
+        """Look up indexed files by type and lane, by name or by extension, and
+        optionally filter them on a regular expression
+
+        :param ftype: the type of file, one of the types in file_types or fastqc
+        :param lane: the lane that the file name starts with, or None for any lane
+        :param pattern: a regular expression to search the paths of the files for
+        :param name: the name of the file, used instead of ftype and lane
+        :param ext: the extension of the file, e.g. '.xml', used instead of ftype and lane
+
+        :returns: a list of the matching files
+        """
+        if name is not None:
+            files = self._file_index.get(("name", name), [])
+        elif ext is not None:
+            files = self._file_index.get(("ext", ext), [])
+        else:
+            files = self._file_index.get((ftype, None if lane is None else str(lane)), [])
+        if pattern is None:
+            return list(files)
+        regexp = self.pattern(pattern)
+        return [f for f in files if regexp.search(f)]
+
+class MetricsManifest(object):
+    """Manifest of the parsed metrics files of a flowcell, saved as json. The results of
+    parsing files are stored with the size, modification time and content hash of the
+    files, so that unchanged files are not parsed again. The documents are stored with
+    a hash of their contents, so that unchanged documents are not pushed again.
+    """
+    ## Document fields that change on every collection, and are not hashed
+    volatile_fields = ["_id", "_rev", "creation_time", "modification_time"]
+
+    def __init__(self, path=None, log=None):
+        self.path = path
+        self.files = {}
+        self.results = {}
+        self.documents = {}
+        self._updates = {"files": {}, "results": {}}
+        self.log = LOG
+        if log:
+            self.log = log
+        if path and os.path.exists(path):
+            try:
+                with open(path) as fh:
+                    data = json.load(fh)
+                self.files = data["files"]
+                self.results = data["results"]
+                self.documents = data["documents"]
+            except (ValueError, KeyError):
+                self.log.warn("Reading manifest {} failed; parsing all files".format(path))
+
+    def _sha1(self, f):
+        h = hashlib.sha1()
+        with open(f, "rb") as fh:
+            for block in iter(lambda: fh.read(1024*1024), ""):
+                h.update(block)
+        return h.hexdigest()
+
+    def fingerprint(self, f):
+        """Return the content hash of file f. The file is only hashed if its size or
+        modification time differ from the manifest
+        """
+        st = os.stat(f)
+        entry = self.files.get(f)
+        if entry is None or entry[0] != st.st_size or entry[1] != st.st_mtime:
+            entry = [st.st_size, st.st_mtime, self._sha1(f)]
+            self.files[f] = entry
+            self._updates["files"][f] = entry
+        return entry[2]
+
+    def parse(self, name, files, parse_fn):
+        """Return the result of parse_fn(files), or the result stored in the manifest
+        if the files have not changed since they were parsed
+
+        :param name: the name of the result, e.g. the parser method
+        :param files: the list of files parsed
+        :param parse_fn: function parsing the files
+
+        :returns: the parsed result
+        """
+        key = "\t".join([name] + list(files))
+        digests = [self.fingerprint(f) for f in files]
+        entry = self.results.get(key)
+        if entry is not None and entry["files"] == digests:
+            return copy.deepcopy(entry["result"])
+        result = parse_fn(files)
+        entry = {"files": digests, "result": copy.deepcopy(result)}
+        self.results[key] = entry
+        self._updates["results"][key] = entry
+        return result
+
+    def pop_updates(self):
+        """Return and clear the entries added since the last call, see update"""
+        updates = self._updates
+        self._updates = {"files": {}, "results": {}}
+        return updates
+
+    def update(self, updates):
+        """Add the entries of another manifest, as returned by its pop_updates"""
+        self.files.update(updates["files"])
+        self.results.update(updates["results"])
+
+    def _digest(self, obj):
+        contents = {k: v for k, v in obj.items() if k not in self.volatile_fields}
+        return hashlib.sha1(json.dumps(contents, sort_keys=True, default=str)).hexdigest()
+
+    def changed(self, obj):
+        """Return True if the contents of document obj differ from when it was last pushed"""
+        return self.documents.get("{}\t{}".format(obj["entity_type"], obj["name"])) != self._digest(obj)
+
+    def pushed(self, obj):
+        """Record the contents of the pushed document obj"""
+        self.documents["{}\t{}".format(obj["entity_type"], obj["name"])] = self._digest(obj)
+
+    def save(self):
+        """Save the manifest, leaving out the files that no longer exist"""
+        self.files = {f: v for f, v in self.files.items() if os.path.exists(f)}
+        self.results = {k: v for k, v in self.results.items() if all([f in self.files for f in k.split("\t")[1:]])}
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, "w") as fh:
+            json.dump({"files": self.files, "results": self.results, "documents": self.documents}, fh)
+        os.rename(tmp, self.path)
+
+class MetricsCache(object):
+    """Persistent cache of the results of parsing metrics files, in an sqlite database.
+    The results are stored by parser name and files, with the size and modification
+    time of the files, and the least recently used results are evicted when the
+    stored results exceed max_size bytes. The parsers use the shared cache, see
+    MetricsCache.shared, unless it is disabled.
+    """
+    ## The location and size limit of the shared cache
+    default_path = os.path.join(os.path.expanduser("~"), ".pm", "metrics_cache.sqlite")
+    default_max_size = 256 * 1024 * 1024
+    ## Set to False to disable the shared cache
+    enabled = True
+    _shared = None
+
+    def __init__(self, path, max_size=None, log=None):
+        self.path = path
+        self.max_size = max_size if max_size is not None else self.default_max_size
+        self.log = LOG
+        if log:
+            self.log = log
+        self._conn = None
+        self._pid = None
+        self._total = None
+
+    @classmethod
+    def shared(cls):
+        """Return the cache shared by the parsers, or None if it is disabled"""
+        if not cls.enabled:
+            return None
+        if cls._shared is None or cls._shared.path != cls.default_path:
+            cls._shared = MetricsCache(cls.default_path)
+        return cls._shared
+
+    @classmethod
+    def configure(cls, enabled=True, path=None, max_size=None):
+        """Enable or disable the shared cache, optionally at path and with max_size bytes"""
+        cls.enabled = enabled
+        if path is not None:
+            cls.default_path = path
+        if max_size is not None:
+            cls.default_max_size = max_size
+        cls._shared = None
+
+    def _connection(self):
+        # An sqlite connection can not be used in a forked worker process, so reconnect there
+        if self._conn is None or self._pid != os.getpid():
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.text_factory = str
+            self._conn.execute("CREATE TABLE IF NOT EXISTS metrics (key TEXT PRIMARY KEY, fingerprint TEXT, result TEXT, size INTEGER, accessed REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS metrics_accessed ON metrics (accessed)")
+            self._conn.commit()
+            self._pid = os.getpid()
+            self._total = None
+        return self._conn
+
+    def _fingerprint(self, files):
+        return json.dumps([[os.path.getsize(f), os.path.getmtime(f)] for f in files])
+
+    def get(self, key, fingerprint):
+        """Return the stored result, or None if there is none for the fingerprint"""
+        conn = self._connection()
+        row = conn.execute("SELECT fingerprint, result FROM metrics WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return None
+        conn.execute("UPDATE metrics SET accessed = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        return json.loads(row[1])
+
+    def put(self, key, fingerprint, result):
+        """Store the result, evicting the least recently used results if needed"""
+        conn = self._connection()
+        data = json.dumps(result)
+        if self._total is None:
+            self._total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM metrics").fetchone()[0]
+        row = conn.execute("SELECT size FROM metrics WHERE key = ?", (key,)).fetchone()
+        conn.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)", (key, fingerprint, data, len(data), time.time()))
+        self._total += len(data) - (row[0] if row else 0)
+        if self._total > self.max_size:
+            self._evict(conn)
+        conn.commit()
+
+    def _evict(self, conn):
+        self._total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM metrics").fetchone()[0]
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM metrics ORDER BY accessed").fetchall():
+            if self._total <= self.max_size:
+                break
+            evicted.append((key,))
+            self._total -= size
+        conn.executemany("DELETE FROM metrics WHERE key = ?", evicted)
+        self.log.debug("Evicted {} results from metrics cache {}".format(len(evicted), self.path))
+
+    def parse(self, name, files, parse_fn):
+        """Return the result of parse_fn(files), or the stored result if the files
+        have the same sizes and modification times as when they were parsed. A
+        failing cache is logged and bypassed.
+
+        :param name: the name of the result, e.g. the parser method
+        :param files: the list of files parsed
+        :param parse_fn: function parsing the files
+
+        :returns: the parsed result
+        """
+        try:
+            key = "\t".join([name] + [os.path.abspath(f) for f in files])
+            fingerprint = self._fingerprint(files)
+            result = self.get(key, fingerprint)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            self.log.warn("Reading metrics cache {} failed: {}".format(self.path, e))
+            return parse_fn(files)
+        if result is not None:
+            return result
+        result = parse_fn(files)
+        try:
+            self.put(key, fingerprint, result)
+        except (sqlite3.Error, OSError, TypeError, ValueError) as e:
+            self.log.warn("Writing metrics cache {} failed: {}".format(self.path, e))
+        return result
+
+class RunMetricsParser(dict):
+    """Generic Run Parser class"""
+    _metrics = []
+
+    def __init__(self, log=None):
+        super(RunMetricsParser, self).__init__()
+        self.index = RunDirectoryIndex(None)
+        self.manifest = None
+        self.path=None
+        self.log = LOG
+        if log:
+            self.log = log
+
+    @property
+    def files(self):
+        return self.index.files
+
+    def _collect_files(self, index=None):
+        """Use the index of the files in the run directory, or walk the directory
+        tree once to create it
+
+        :param index: a RunDirectoryIndex of self.path to share with other parsers
+        """
+        if index is not None and index.path != self.path:
+            raise ValueError("index of {} can not be used for {}".format(index.path, self.path))
+        if index is None:
+            index = RunDirectoryIndex(self.path)
+        self.index = index
+
+    def find_files(self, ftype=None, lane=None, pattern=None, name=None, ext=None):
+        """Look up indexed files, see RunDirectoryIndex.find_files"""
+        return self.index.find_files(ftype, lane, pattern, name, ext)
+
+    def _parse_files(self, name, files, parse_fn):
+        """Return parse_fn(files), or the stored result from the manifest or from the
+        shared cache if the files have not changed, see MetricsManifest.parse and
+        MetricsCache.parse
+        """
+        cache = MetricsCache.shared()
+        if cache is not None:
+            uncached_fn = parse_fn
+            def parse_fn(files):
+                return cache.parse(name, files, uncached_fn)
+        if self.manifest is None:
+            return parse_fn(files)
+        return self.manifest.parse(name, files, parse_fn)
+
+    def _parse_file(self, name, f, parse_fn):
+        """Return parse_fn applied to the open file f, see _parse_files"""
+        def parse(files):
+            with open(files[0]) as fh:
+                return parse_fn(fh)
+        return self._parse_files(name, [f], parse)
 
     def filter_files(self, pattern, filter_fn=None):
         """Take file list and return those files that pass the filter_fn criterium"""
         def filter_function(f):
-            return re.search(pattern, f) != None
+            return regexp.search(f) != None
         if not filter_fn:
+            regexp = self.index.pattern(pattern)
             filter_fn = filter_function
         return filter(filter_fn, self.files)
 
-    def parse_json_files(self, filter_fn=None):
+    def parse_json_files(self, filter_fn=None, files=None):
         """Parse json files and return the corresponding dicts
         """
         def filter_function(f):
             return f is not None and f.endswith(".json")
         if not filter_fn:
             filter_fn = filter_function
-        files = self.filter_files(None,filter_fn)
+        if files is None:
+            files = self.filter_files(None,filter_fn)
         dicts = []
         for f in files:
             with open(f) as fh:
                 dicts.append(json.load(fh))
         return dicts
 
-    def parse_csv_files(self, filter_fn=None):
+    def parse_csv_files(self, filter_fn=None, files=None):
         """Parse csv files and return a dict with filename as key and the corresponding dicts as value
         """
         def filter_function(f):
             return f is not None and f.endswith(".csv")
         if not filter_fn:
             filter_fn = filter_function
-        files = self.filter_files(None,filter_fn)
+        if files is None:
+            files = self.filter_files(None,filter_fn)
         dicts = {}
         for f in files:
             with open(f) as fh:
@@ -539,23 +960,24 @@ class RunMetricsParser(dict):
 class SampleRunMetricsParser(RunMetricsParser):
     """Sample-level class for parsing run metrics data"""
 
-    def __init__(self, path):
+    def __init__(self, path, index=None, manifest=None):
         RunMetricsParser.__init__(self)
         self.path = path
-        self._collect_files()
+        self.manifest = manifest
+        self._collect_files(index)
 
     def read_picard_metrics(self, barcode_name, sample_prj, lane, flowcell, barcode_id, **kw):
         self.log.debug("read_picard_metrics for sample {}, project {}, lane {} in run {}".format(barcode_name, sample_prj, lane, flowcell))
         picard_parser = ExtendedPicardMetricsParser()
         pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id),
                             "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.find_files("picard", lane, pattern)
         if len(files) == 0:
             self.log.warn("no picard metrics files for sample {}; pattern {}".format(barcode_name, pattern))
             return {}
         try:
             self.log.debug("files {}".format(",".join(files)))
-            metrics = picard_parser.extract_metrics(files)
+            metrics = self._parse_files("picard_metrics", files, picard_parser.extract_metrics)
             return metrics
         except:
             self.log.warn("no picard metrics for sample {}".format(barcode_name))
@@ -567,13 +989,10 @@ class SampleRunMetricsParser(RunMetricsParser):
         pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?_[12]_screen.txt".format(lane, barcode_id),
                             "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?_[12]_screen.txt".format(lane, barcode_id),
                             "{}_{}_L0*{}_.*_screen.txt".format(barcode_name, kw.get("sequence"), lane)])
-        files = self.filter_files(pattern)
+        files = self.find_files("fastq_screen", pattern=pattern)
         self.log.debug("files {}".format(",".join(files)))
         try:
-            fp = open(files[0])
-            data = parser.parse_fastq_screen_metrics(fp)
-            fp.close()
-            return data
+            return self._parse_file("fastq_screen", files[0], parser.parse_fastq_screen_metrics)
         except:
             self.log.warn("no fastq screen metrics for sample {}".format(barcode_name))
             return {}
@@ -581,17 +1000,13 @@ class SampleRunMetricsParser(RunMetricsParser):
     def parse_bcbb_checkpoints(self, barcode_name, sample_prj, flowcell, barcode_id, **kw):
         self.log.debug("parse_bcbb_checkpoints for sample {}, project {} in run {}".format(barcode_name, sample_prj, flowcell))
         parser = MetricsParser()
-        def filter_fn(f):
-            return re.match("[0-9][0-9]_[^\/]+\.txt", os.path.basename(f)) != None
-
-        files = self.filter_files(None,filter_fn)
+        files = self.find_files("checkpoint")
         self.log.debug("files {}".format(",".join(files)))
 
         checkpoints = {}
         for f in files:
             try:
-                with open(f) as fh:
-                    checkpoints[os.path.splitext(os.path.basename(f))[0]] = parser.parse_bcbb_checkpoints(fh)
+                checkpoints[os.path.splitext(os.path.basename(f))[0]] = self._parse_file("bcbb_checkpoints", f, parser.parse_bcbb_checkpoints)
             except Exception as e:
                 self.log.warn("Exception: {}".format(e))
                 self.log.warn("no bcbb checkpoint for sample {} using pattern '{}'".format(barcode_name, pattern))
@@ -602,13 +1017,11 @@ class SampleRunMetricsParser(RunMetricsParser):
         self.log.debug("parse_software_versions for sample {}, project {} in run {}".format(barcode_name, sample_prj, flowcell))
         parser = MetricsParser()
         pattern = "bcbb_software_versions.txt"
-        files = self.filter_files(pattern)
+        files = self.find_files(name=pattern)
         self.log.debug("files {}".format(",".join(files)))
         data = {}
         try:
-            fp = open(files[0])
-            data = parser.parse_software_versions(fp)
-            fp.close()
+            data = self._parse_file("software_versions", files[0], parser.parse_software_versions)
         except:
             self.log.warn("no bcbb_software_versions.txt for sample {}".format(barcode_name))
 
@@ -619,12 +1032,20 @@ class SampleRunMetricsParser(RunMetricsParser):
         if barcode_name == "unmatched":
             return
         pattern = "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-*".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.find_files("fastqc", lane, pattern)
         self.log.debug("files {}".format(",".join(files)))
         try:
-            fastqc_dir = os.path.dirname(files[0])
-            fqparser = ExtendedFastQCParser(fastqc_dir)
-            stats = fqparser.get_fastqc_summary()
+            # Prefer extracted output over a zip archive
+            files = sorted(files, key=lambda x: x.endswith(".zip"))
+            if files[0].endswith(".zip"):
+                def parse(files):
+                    return ExtendedFastQCParser(files[0]).get_fastqc_summary()
+                stats = self._parse_files("fastqc", files[0:1], parse)
+            else:
+                def parse(files):
+                    return ExtendedFastQCParser(os.path.dirname(files[0])).get_fastqc_summary()
+                fastqc_dir = os.path.dirname(files[0])
+                stats = self._parse_files("fastqc", [os.path.join(fastqc_dir, "fastqc_data.txt")], parse)
             return {'stats':stats}
         except Exception as e:
             self.log.warn("Exception: {}".format(e))
@@ -635,9 +1056,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """Parse the json output from the GATK genotype evaluation"""
         self.log.debug("parse_eval_metrics for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?.*.eval_metrics".format(lane, barcode_id)
-        def filter_function(f):
-            return re.search(pattern, f) != None
-        metrics = self.parse_json_files(filter_fn=filter_function)
+        metrics = self.parse_json_files(files=self.find_files("eval", lane, pattern))
         if metrics:
             return metrics[0]
         return {}
@@ -646,9 +1065,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """Parse the project summary output"""
         self.log.debug("parse_project_summary for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "project-summary.csv"
-        def filter_function(f):
-            return os.path.basename(f) == pattern
-        metrics = self.parse_csv_files(filter_fn=filter_function)
+        metrics = self.parse_csv_files(files=self.find_files(name=pattern))
         if metrics:
             return metrics.values()[0][0]
         return {}
@@ -681,7 +1098,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """CASAVA: Parse filter metrics at sample level"""
         self.log.debug("parse_filter_metrics for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?.filter_metrics".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.find_files("filter", lane, pattern)
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -709,16 +1126,14 @@ class SampleRunMetricsParser(RunMetricsParser):
                 else:
                     return reads/2
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
-        files = self.filter_files(pattern)
+        files = self.find_files("bc", lane, pattern)
         if len(files) == 0:
             self.log.debug("no bc metrics files for sample {}, lane {}; pattern {}".format(barcode_name, lane, pattern))
             return None
         self.log.debug("files {}".format(",".join(files)))
         try:
             parser = MetricsParser()
-            fp = open(files[0])
-            data = parser.parse_bc_metrics(fp)
-            fp.close()
+            data = self._parse_file("bc_metrics", files[0], parser.parse_bc_metrics)
             return data[str(barcode_id)]
         except:
             self.log.warn("No bc_metrics info for lane {}".format(lane))
@@ -733,10 +1148,11 @@ class SampleRunMetricsParser(RunMetricsParser):
 class FlowcellRunMetricsParser(RunMetricsParser):
     """Flowcell level class for parsing flowcell run metrics data."""
     _lanes = range(1,9)
-    def __init__(self, path):
+    def __init__(self, path, index=None, manifest=None):
         RunMetricsParser.__init__(self)
         self.path = path
-        self._collect_files()
+        self.manifest = manifest
+        self._collect_files(index)
 
     def parseRunInfo(self, fn="RunInfo.xml", **kw):
         infile = os.path.join(os.path.abspath(self.path), fn)
@@ -818,16 +1234,28 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             self.log.warn("No such file {}".format(infile))
             return False
 
-    def parse_illumina_metrics(self, fullRTA=False, **kw):
+    def _rta_files(self):
+        """Find the RTA xml files in Data/reports and its subdirectories"""
+        reports = os.path.join(self.path, "Data", "reports")
+        return sorted(glob.glob(os.path.join(reports, "*.xml")) + glob.glob(os.path.join(reports, "*", "*.xml")))
+
+    def parse_illumina_metrics(self, fullRTA=False, processes=1, **kw):
+        """Parse the RTA xml files. With fullRTA, the tile values of the charts are
+        returned as RTAChartMetrics, see RTAChartMetrics.as_dict.
+
+        :param fullRTA: parse the charts
+        :param processes: the number of processes parsing the files
+        """
         self.log.debug("parse_illumina_metrics")
-        fn = []
-        for root, dirs, files in os.walk(os.path.abspath(self.path)):
-            for f in files:
-                if f.endswith(".xml"):
-                    fn.append(os.path.join(root, f))
+        fn = self._rta_files()
         self.log.debug("Found {} RTA files {}...".format(len(fn), ",".join(fn[0:10])))
-        parser = IlluminaXMLParser()
-        metrics = parser.parse(fn, fullRTA)
+        def parse(files):
+            return IlluminaXMLParser().parse(files, fullRTA, processes)
+        if fullRTA:
+            ## The chart arrays are not cached in the manifest
+            metrics = parse(fn)
+        else:
+            metrics = self._parse_files("illumina_metrics", fn, parse)
         def filter_function(f):
             return f is not None and f == "run_summary.json"
         try:
@@ -836,6 +1264,35 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             pass
         return metrics
 
+    def interop_metrics(self, reads=None):
+        """Return the InterOpMetrics of the InterOp directory of the flowcell
+
+        :param reads: the Reads of RunInfo.xml. If None, RunInfo.xml is parsed.
+        """
+        if reads is None:
+            reads = self.parseRunInfo().get("Reads", [])
+        return InterOpMetrics(os.path.join(self.path, "InterOp"), reads)
+
+    def parse_interop_metrics(self, reads=None, **kw):
+        """Parse the InterOp binary files, returning the lane and read aggregates
+        of InterOpMetrics.summary
+
+        :param reads: the Reads of RunInfo.xml. If None, RunInfo.xml is parsed.
+        """
+        self.log.debug("parse_interop_metrics")
+        try:
+            metrics = self.interop_metrics(reads)
+            files = metrics.files()
+            if len(files) == 0:
+                return {}
+            def parse(files):
+                return metrics.summary()
+            # The aggregates depend on the reads, so the stored results are kept apart by reads
+            return self._parse_files("interop_metrics {}".format(json.dumps(metrics.reads, sort_keys=True)), files, parse)
+        except (InterOpError, IOError, ValueError) as e:
+            self.log.warn("Reading InterOp metrics in {} failed: {}".format(self.path, e))
+            return {}
+
     def parse_filter_metrics(self, fc_name, **kw):
         """pre-CASAVA: Parse filter metrics at flowcell level"""
         self.log.debug("parse_filter_metrics for flowcell {}".format(fc_name))
@@ -843,13 +1300,11 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         for lane in self._lanes:
             pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?.filter_metrics".format(lane)
             lanes[str(lane)]["filter_metrics"] = {"reads":None, "reads_aligned":None, "reads_fail_align":None}
-            files = self.filter_files(pattern)
+            files = self.find_files("filter", lane, pattern)
             self.log.debug("filter metrics files {}".format(",".join(files)))
             try:
-                fp = open(files[0])
                 parser = MetricsParser()
-                data = parser.parse_filter_metrics(fp)
-                fp.close()
+                data = self._parse_file("filter_metrics", files[0], parser.parse_filter_metrics)
                 lanes[str(lane)]["filter_metrics"] = data
             except:
                 self.log.warn("No filter nophix metrics for lane {}".format(lane))
@@ -862,13 +1317,11 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         for lane in self._lanes:
             pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
             lanes[str(lane)]["bc_metrics"] = {}
-            files = self.filter_files(pattern)
+            files = self.find_files("bc", lane, pattern)
             self.log.debug("bc metrics files {}".format(",".join(files)))
             try:
                 parser = MetricsParser()
-                fp = open(files[0])
-                data = parser.parse_bc_metrics(fp)
-                fp.close()
+                data = self._parse_file("bc_metrics", files[0], parser.parse_bc_metrics)
                 lanes[str(lane)]["bc_metrics"] = data
             except:
                 self.log.warn("No bc_metrics info for lane {}".format(lane))
@@ -921,6 +1374,36 @@ class FlowcellRunMetricsParser(RunMetricsParser):
 
         return lanes
 
+    def _read_demultiplex_stats_htm(self, htm_file):
+        """Read the barcode lane statistics and sample information of a Demultiplex_Stats.htm file"""
+        metrics = {}
+        with open(htm_file) as fh:
+            parser = DemultiplexStatsParser().parse(fh)
+        ##
+        ## Find headers
+        headers = parser.header_rows
+        bc_header = list(headers[0])
+        smp_header = list(headers[1])
+        ## 'Known' headers from a Demultiplex_Stats.htm document
+        bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
+        smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
+        if not bc_header == bc_header_known:
+            self.log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
+        if not smp_header == smp_header_known:
+            self.log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
+        ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
+        smp_header[0] = "Sample ID"
+
+        ## Parse Barcode lane statistics
+        parse_row = lambda row: {bc_header[i]:row[i] for i in range(0, len(bc_header)) if row}
+        metrics["Barcode_lane_statistics"] = map(parse_row, parser.tables[1])
+
+        ## Parse Sample information
+        parse_row = lambda row: {smp_header[i]:row[i] for i in range(0, len(smp_header)) if row}
+        metrics["Sample_information"] = map(parse_row, parser.tables[3])
+
+        return metrics
+
     def parse_demultiplex_stats_htm(self, fc_name, **kw):
         """Parse the Unaligned*/Basecall_Stats_*/Demultiplex_Stats.htm file
         generated from CASAVA demultiplexing and returns barcode metrics.
@@ -934,42 +1417,9 @@ class FlowcellRunMetricsParser(RunMetricsParser):
             if not os.path.exists(htm_file):
                 self.log.warn("No such file {}".format(htm_file))
                 continue
-            with open(htm_file) as fh:
-                htm_doc = fh.read()
-            soup = BeautifulSoup(htm_doc)
-            ##
-            ## Find headers
-            allrows = soup.findAll("tr")
-            column_gen=(row.findAll("th") for row in allrows)
-            parse_row = lambda row: row
-            headers = [h for h in map(parse_row, column_gen) if h]
-            bc_header = [str(x.string) for x in headers[0]]
-            smp_header = [str(x.string) for x in headers[1]]
-            ## 'Known' headers from a Demultiplex_Stats.htm document
-            bc_header_known = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of >= Q30 Bases (PF)', 'Mean Quality Score (PF)']
-            smp_header_known = ['None', 'Recipe', 'Operator', 'Directory']
-            if not bc_header == bc_header_known:
-                self.log.warn("Barcode lane statistics header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in bc_header_known])), ",".join(["'{}'".format(x) for x in bc_header])))
-            if not smp_header == smp_header_known:
-                self.log.warn("Sample header information has changed. New format?\nOld format: {}\nSaw: {}".format(",".join((["'{}'".format(x) for x in smp_header_known])), ",".join(["'{}'".format(x) for x in smp_header])))
-            ## Fix first header name in smp_header since htm document is mal-formatted: <th>Sample<p></p>ID</th>
-            smp_header[0] = "Sample ID"
-
-            ## Parse Barcode lane statistics
-            soup = BeautifulSoup(htm_doc)
-            table = soup.findAll("table")[1]
-            rows = table.findAll("tr")
-            column_gen = (row.findAll("td") for row in rows)
-            parse_row = lambda row: {bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row}
-            metrics["Barcode_lane_statistics"].extend(map(parse_row, column_gen))
-
-            ## Parse Sample information
-            soup = BeautifulSoup(htm_doc)
-            table = soup.findAll("table")[3]
-            rows = table.findAll("tr")
-            column_gen = (row.findAll("td") for row in rows)
-            parse_row = lambda row: {smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row}
-            metrics["Sample_information"].extend(map(parse_row, column_gen))
+            data = self._parse_files("demultiplex_stats", [htm_file], lambda files: self._read_demultiplex_stats_htm(files[0]))
+            metrics["Barcode_lane_statistics"].extend(data["Barcode_lane_statistics"])
+            metrics["Sample_information"].extend(data["Sample_information"])
 
         # Define a function for sorting the values
         def by_lane_sample(data):
@@ -0,0 +1,237 @@
+"""Readers for the Illumina InterOp binary metrics files.
+
+The records of a metrics file are memory-mapped into a NumPy structured array,
+so that lane and read aggregates can be computed without parsing the records one
+by one:
+
+    metrics = InterOpMetrics("/path/to/run/InterOp", reads=runinfo["Reads"])
+    summary = metrics.summary()
+
+Each file starts with a version byte and a record length byte. The versions
+written by RTA 1.13 - 1.18 are supported.
+"""
+import os
+import numpy as np
+
+ERROR_METRICS = "ErrorMetricsOut.bin"
+QUALITY_METRICS = "QMetricsOut.bin"
+TILE_METRICS = "TileMetricsOut.bin"
+EXTRACTION_METRICS = "ExtractionMetricsOut.bin"
+
+_TILE = [("lane", "<u2"), ("tile", "<u2")]
+_CYCLE = _TILE + [("cycle", "<u2")]
+
+ERROR_DTYPES = {3: np.dtype(_CYCLE + [("error_rate", "<f4"), ("errors", "<u4", (5,))])}
+TILE_DTYPES = {2: np.dtype(_TILE + [("code", "<u2"), ("value", "<f4")])}
+EXTRACTION_DTYPES = {2: np.dtype(_CYCLE + [("fwhm", "<f4", (4,)), ("intensity", "<u2", (4,)), ("datetime", "<u8")])}
+
+## The number of quality scores of the unbinned QMetricsOut records
+QSCORES = 50
+
+## The tile metric codes
+CLUSTER_DENSITY = 100
+CLUSTER_DENSITY_PF = 101
+CLUSTER_COUNT = 102
+CLUSTER_COUNT_PF = 103
+
+class InterOpError(Exception):
+    """Raised for InterOp files of an unknown version or layout"""
+    pass
+
+def _header(fh):
+    header = bytearray(fh.read(2))
+    if len(header) < 2:
+        raise InterOpError("Missing header of {}".format(fh.name))
+    version, length = header
+    return version, length
+
+def _memmap(fname, dtype, offset):
+    """Memory-map the records following offset bytes of header"""
+    nrecords = (os.path.getsize(fname) - offset) // dtype.itemsize
+    if nrecords == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode="r", offset=offset, shape=(nrecords,))
+
+def _read_records(fname, dtypes):
+    with open(fname, "rb") as fh:
+        version, length = _header(fh)
+    if version not in dtypes or dtypes[version].itemsize != length:
+        raise InterOpError("Unsupported version {} with record length {} of {}".format(version, length, fname))
+    return _memmap(fname, dtypes[version], 2)
+
+def read_error_metrics(fname):
+    """Read ErrorMetricsOut.bin, with the PhiX error rate of each lane, tile and cycle
+
+    :param fname: the file name
+
+    :returns: a structured array with fields lane, tile, cycle, error_rate and errors
+    """
+    return _read_records(fname, ERROR_DTYPES)
+
+def read_tile_metrics(fname):
+    """Read TileMetricsOut.bin, with a metric code and value per record
+
+    :param fname: the file name
+
+    :returns: a structured array with fields lane, tile, code and value
+    """
+    return _read_records(fname, TILE_DTYPES)
+
+def read_extraction_metrics(fname):
+    """Read ExtractionMetricsOut.bin, with the FWHM and intensity of each channel
+
+    :param fname: the file name
+
+    :returns: a structured array with fields lane, tile, cycle, fwhm, intensity and datetime
+    """
+    return _read_records(fname, EXTRACTION_DTYPES)
+
+def read_quality_metrics(fname):
+    """Read QMetricsOut.bin, with the number of clusters per quality score
+
+    :param fname: the file name
+
+    :returns: a structured array with fields lane, tile, cycle and counts, and
+    an array with the quality score of each column of counts
+    """
+    with open(fname, "rb") as fh:
+        version, length = _header(fh)
+        offset = 2
+        qscores = np.arange(1, QSCORES + 1)
+        if version in (5, 6):
+            binned = bytearray(fh.read(1))[0]
+            offset += 1
+            if binned:
+                nbins = bytearray(fh.read(1))[0]
+                bins = np.frombuffer(fh.read(3 * nbins), dtype=np.uint8).reshape(3, nbins)
+                offset += 1 + 3 * nbins
+                if version == 6:
+                    qscores = bins[2].astype(int)
+        elif version != 4:
+            raise InterOpError("Unsupported version {} of {}".format(version, fname))
+    dtype = np.dtype(_CYCLE + [("counts", "<u4", (len(qscores),))])
+    if dtype.itemsize != length:
+        raise InterOpError("Unexpected record length {} of {}".format(length, fname))
+    return _memmap(fname, dtype, offset), qscores
+
+def _group_sums(lanes, reads, *weights):
+    """Sum the weights by lane and read
+
+    :returns: the lanes and reads of the groups, and the sums of each weight
+    """
+    keys = lanes.astype(np.int64) * 256 + reads
+    groups, inverse = np.unique(keys, return_inverse=True)
+    sums = [np.bincount(inverse, weights=w, minlength=len(groups)) for w in weights]
+    return groups // 256, groups % 256, sums
+
+class InterOpMetrics(object):
+    """The InterOp metrics of a run. The files are memory-mapped when first used.
+
+    :param path: the InterOp directory
+    :param reads: the Reads of RunInfo.xml, see RunInfoParser, mapping cycles to reads.
+    If None, all cycles belong to read 1
+    """
+    def __init__(self, path, reads=None):
+        self.path = path
+        self.reads = reads or []
+        self._arrays = {}
+
+    def _read(self, name, read_fn):
+        if name not in self._arrays:
+            fname = os.path.join(self.path, name)
+            self._arrays[name] = read_fn(fname) if os.path.exists(fname) else None
+        return self._arrays[name]
+
+    @property
+    def error_metrics(self):
+        return self._read(ERROR_METRICS, read_error_metrics)
+
+    @property
+    def quality_metrics(self):
+        return self._read(QUALITY_METRICS, read_quality_metrics)
+
+    @property
+    def tile_metrics(self):
+        return self._read(TILE_METRICS, read_tile_metrics)
+
+    @property
+    def extraction_metrics(self):
+        return self._read(EXTRACTION_METRICS, read_extraction_metrics)
+
+    def files(self):
+        """Return the metrics files present in the InterOp directory"""
+        return [os.path.join(self.path, f) for f in [ERROR_METRICS, QUALITY_METRICS, TILE_METRICS, EXTRACTION_METRICS]
+                if os.path.exists(os.path.join(self.path, f))]
+
+    def read_of_cycle(self, cycles):
+        """Map an array of cycles to the numbers of their reads"""
+        if len(self.reads) == 0:
+            return np.ones(len(cycles), dtype=int)
+        reads = sorted(self.reads, key=lambda r: int(r["Number"]))
+        numbers = np.repeat([int(r["Number"]) for r in reads], [int(r["NumCycles"]) for r in reads])
+        return numbers[np.clip(np.asarray(cycles, dtype=int) - 1, 0, len(numbers) - 1)]
+
+    def lane_summary(self):
+        """Aggregate the tile metrics by lane: the mean cluster densities of the tiles,
+        the total cluster counts and the percentage of clusters passing filter
+
+        :returns: a dict of metrics by lane
+        """
+        records = self.tile_metrics
+        if records is None or len(records) == 0:
+            return {}
+        lanes = records["lane"].astype(np.int64)
+        values = records["value"].astype(np.float64)
+        summary = {}
+        for name, code, mean in [("ClusterDensity", CLUSTER_DENSITY, True), ("ClusterDensityPF", CLUSTER_DENSITY_PF, True),
+                                 ("ClustersRaw", CLUSTER_COUNT, False), ("ClustersPF", CLUSTER_COUNT_PF, False)]:
+            mask = (records["code"] == code) & ~np.isnan(values)
+            total = np.bincount(lanes[mask], weights=values[mask])
+            count = np.bincount(lanes[mask])
+            for lane in np.nonzero(count)[0]:
+                summary.setdefault(str(lane), {})[name] = total[lane] / count[lane] if mean else total[lane]
+        for lane, data in summary.items():
+            if data.get("ClustersRaw"):
+                data["PercentPF"] = 100.0 * data.get("ClustersPF", 0) / data["ClustersRaw"]
+        return summary
+
+    def read_summary(self):
+        """Aggregate the error and quality metrics by lane and read: the mean PhiX error
+        rate over tiles and cycles, and the percentage of bases with quality >= 30
+
+        :returns: a dict of metrics by lane and read
+        """
+        summary = {}
+        records = self.error_metrics
+        if records is not None and len(records) > 0:
+            rates = records["error_rate"].astype(np.float64)
+            mask = ~np.isnan(rates)
+            lanes, reads, (total, count) = _group_sums(records["lane"][mask], self.read_of_cycle(records["cycle"][mask]),
+                                                       rates[mask], np.ones(mask.sum()))
+            for lane, read, t, c in zip(lanes, reads, total, count):
+                summary.setdefault(str(lane), {}).setdefault(str(read), {})["ErrorRate"] = t / c
+        quality = self.quality_metrics
+        if quality is not None and len(quality[0]) > 0:
+            records, qscores = quality
+            counts = records["counts"].astype(np.float64)
+            lanes, reads, (q30, total) = _group_sums(records["lane"], self.read_of_cycle(records["cycle"]),
+                                                     counts[:, qscores >= 30].sum(axis=1), counts.sum(axis=1))
+            for lane, read, q, t in zip(lanes, reads, q30, total):
+                if t > 0:
+                    summary.setdefault(str(lane), {}).setdefault(str(read), {})["PercentQ30"] = 100.0 * q / t
+        indexed = dict([(str(r["Number"]), r.get("IsIndexedRead", "N")) for r in self.reads])
+        for lane in summary.values():
+            for read, data in lane.items():
+                data["IsIndexedRead"] = indexed.get(read, "N")
+        return summary
+
+    def summary(self):
+        """Return the lane aggregates of lane_summary, with the read aggregates of
+        read_summary under Reads, as a json serialisable dict keyed by lane
+        """
+        summary = self.lane_summary()
+        for lane, reads in self.read_summary().items():
+            summary.setdefault(lane, {})["Reads"] = reads
+        def _float(d):
+            return dict([(k, _float(v) if isinstance(v, dict) else (float(v) if isinstance(v, (float, np.floating)) else v)) for k, v in d.items()])
+        return _float(summary)
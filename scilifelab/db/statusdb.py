@@ -433,7 +433,12 @@ class FlowcellRunMetricsConnection(Couch):
     def get_phix_error_rate(self, name, lane):
         """Get phix error rate. Returns -1 if error rate could not be determined"""
         fc = self.get_entry(name)
-        phix_r = []
+
+        # Use the error rates of the non-index reads aggregated from the InterOp per-cycle data, if available
+        reads = fc.get("illumina",{}).get("InterOp",{}).get(lane,{}).get("Reads",{})
+        phix_r = [read["ErrorRate"] for read in reads.values() if read.get("IsIndexedRead","N") != "Y" and read.get("ErrorRate",-1) > 0]
+        if len(phix_r) > 0:
+            return sum(phix_r)/len(phix_r)
 
         # Get the error rate for non-index reads and add them
         summary = fc.get("illumina",{}).get("Summary",{})
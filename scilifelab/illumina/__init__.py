@@ -3,15 +3,47 @@ A module for handling the files and directories from an illumina run
 """
 
 import os
+import csv
 import glob
+from functools import partial
 from scilifelab.illumina.index_definitions import BASIC_LOOKUP
 from scilifelab.utils.string import hamming_distance
+from scilifelab.utils.index_matcher import neighbours, BASES as INDEX_BASES
 from scilifelab.bcbio.flowcell import Flowcell
 from scilifelab.bcbio.qc import FlowcellRunMetricsParser
  
+# The largest number of mismatches for which map_index_name uses a precomputed
+# neighbourhood index, larger numbers of mismatches are matched by scanning all indexes
+MAX_INDEXED_MISMATCHES = 2
+
+# The neighbourhood indexes, by number of mismatches and index length, created when first used
+_INDEX_NEIGHBOURHOODS = {}
+
+def _index_neighbourhood(length, mismatch):
+    """Return a dict mapping each sequence of the given length within mismatch
+    substitutions of a known index to the names of those indexes, in the order
+    of BASIC_LOOKUP. Dual indexes are included with the separator removed.
+    """
+    key = (mismatch, length)
+    if key not in _INDEX_NEIGHBOURHOODS:
+        table = {}
+        for name, sequence in BASIC_LOOKUP.items():
+            sequence = sequence.replace('-','')
+            if len(sequence) != length:
+                continue
+            for seq, _ in neighbours(sequence, mismatch):
+                table.setdefault(seq, []).append(name)
+        _INDEX_NEIGHBOURHOODS[key] = table
+    return _INDEX_NEIGHBOURHOODS[key]
+
 def map_index_name(index, mismatch=0):
     """Map the index sequences to the known names, if possible. Requires the samplesheet module.
+
+    Up to MAX_INDEXED_MISMATCHES mismatches, the names are looked up in a precomputed 
+    neighbourhood of the known indexes of the same length as the index sequence.
     """
+    if mismatch <= MAX_INDEXED_MISMATCHES and not set(index).difference(INDEX_BASES):
+        return list(_index_neighbourhood(len(index), max(mismatch,0)).get(index, []))
     
     names = []
     for name, sequence in BASIC_LOOKUP.items():
@@ -143,6 +175,88 @@ class IlluminaRun(object):
         
         return reads
     
+    def count_unmatched_barcodes(self, lanes=range(1,9), nindex=25, mismatch=1, processes=None, error_rate=1e-5):
+        """Count the most common barcodes in the undetermined indexes reads of each lane 
+        specified and map them to the names of known indexes. The read files of all lanes
+        are counted together in a pool of processes. The barcodes are taken from the headers
+        of the first reads in the pairs.
+
+        :param lanes: the lanes to count
+        :param nindex: the number of barcodes to report per lane
+        :param mismatch: the number of mismatches allowed when mapping barcodes to index names
+        :param processes: the number of processes, defaults to the number of cpus
+        :param error_rate: the maximum error of the counts as a fraction of the reads, 
+        see scilifelab.utils.heavy_hitters.HeavyHitterCounter
+
+        :returns: a dict with the lanes as keys and lists of dicts with the keys lane, 
+        sequence, count and index_name, in order of decreasing count, as values
+        """
+        from scilifelab.utils.fastq_mapreduce import map_reduce, count_file_barcodes, merge_counter_dicts
+        from scilifelab.utils.heavy_hitters import HeavyHitterCounter
+        
+        lane_files = {}
+        for lane, files in zip(lanes, self.get_unmatched_reads(lanes)):
+            lane_files[lane] = sorted([f for f in files if "_R1_" in os.path.basename(f)])
+        
+        capacity = HeavyHitterCounter(error_rate=error_rate).capacity
+        counters = map_reduce(sum(lane_files.values(), []),
+                              partial(count_file_barcodes, capacity=capacity),
+                              merge_counter_dicts,
+                              {},
+                              processes)
+        
+        barcodes = {}
+        for lane, files in lane_files.items():
+            if len(files) == 0:
+                continue
+            counter = HeavyHitterCounter(capacity=capacity)
+            for f in files:
+                counter.update(counters.get(f, {}))
+            barcodes[lane] = [dict(lane=str(lane), sequence=bc, count=count, index_name=",".join(map_index_name(bc, mismatch))) 
+                              for bc, count in counter.most_common(nindex)]
+        return barcodes
+    
+    def write_undemultiplexed_stats(self, lanes=range(1,9), **kwargs):
+        """Count the most common barcodes in the undetermined indexes reads, see 
+        count_unmatched_barcodes, and write them to Undemultiplexed_stats.metrics in the
+        Basecall_Stats directory next to the Undetermined_indices directory of each lane
+        
+        :returns: a list of the written metrics files
+        """
+        barcodes = self.count_unmatched_barcodes(lanes, **kwargs)
+        
+        # Group the lanes by the directory holding their undetermined indexes reads
+        seq_dirs = {}
+        for lane, files in zip(lanes, self.get_unmatched_reads(lanes)):
+            if lane in barcodes:
+                seq_dir = os.path.dirname(os.path.dirname(os.path.dirname(files[0])))
+                seq_dirs.setdefault(seq_dir, []).append(lane)
+        
+        header = ['lane', 'sequence', 'count', 'index_name']
+        metrics_files = []
+        for seq_dir, seq_lanes in seq_dirs.items():
+            basecall_stats = glob.glob(os.path.join(seq_dir,"Basecall_Stats_*"))
+            if len(basecall_stats) == 0:
+                basecall_stats = [os.path.join(seq_dir,"Basecall_Stats_{}".format(self.get_flowcell_id()))]
+                os.mkdir(basecall_stats[0])
+            metrics_file = os.path.join(basecall_stats[0],"Undemultiplexed_stats.metrics")
+            with open(metrics_file,"w") as fh:
+                csvw = csv.DictWriter(fh, fieldnames=header, dialect=csv.excel_tab)
+                csvw.writeheader()
+                for lane in sorted(seq_lanes):
+                    csvw.writerows(barcodes[lane])
+            metrics_files.append(metrics_file)
+        
+        return metrics_files
+    
+    def get_flowcell_id(self):
+        """Return the flowcell id, without the position prefix, from the run info or else the run folder name
+        """
+        fcid = self.run_info.get('Flowcell')
+        if fcid:
+            return fcid
+        return os.path.basename(self._run_dir).split("_")[-1][1:]
+    
     def get_basecall_stats(self):
         """Return the path to the Basecall_stats_FCID directory
         """
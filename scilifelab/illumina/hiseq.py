@@ -4,6 +4,8 @@ import os
 import glob
 import csv
 import scilifelab.illumina as illumina
+from scilifelab.illumina.index_definitions import BASIC_LOOKUP
+from scilifelab.utils.index_matcher import index_collisions
 
 
 class HiSeqRun(illumina.IlluminaRun):
@@ -117,3 +119,28 @@ class HiSeqSampleSheet(list):
             else:
                 csvw.writerow(self.header)
             csvw.writerows([row.values() for row in self])
+
+    def index_collisions(self, max_mismatches=0):
+        """Check, for each lane, that the indexes of the samples can be told apart 
+        when allowing max_mismatches mismatches (per part for dual indexes). Indexes
+        given by their names in the index definitions are looked up. Samples without
+        an index are not checked.
+
+        :param max_mismatches: the maximum number of mismatches allowed
+
+        :returns: a dict with the lanes as keys and tuples with the minimum distance
+        between the indexes in the lane and a list of tuples (sample1, sample2, distance)
+        for the samples whose indexes collide as values
+        """
+        lanes = {}
+        for row in self:
+            index = BASIC_LOOKUP.get(row["Index"], row["Index"])
+            if len(index) == 0 or index == "NoIndex":
+                continue
+            lanes.setdefault(row["Lane"], []).append((row["SampleID"], index))
+        
+        collisions = {}
+        for lane, samples in lanes.items():
+            min_distance, pairs = index_collisions([index for _, index in samples], max_mismatches)
+            collisions[lane] = (min_distance, [(samples[i][0], samples[j][0], d) for i, j, d in pairs])
+        return collisions
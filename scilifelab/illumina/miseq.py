@@ -218,6 +218,12 @@ class MiSeqSampleSheet:
 
         return rows
     
+    def index_collisions(self, max_mismatches=0):
+        """Check that the indexes of the samples can be told apart when allowing
+        max_mismatches mismatches, see HiSeqSampleSheet.index_collisions
+        """
+        return HiSeqSampleSheet(self.to_hiseq()).index_collisions(max_mismatches)
+    
     def _extract_reference_from_path(self, path):
         """Attempts to extract a name of a reference assembly from a path
         """
@@ -0,0 +1,119 @@
+"""Picard metrics files.
+
+A metrics file has a METRICS section with a header line and one or more rows
+and, for some metrics, a HISTOGRAM section:
+
+    ## METRICS CLASS	net.sf.picard.analysis.InsertSizeMetrics
+    MEDIAN_INSERT_SIZE	MEDIAN_ABSOLUTE_DEVIATION	...
+    ...
+    ## HISTOGRAM	java.lang.Integer
+    insert_size	All_Reads.fr_count
+    ...
+
+The cells are kept as read, for json serialisable documents, and are converted
+to typed NumPy arrays one column at a time when needed.
+"""
+import numpy as np
+
+def column_array(values):
+    """Convert a column of cells to an array of integers, of floats, where a comma
+    is taken as the decimal mark, or of strings, whichever fits all cells
+    """
+    values = np.array(values, dtype=str)
+    for dtype in (np.int64, np.float64):
+        try:
+            return values.astype(dtype)
+        except ValueError:
+            pass
+    try:
+        return np.char.replace(values, ",", ".").astype(np.float64)
+    except ValueError:
+        return values
+
+class PicardMetrics(object):
+    """The command, metrics and histogram of a Picard metrics file"""
+    ## The prefixes of the comment line with the Picard command
+    command_prefixes = ("# net.sf.picard.analysis", "# net.sf.picard.sam")
+
+    def __init__(self):
+        self.command = None
+        self.metrics_header = []
+        self.metrics_rows = []
+        self.histogram_header = None
+        self.histogram_rows = []
+        self._columns = {}
+
+    def parse(self, fh):
+        """Parse the metrics file
+
+        :param fh: the file handle
+
+        :returns: self
+        """
+        section = None
+        for line in fh.read().split("\n"):
+            if line.startswith("#"):
+                if line.startswith("## METRICS"):
+                    section = self.metrics_rows
+                elif line.startswith("## HISTOGRAM"):
+                    section = self.histogram_rows
+                elif self.command is None and line.startswith(self.command_prefixes):
+                    self.command = line
+                continue
+            if section is None:
+                continue
+            if line.strip() == "":
+                section = None
+                continue
+            section.append(line.split("\t"))
+        if len(self.metrics_rows) > 0:
+            self.metrics_header = self.metrics_rows.pop(0)
+        if len(self.histogram_rows) > 0:
+            self.histogram_header = self.histogram_rows.pop(0)
+            self.histogram_rows = [row for row in self.histogram_rows if len(row) >= len(self.histogram_header)]
+        return self
+
+    def _typed_columns(self, key, header, rows):
+        if key not in self._columns:
+            columns = zip(*rows) if len(rows) > 0 else [[] for h in header]
+            self._columns[key] = dict([(h, column_array(c)) for h, c in zip(header, columns)])
+        return self._columns[key]
+
+    def metrics_columns(self):
+        """Return the metrics as typed arrays, by column"""
+        return self._typed_columns("metrics", self.metrics_header, [row[0:len(self.metrics_header)] for row in self.metrics_rows])
+
+    @property
+    def histogram(self):
+        """The histogram as typed arrays, by column, or None if there is no histogram"""
+        if self.histogram_header is None:
+            return None
+        return self._typed_columns("histogram", self.histogram_header, self.histogram_rows)
+
+    def records(self):
+        """Return the metrics rows as dicts of typed values"""
+        columns = self.metrics_columns()
+        return [dict([(h, columns[h][i].item()) for h in self.metrics_header]) for i in range(len(self.metrics_rows))]
+
+    def metrics_dicts(self):
+        """Return the metrics rows as dicts of the cells as read"""
+        return [dict(zip(self.metrics_header, row)) for row in self.metrics_rows]
+
+    def histogram_dict(self):
+        """Return the histogram as lists of the cells as read, by column, or None
+        if there is no histogram
+        """
+        if self.histogram_header is None:
+            return None
+        columns = zip(*self.histogram_rows) if len(self.histogram_rows) > 0 else [[] for h in self.histogram_header]
+        return dict([(h, list(c)) for h, c in zip(self.histogram_header, columns)])
+
+def read_picard_metrics(f):
+    """Read a Picard metrics file
+
+    :param f: the file name
+
+    :returns: a PicardMetrics
+    """
+    with open(f) as fh:
+        return PicardMetrics().parse(fh)
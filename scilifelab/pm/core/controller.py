@@ -23,6 +23,7 @@ class AbstractBaseController(controller.CementBaseController):
         self._meta.arguments.append((['--force'], dict(help="force execution", action="store_true", default=False)))
         self._meta.arguments.append((['--verbose'], dict(help="verbose mode", action="store_true", default=False)))
         self._meta.arguments.append((['--java_opts'], dict(help="java options", action="store", default="Xmx3g")))
+        self._meta.arguments.append((['--no_cache'], dict(help="parse all metrics files, without using the cache of parsed metrics", action="store_true", default=False)))
         super(AbstractBaseController, self)._setup(base_app)
         self.ignore = self.config.get("config", "ignore")
         self.shared_config = dict()
@@ -39,6 +40,9 @@ class AbstractBaseController(controller.CementBaseController):
         """
         self._add_arguments_to_parser()
         self._parse_args()
+        if getattr(self.pargs, "no_cache", False):
+            from scilifelab.bcbio.qc import MetricsCache
+            MetricsCache.configure(enabled=False)
         self._process_args()
 
         if not self.command:
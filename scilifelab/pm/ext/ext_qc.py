@@ -6,13 +6,14 @@ import ast
 import itertools
 import re
 import glob
+import multiprocessing
 from collections import defaultdict
 
 from cement.core import backend, controller, handler, hook
 from scilifelab.utils.misc import query_yes_no
 from scilifelab.pm.core.controller import AbstractBaseController
 from scilifelab.utils.timestamp import modified_within_days
-from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser
+from scilifelab.bcbio.qc import FlowcellRunMetricsParser, SampleRunMetricsParser, RunDirectoryIndex, MetricsManifest
 from scilifelab.pm.bcbio.utils import validate_fc_directory_format, fc_id, fc_parts, fc_fullname
 from scilifelab.db.statusdb import SampleRunMetricsConnection, FlowcellRunMetricsConnection, ProjectSummaryConnection, SampleRunMetricsDocument, FlowcellRunMetricsDocument, AnalysisConnection, AnalysisDocument
 from scilifelab.utils.dry import dry
@@ -20,6 +21,48 @@ import scilifelab.log
 
 LOG = scilifelab.log.minimal_logger(__name__)
 
+def collect_sample_run_metrics(path, sample_kw, index=None, demultiplex_stats=None, run_setup=None, manifest=None):
+    """Parse the run metrics of a sample in path into a SampleRunMetricsDocument
+
+    :param path: the directory holding the metrics files of the sample
+    :param sample_kw: the keyword arguments of the sample, passed to the document and the parser methods
+    :param index: a RunDirectoryIndex of path, shared with other parsers
+    :param demultiplex_stats: the parsed Demultiplex_Stats.htm, used for the bc_count if given
+    :param run_setup: the Reads of the RunInfo
+    :param manifest: a MetricsManifest with the results of earlier parses
+
+    :returns: the SampleRunMetricsDocument
+    """
+    parser = SampleRunMetricsParser(path, index, manifest)
+    obj = SampleRunMetricsDocument(**sample_kw)
+    obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
+    obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
+    obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, run_setup=run_setup, **sample_kw)
+    obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
+    obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
+    obj["software_versions"] = parser.parse_software_versions(**sample_kw)
+    return obj
+
+## The run directory indexes, manifest and flowcell level data shared by the sample workers of a pool
+_worker_args = {}
+
+def _init_sample_worker(indexes, demultiplex_stats, run_setup, manifest):
+    if manifest is not None:
+        manifest.pop_updates()
+    _worker_args.update(indexes=indexes, demultiplex_stats=demultiplex_stats, run_setup=run_setup, manifest=manifest)
+
+def _collect_sample_worker(args):
+    """Collect the sample run metrics in a worker, returning the document and the new
+    manifest entries, see MetricsManifest.pop_updates
+    """
+    path, sample_kw = args
+    indexes = _worker_args["indexes"]
+    manifest = _worker_args["manifest"]
+    if path not in indexes:
+        indexes[path] = RunDirectoryIndex(path)
+    obj = collect_sample_run_metrics(path, sample_kw, indexes[path], _worker_args["demultiplex_stats"], _worker_args["run_setup"], manifest)
+    return obj, manifest.pop_updates() if manifest is not None else None
+
 class RunMetricsController(AbstractBaseController):
     """
     This class is an implementation of the :ref:`ICommand
@@ -41,6 +84,8 @@ class RunMetricsController(AbstractBaseController):
             (['--names'], dict(help="Sample name mapping from barcode name to project name as a JSON string, as in \"{'sample_run_name':'project_run_name'}\". Mapping can also be given in a file", default=None, action="store", type=str)),
             (['--extensive_matching'], dict(help="Perform extensive barcode to project sample name matcing", default=False, action="store_true")),
             (['--project_alias'], dict(help="True project name as defined in project summary, as in 'J.Doe_00_01'.", default=None, action="store", type=str)),
+            (['--processes'], dict(help="Number of processes collecting the sample run metrics and parsing the RTA files in upload-qc. Defaults to 1.", default=1, action="store", type=int)),
+            (['--no_manifest'], dict(help="Parse all metrics files and push all documents in upload-qc, ignoring the manifest of earlier uploads", default=False, action="store_true")),
             ]
 
 
@@ -109,8 +154,50 @@ class RunMetricsController(AbstractBaseController):
     ##############################
     ## New structures
     ##############################
-    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None, setup=None):
-        """Parse samplesheet information and populate sample run metrics object"""
+    def _manifest_file(self):
+        """Return the manifest file of the flowcell, in the manifest directory set in
+        the runqc section of the configuration, or in ~/.pm/upload_qc
+        """
+        if self.app.config.has_option("runqc", "manifest"):
+            manifest_dir = self.app.config.get("runqc", "manifest")
+        else:
+            manifest_dir = os.path.join(os.path.expanduser("~"), ".pm", "upload_qc")
+        return os.path.join(manifest_dir, "{}.json".format(os.path.basename(os.path.abspath(self.pargs.flowcell))))
+
+    def _run_index(self, path):
+        """Return the index of the files in path, shared by all parsers of an upload"""
+        if path not in self._run_indexes:
+            self._run_indexes[path] = RunDirectoryIndex(path)
+        return self._run_indexes[path]
+
+    def _collect_samples(self, samples, demultiplex_stats=None, setup=None):
+        """Collect the sample run metrics documents of (path, sample_kw) samples, in the
+        given order. With more than one process, the documents are collected in a pool
+        of processes and yielded as they are done.
+        """
+        if self.pargs.processes <= 1:
+            for path, sample_kw in samples:
+                yield collect_sample_run_metrics(path, sample_kw, self._run_index(path), demultiplex_stats, setup, self._manifest)
+            return
+        # List the samples here, so that samplesheet warnings and errors are raised in this process
+        samples = list(samples)
+        pool = multiprocessing.Pool(self.pargs.processes, _init_sample_worker, (self._run_indexes, demultiplex_stats, setup, self._manifest))
+        try:
+            for obj, updates in pool.imap(_collect_sample_worker, samples):
+                if updates is not None:
+                    self._manifest.update(updates)
+                yield obj
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _parse_samplesheet(self, runinfo, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None, setup=None):
+        """Parse samplesheet information and yield the sample run metrics objects"""
+        samples = self._samplesheet_samples(runinfo, fc_date, fc_name, fcdir, as_yaml)
+        return self._collect_samples(samples, demultiplex_stats, setup)
+
+    def _samplesheet_samples(self, runinfo, fc_date, fc_name, fcdir, as_yaml=False):
+        """Yield the directory and keyword arguments of the samples in the samplesheet information"""
         if as_yaml:
             for info in runinfo:
                 if not info.get("multiplex"):
@@ -123,16 +210,7 @@ class RunMetricsController(AbstractBaseController):
                     sample.update({k: info.get(k, None) for k in ('analysis', 'description', 'flowcell_id', 'lane')})
                     sample_kw = dict(flowcell=fc_name, date=fc_date, lane=sample['lane'], barcode_name=sample['name'], sample_prj=sample.get('sample_prj', None),
                                      barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"))
-                
-                    parser = SampleRunMetricsParser(fcdir)
-                    obj = SampleRunMetricsDocument(**sample_kw)
-                    obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                    obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                    obj["bc_count"] = parser.get_bc_count(run_setup=setup, **sample_kw)
-                    obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                    obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
-                    obj["software_versions"] = parser.parse_software_versions(**sample_kw)
-                    qc_objects.append(obj)
+                    yield (fcdir, sample_kw)
         else:
             for d in runinfo:
                 LOG.debug("Getting information for sample defined by {}".format(d.values()))
@@ -161,19 +239,10 @@ class RunMetricsController(AbstractBaseController):
                     self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
                     runinfo_yaml['details'][0]['multiplex'] = [{'barcode_id': 0, 'sequence': 'NoIndex'}]
                 sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
-                parser = SampleRunMetricsParser(sample_fcdir)
-                obj = SampleRunMetricsDocument(**sample_kw)
-                obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, run_setup=setup, **sample_kw)
-                obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
-                obj["software_versions"] = parser.parse_software_versions(**sample_kw)
-                qc_objects.append(obj)
-        return qc_objects
+                yield (sample_fcdir, sample_kw)
 
     def _collect_pre_casava_qc(self):
-        qc_objects = []
+        """Yield the flowcell and sample run metrics objects of a pre-CASAVA flowcell"""
         as_yaml = False
         read_setup = None
         
@@ -181,10 +250,10 @@ class RunMetricsController(AbstractBaseController):
         
         ## Check modification time
         if not modified_within_days(fcdir, self.pargs.mtime):
-            return qc_objects
+            return
         
         # Get the fc_name, fc_date from RunInfo    
-        parser = FlowcellRunMetricsParser(fcdir)
+        parser = FlowcellRunMetricsParser(fcdir, self._run_index(fcdir), self._manifest)
         runinfo_xml = parser.parseRunInfo()
         runparams = parser.parseRunParameters()
         fc_date = runinfo_xml.get('Date',None)
@@ -211,26 +280,27 @@ class RunMetricsController(AbstractBaseController):
         fcobj = FlowcellRunMetricsDocument(**fc_kw)
         fcobj["RunInfo"] = runinfo_xml
         fcobj["RunParameters"] = runparams
-        fcobj["illumina"] = parser.parse_illumina_metrics(fullRTA=False, **fc_kw)
+        fcobj["illumina"] = parser.parse_illumina_metrics(fullRTA=False, processes=self.pargs.processes, **fc_kw)
+        fcobj["illumina"]["InterOp"] = parser.parse_interop_metrics(reads=runinfo_xml.get('Reads',[]), **fc_kw)
         fcobj["bc_metrics"] = parser.parse_bc_metrics(**fc_kw)
         fcobj["filter_metrics"] = parser.parse_filter_metrics(**fc_kw)
         fcobj["samplesheet_csv"] = runinfo
         fcobj["run_info_yaml"] = parser.parse_run_info_yaml(**fc_kw)
         read_setup = fcobj["RunInfo"].get('Reads',[])
         fcobj["run_setup"] = self._run_setup(read_setup)
-        qc_objects.append(fcobj)
-        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, as_yaml=as_yaml, setup=read_setup)
-        return qc_objects
+        yield fcobj
+        for obj in self._parse_samplesheet(runinfo, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, as_yaml=as_yaml, setup=read_setup):
+            yield obj
 
     def _collect_casava_qc(self):
-        qc_objects = []
+        """Yield the flowcell and sample run metrics objects of a CASAVA flowcell"""
         read_setup = None
         demux_stats = None
         
         fcdir = os.path.join(os.path.abspath(self._meta.root_path), self.pargs.flowcell)
         
         # Get the fc_name, fc_date from RunInfo    
-        parser = FlowcellRunMetricsParser(fcdir)
+        parser = FlowcellRunMetricsParser(fcdir, self._run_index(fcdir), self._manifest)
         runinfo_xml = parser.parseRunInfo()
         runparams = parser.parseRunParameters()
         fc_date = runinfo_xml.get('Date',None)
@@ -249,7 +319,8 @@ class RunMetricsController(AbstractBaseController):
             fcobj["RunInfo"] = runinfo_xml
             fcobj["RunParameters"] = runparams
             fcobj["DemultiplexConfig"] = parser.parseDemultiplexConfig(**fc_kw)
-            fcobj["illumina"] = parser.parse_illumina_metrics(fullRTA=False, **fc_kw)
+            fcobj["illumina"] = parser.parse_illumina_metrics(fullRTA=False, processes=self.pargs.processes, **fc_kw)
+            fcobj["illumina"]["InterOp"] = parser.parse_interop_metrics(reads=runinfo_xml.get('Reads',[]), **fc_kw)
             fcobj["bc_metrics"] = parser.parse_bc_metrics(**fc_kw)
             fcobj["undemultiplexed_barcodes"] = parser.parse_undemultiplexed_barcode_metrics(**fc_kw)
             fcobj["illumina"].update({"Demultiplex_Stats" : parser.parse_demultiplex_stats_htm(**fc_kw)})
@@ -257,9 +328,9 @@ class RunMetricsController(AbstractBaseController):
             read_setup = fcobj["RunInfo"].get('Reads',[])
             fcobj["run_setup"] = self._run_setup(read_setup)
             demux_stats = fcobj["illumina"]["Demultiplex_Stats"]
-            qc_objects.append(fcobj)
-        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, demultiplex_stats=demux_stats, setup=read_setup)
-        return qc_objects
+            yield fcobj
+        for obj in self._parse_samplesheet(runinfo, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, demultiplex_stats=demux_stats, setup=read_setup):
+            yield obj
 
     def _run_setup(self, reads):
         """Return a string representing the run setup"""
@@ -379,6 +450,19 @@ class RunMetricsController(AbstractBaseController):
         runinfo_csv = os.path.join(os.path.abspath(self.pargs.flowcell), "{}.csv".format(fc_id(self.pargs.flowcell)))
         runinfo_yaml = os.path.join(os.path.abspath(self.pargs.flowcell), "run_info.yaml")
         (fc_date, fc_name) = fc_parts(self.pargs.flowcell)
+        # The run directories are walked once, and their files shared by all parsers
+        self._run_indexes = {}
+        # Unchanged files are not parsed, and unchanged documents not pushed, again
+        self._manifest = None
+        if not self.pargs.no_manifest:
+            self._manifest = MetricsManifest(self._manifest_file(), log=self.app.log)
+        try:
+            self._upload_qc(fc_date)
+        finally:
+            if self._manifest is not None:
+                self._manifest.save()
+
+    def _upload_qc(self, fc_date):
         if int(fc_date) < 120815:
             self.log.info("Assuming pre-casava based file structure for {}".format(fc_id(self.pargs.flowcell)))
             qc_objects = self._collect_pre_casava_qc()
@@ -386,25 +470,36 @@ class RunMetricsController(AbstractBaseController):
             self.log.info("Assuming casava based file structure for {}".format(fc_id(self.pargs.flowcell)))
             qc_objects = self._collect_casava_qc()
 
-        if len(qc_objects) == 0:
+        # The objects are saved as they are collected
+        first = next(qc_objects, None)
+        if first is None:
             self.log.info("No out-of-date qc objects for {}".format(fc_id(self.pargs.flowcell)))
             return
-        else:
-            self.log.info("Retrieved {} updated qc objects".format(len(qc_objects)))
 
         s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
         fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
         p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
-        for obj in qc_objects:
+        n_objects = 0
+        n_unchanged = 0
+        for obj in itertools.chain([first], qc_objects):
+            n_objects += 1
             if self.app.pargs.debug:
                 self.log.debug("{}: {}".format(str(obj), obj["_id"]))
-            if isinstance(obj, FlowcellRunMetricsDocument):
-                dry("Saving object {}".format(repr(obj)), fc_con.save(obj))
             if isinstance(obj, SampleRunMetricsDocument):
                 project_sample = p_con.get_project_sample(obj.get("sample_prj", None), obj.get("barcode_name", None), self.pargs.extensive_matching)
                 if project_sample:
                     obj["project_sample_name"] = project_sample['sample_name']
+            if self._manifest is not None and not self._manifest.changed(obj):
+                self.log.debug("Object {} unchanged since the last upload; not saving".format(repr(obj)))
+                n_unchanged += 1
+                continue
+            if isinstance(obj, FlowcellRunMetricsDocument):
+                dry("Saving object {}".format(repr(obj)), fc_con.save(obj))
+            if isinstance(obj, SampleRunMetricsDocument):
                 dry("Saving object {}".format(repr(obj)), s_con.save(obj))
+            if self._manifest is not None:
+                self._manifest.pushed(obj)
+        self.log.info("Retrieved {} updated qc objects, {} of which unchanged since the last upload".format(n_objects, n_unchanged))
 
     @controller.expose(help="Perform a multiplex QC")
     def multiplex_qc(self):
@@ -0,0 +1,249 @@
+"""Map-reduce processing of FastQ files over a pool of processes.
+
+The input files are split into record-aligned chunks. Each chunk is passed to a
+map function in a worker process and the per-chunk results are merged, in input
+order, with a reduce function, so the result is the same as for a serial run:
+
+    def count_reads(chunk):
+        return sum([len(batch[0][0]) for batch in chunk.batches()])
+
+    total = map_reduce(["sample_R1.fastq.gz"], count_reads, operator.add, processes=8)
+
+The map function must be picklable, i.e. defined at the top level of a module.
+"""
+import collections
+import itertools
+import multiprocessing
+import numpy as np
+from cStringIO import StringIO
+from scilifelab.utils.fastq_utils import FastQParser, FastQIndex, lockstep_batches, open_fastq
+from scilifelab.utils.gzip_utils import is_bgzf
+from scilifelab.utils.heavy_hitters import HeavyHitterCounter
+from scilifelab.utils.packed_barcodes import BarcodeCounter
+
+class FastQChunk:
+    """A chunk of records from one or more paired fastq files. The chunk either
+       refers to a range of records in the files, which is read by the worker
+       process, or holds the raw data of the records, read by the main process
+       and parsed by the worker process.
+    """
+
+    def __init__(self, number, fastq_files, start=0, max_records=None, data=None, parser_args={}):
+        self.number = number
+        self.fastq_files = fastq_files
+        self.start = start
+        self.max_records = max_records
+        self._data = data
+        self._parser_args = parser_args
+
+    def batches(self):
+        """Iterate over the records in the chunk, yielding a list with one batch
+           (see FastQParser.batches) per input file. The batches for paired files
+           hold the same records
+        """
+        return self._read_batches()
+
+    def _read_batches(self):
+        if self._data is not None:
+            parsers = [FastQParser(f, fileobj=StringIO(d), **self._parser_args) for f, d in zip(self.fastq_files, self._data)]
+        else:
+            parsers = [FastQParser(f, start=self.start, max_records=self.max_records, **self._parser_args) for f in self.fastq_files]
+        try:
+            for batches in lockstep_batches(parsers):
+                yield batches
+        finally:
+            # Close the parsers, stopping any decompressor process, also when the chunk is not read to the end
+            for parser in parsers:
+                parser.close()
+
+def _random_access(fastq_file, index):
+    """Return True if records deep into the file can be reached without decompressing
+    the preceding data, i.e. the file is uncompressed or has several gzip members
+    """
+    return not fastq_file.endswith(".gz") or is_bgzf(fastq_file) or len(set([c[1] for c in index.checkpoints])) > 1
+
+def _raw_chunks(fastq_file, chunk_records, decompressor="auto", threads=None, block_size=FastQParser.BLOCK_SIZE, **kw):
+    """Read a fastq file in blocks and yield the raw data of chunk_records records at a time,
+    split after every 4*chunk_records:th line. The records are not parsed, any trailing
+    blank lines are left to the parser
+    """
+    fh = open_fastq(fastq_file, decompressor, threads)
+    try:
+        pending = []
+        lines = 0
+        for data in iter(lambda: fh.read(block_size), ""):
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+            start = 0
+            i = 4*chunk_records - lines - 1
+            while i < len(newlines):
+                end = int(newlines[i]) + 1
+                pending.append(data[start:end])
+                yield "".join(pending)
+                pending = []
+                start = end
+                i += 4*chunk_records
+            pending.append(data[start:])
+            lines = (lines + len(newlines)) % (4*chunk_records)
+        tail = "".join(pending)
+        if len(tail.strip()) > 0:
+            yield tail
+    finally:
+        fh.close()
+
+def split_chunks(fastq_files, chunk_records, number=0, build_index=False, parser_args={}):
+    """Split (paired) fastq files into chunks of chunk_records records. If all files have
+       an up-to-date index (see FastQIndex) and can be accessed randomly, the chunks refer
+       to record ranges that are read by the workers. Otherwise, e.g. for single-member gzip
+       files, the files are decompressed here and the raw data of the records is passed on
+       to the workers in the chunks, so that the records are parsed by the workers. Files
+       without records give a single empty chunk, so that the map function is applied at
+       least once.
+
+       :param fastq_files: list of paired fastq files, or a single file
+       :param chunk_records: the number of records in each chunk
+       :param number: the number of the first chunk
+       :param build_index: build and save the index for files that lack an up-to-date index
+       :param parser_args: additional keyword arguments to FastQParser
+    """
+    if isinstance(fastq_files, basestring):
+        fastq_files = [fastq_files]
+    indexes = [FastQIndex.find(f) for f in fastq_files]
+    if build_index:
+        for i, f in enumerate(fastq_files):
+            if indexes[i] is None:
+                indexes[i] = FastQIndex.build(f, min(chunk_records, FastQIndex.INTERVAL))
+                try:
+                    indexes[i].save()
+                except IOError:
+                    pass
+
+    if None not in indexes and all([_random_access(f, ix) for f, ix in zip(fastq_files, indexes)]):
+        for start in xrange(0, indexes[0].records, chunk_records):
+            yield FastQChunk(number, fastq_files, start, chunk_records, parser_args=parser_args)
+            number += 1
+        if indexes[0].records == 0:
+            yield FastQChunk(number, fastq_files, data=["" for f in fastq_files])
+        return
+
+    first = number
+    for data in itertools.izip_longest(*[_raw_chunks(f, chunk_records, **parser_args) for f in fastq_files]):
+        if None in data:
+            raise ValueError("The paired files {} contain different numbers of records".format(", ".join(fastq_files)))
+        yield FastQChunk(number, fastq_files, data=list(data), parser_args=parser_args)
+        number += 1
+    if number == first:
+        yield FastQChunk(number, fastq_files, data=["" for f in fastq_files])
+
+def _map_chunk(args):
+    map_fn, chunk = args
+    return map_fn(chunk)
+
+def map_reduce(inputs, map_fn, reduce_fn, initial=None, processes=None, chunk_records=FastQIndex.INTERVAL,
+               build_index=False, **parser_args):
+    """Apply map_fn to each chunk of the inputs in a pool of processes and merge the
+       results with reduce_fn, in the order of the chunks in the inputs.
+
+       :param inputs: list of fastq files, where paired files are given as lists or tuples
+       :param map_fn: function taking a FastQChunk and returning a result
+       :param reduce_fn: function taking two results and returning the merged result
+       :param initial: the initial value for the reduction. If None, the result of the first
+       chunk is used, and None is returned if there are no inputs
+       :param processes: the number of worker processes, defaults to the number of cpus.
+       With a single process, the chunks are processed serially in this process
+       :param chunk_records: the number of records in each chunk
+       :param build_index: build and save the index for files that lack an up-to-date index
+       :param parser_args: additional keyword arguments to FastQParser, e.g. decompressor.
+       The decompression threads default to the number of cpus divided by processes
+
+       :returns: the reduced result
+    """
+    if isinstance(inputs, basestring):
+        inputs = [inputs]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # Share the cpus between the workers, rather than each worker decompressing with all cpus
+    parser_args.setdefault("threads", max(1, multiprocessing.cpu_count() // processes))
+
+    def _chunks():
+        number = 0
+        for fastq_files in inputs:
+            for chunk in split_chunks(fastq_files, chunk_records, number, build_index, parser_args):
+                number = chunk.number + 1
+                yield chunk
+
+    if processes == 1:
+        results = itertools.imap(map_fn, _chunks())
+    else:
+        results = _pool_map(map_fn, _chunks(), processes)
+
+    if initial is None:
+        try:
+            initial = results.next()
+        except StopIteration:
+            return None
+    return reduce(reduce_fn, results, initial)
+
+def _pool_map(map_fn, chunks, processes):
+    """Map the chunks in a pool of processes, keeping a bounded number of chunks in flight
+    and yielding the results in order
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_map_chunk, ((map_fn, chunk),)))
+            if len(pending) > 2*processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def count_barcodes(chunk, casava18=True, offset=101, length=6, capacity=None):
+    """Map function counting the barcodes in a chunk, extracted as by 
+    scilifelab.utils.fastq_utils.BarcodeExtractor. For paired files, the
+    barcodes of the reads in a pair are concatenated. Merge the resulting 
+    counters with merge_counters.
+
+    The barcodes in the chunk are counted in bulk, packed into integers, see
+    scilifelab.utils.packed_barcodes.BarcodeCounter. If capacity is given, at most 
+    capacity barcodes are returned, with approximate counts, see 
+    scilifelab.utils.heavy_hitters.HeavyHitterCounter
+    """
+    packed = BarcodeCounter()
+    for batches in chunk.batches():
+        if casava18:
+            barcodes = [[h.rsplit(":",1)[-1] for h in batch[0]] for batch in batches]
+        else:
+            barcodes = [[s[offset:offset+length] for s in batch[1]] for batch in batches]
+        if len(barcodes) == 1:
+            packed.add(barcodes[0])
+        else:
+            packed.add(map("".join, itertools.izip(*barcodes)))
+    return HeavyHitterCounter(packed.counter(), capacity=capacity)
+
+def merge_counters(c1, c2):
+    """Reduce function adding the counts in c2 to c1
+    """
+    c1.update(c2)
+    return c1
+
+def count_file_barcodes(chunk, **kwargs):
+    """Map function counting the barcodes in a chunk as count_barcodes, returning
+    a dict with the counter keyed by the (first) fastq file of the chunk, so that
+    the counts of several files can be kept apart. Merge the resulting dicts with
+    merge_counter_dicts
+    """
+    return {chunk.fastq_files[0]: count_barcodes(chunk, **kwargs)}
+
+def merge_counter_dicts(d1, d2):
+    """Reduce function adding the counters in d2 to the counters with the same key in d1
+    """
+    for key, counter in d2.items():
+        if key in d1:
+            d1[key].update(counter)
+        else:
+            d1[key] = counter
+    return d1
@@ -1,79 +1,360 @@
 """Utilities for handling FastQ data"""
-import gzip
+import bisect
+import collections
+import csv
+import itertools
+import multiprocessing
 import os
 import re
+import numpy as np
 from scilifelab.illumina.hiseq import HiSeqRun
+from scilifelab.utils.gzip_utils import open_gzip, open_gzip_writer, inflate_members, BGZF_BLOCK_SIZE
+from scilifelab.utils.index_matcher import IndexMatcher
+from scilifelab.utils.quality_stats import read_quality
+
+def open_fastq(fname, decompressor="auto", threads=None, offset=0):
+    """Open a fastq file for reading, starting at the byte offset. If the file name ends
+    with .gz, the file is decompressed with the specified backend, see 
+    scilifelab.utils.gzip_utils.open_gzip, and the offset must be the start of a gzip member
+    """
+    if fname.endswith(".gz"):
+        return open_gzip(fname, decompressor, threads, offset)
+    fh = open(fname,"rb")
+    fh.seek(offset)
+    return fh
          
 class FastQParser:
     """Parser for fastq files, possibly compressed with gzip. 
        Iterates over one record at a time. A record consists 
        of a list with 4 elements corresponding to 1) Header, 
-       2) Nucleotide sequence, 3) Optional header, 4) Qualities"""
+       2) Nucleotide sequence, 3) Optional header, 4) Qualities.
+       
+       For bulk processing, use the batches method, which reads
+       the input in large blocks and yields the records in batches.
+       
+       The decompressor and threads arguments select the backend used
+       for decompressing gzipped input, see open_fastq.
+       
+       Parsing can start at the record number start, using the checkpoints 
+       in a FastQIndex to avoid reading the preceding records, or at an offset 
+       as stored in the index, and can be limited to max_records records.
+       
+       If fileobj is given, the records are read from it rather than from
+       the file, which is then only used as the name of the input"""
     
-    def __init__(self,file,filter=None):
+    # Number of bytes read from the input at a time
+    BLOCK_SIZE = 4*1024*1024
+    # Default number of records in a batch
+    BATCH_SIZE = 10000
+    
+    def __init__(self,file,filter=None,block_size=BLOCK_SIZE,decompressor="auto",threads=None,
+                 start=0,max_records=None,offset=None,index=None,fileobj=None):
         self.fname = file
         self.filter = filter
-        fh = open(file,"rb")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
+        self.block_size = block_size
+        self.max_records = max_records
+        
+        # Locate the closest checkpoint preceding the start record, the remaining records are skipped
+        self._skip = 0
+        if offset is None and start > 0:
+            if index is None:
+                index = FastQIndex.find(file)
+            if index is None:
+                offset = (0, 0)
+                self._skip = start
+            else:
+                record, coffset, uoffset = index.checkpoint(start)
+                offset = (coffset, uoffset)
+                self._skip = start - record
+        if offset is None:
+            offset = (0, 0)
+        elif not isinstance(offset, tuple):
+            offset = (offset, 0)
+            
+        if fileobj is not None:
+            self._fh = fileobj
         else:
-            self._fh = fh
+            self._fh = open_fastq(file,decompressor,threads,offset[0])
+        self._discard(offset[1])
         self._records_read = 0
-        self._next = self.setup_next()
+        self._filter = None
+        self._reset()
         
     def __iter__(self):
         return self
     
     def next(self):
-        return self._next(self)
-
-    def setup_next(self):
-        """Return the function to return the next record
+        try:
+            record = self._records.next()
+        except StopIteration:
+            # Fetch the next batch, this will raise StopIteration when the input is exhausted
+            if self._batch_iter is None:
+                self._batch_iter = self._batches(self.BATCH_SIZE)
+            self._records = itertools.imap(list,itertools.izip(*self._batch_iter.next()))
+            record = self._records.next()
+        self._records_read += 1
+        return record
+    
+    def batches(self,size=BATCH_SIZE):
+        """Iterate over the remaining records in batches of (at most) size records.
+           A batch is a list with 4 elements, each a list of 1) Headers, 
+           2) Nucleotide sequences, 3) Optional headers, 4) Qualities, so 
+           that e.g. the sequence of the i:th record in a batch is batch[1][i]
+           
+           The records buffered by next are yielded first, so next and batches
+           can be mixed on the same parser
+        """
+        if self._batch_iter is None:
+            self._batch_iter = self._batches(size)
+        while True:
+            records = list(itertools.islice(self._records,size))
+            if len(records) > 0:
+                batch = [list(field) for field in itertools.izip(*records)]
+            else:
+                try:
+                    batch = self._batch_iter.next()
+                except StopIteration:
+                    return
+                if len(batch[0]) > size:
+                    # Buffer the larger batches read for next, and split them
+                    self._records = itertools.imap(list,itertools.izip(*batch))
+                    continue
+            self._records_read += len(batch[0])
+            yield batch
+            
+    def _lines(self):
+        """Read the input in blocks and yield the complete lines in each block. 
+        Any partial line at the end of a block is carried over to the next block.
+        """
+        while True:
+            block = self._fh.read(self.block_size)
+            if not block:
+                break
+            lines = (self._tail + block).split("\n")
+            self._tail = lines.pop()
+            yield lines
+        if self._tail:
+            yield [self._tail]
+            self._tail = ""
+    
+    def _batches(self, size):
+        """Split the lines read on record boundaries into batches of size records,
+        skipping any records before the start and stopping after max_records records.
+        Any partial batch at the end of a block is carried over to the next block.
+        """
+        step = 4*size
+        skip = 4*self._skip
+        left = None
+        if self.max_records is not None:
+            left = 4*self.max_records
+        pending = []
+        for lines in self._lines():
+            if skip > 0:
+                n = min(skip,len(lines))
+                lines = lines[n:]
+                skip -= n
+            if left is not None:
+                lines = lines[0:left]
+                left -= len(lines)
+            if pending:
+                lines = pending + lines
+            stop = len(lines) - len(lines) % step
+            for i in xrange(0,stop,step):
+                batch = self._batch(lines[i:i+step])
+                if len(batch[0]) > 0:
+                    yield batch
+            pending = lines[stop:]
+            if left == 0:
+                break
+        
+        # Flush the remaining lines, disregarding any trailing empty lines or incomplete record
+        while len(pending) > 0 and len(pending[-1].strip()) == 0:
+            pending.pop()
+        pending = pending[0:len(pending) - len(pending) % 4]
+        if len(pending) > 0:
+            batch = self._batch(pending)
+            if len(batch[0]) > 0:
+                yield batch
+        
+    def _batch(self, lines):
+        """Create a batch from a list of lines, applying the filter if specified
         """
+        batch = [map(str.strip,lines[n::4]) for n in range(4)]
         if self.filter is None or len(self.filter.keys()) == 0:
-            def _next(self):
-                self._records_read += 1
-                return [self._fh.next().strip() for n in range(4)]
-        else:
-            def _next(self):
-                while True:
-                    record = [self._fh.next().strip() for n in range(4)]
-                    header = parse_header(record[0])
-                    skip = False
-                    for k, v in self.filter.items():
-                        if k in header and header[k] not in v:
-                            skip = True
-                            break
-                    if not skip:
-                        self._records_read += 1
-                        return record 
-        return _next
+            return batch
+        if self._filter is None:
+            # The header format is determined from the first record
+            self._filter = compile_header_filter(self.filter,batch[0][0])
+        keep = self._filter(batch[0])
+        return [list(itertools.compress(field,keep)) for field in batch]
     
+    def _discard(self, nbytes):
+        """Read and discard nbytes of the input
+        """
+        while nbytes > 0:
+            data = self._fh.read(min(nbytes,self.block_size))
+            if not data:
+                break
+            nbytes -= len(data)
+    
+    def _reset(self):
+        """Discard any buffered data
+        """
+        self._tail = ""
+        self._records = iter([])
+        # The batches are read by next and batches alike, created when first used
+        self._batch_iter = None
+        
     def name(self):
         return self.fname
     
     def rread(self):
         return self._records_read
 
-    def seek(self,offset,whence=None):
+    def seek(self,offset,whence=0):
         self._fh.seek(offset,whence)
+        self._skip = 0
+        self._reset()
         
     def close(self):
         self._fh.close()
 
+class FastQIndex:
+    """An index of a fastq file, holding checkpoints for every interval:th record.
+       A checkpoint is a tuple (record number, offset, skip) where offset is the
+       position in the file to start reading at and skip is the number of 
+       (decompressed) bytes to discard before the record starts. 
+       
+       For uncompressed files, offset is the byte offset of the record. For gzip 
+       files, offset is the start of the gzip member holding the record, so BGZF 
+       files, as written by FastQWriter with compressor="threaded", and other 
+       multi-member files can be accessed randomly. A single-member gzip file
+       only has one member, so starting at a checkpoint still requires 
+       decompressing the preceding data, but not parsing it.
+       
+       The index is stored in a sidecar file, with the SUFFIX appended to the 
+       fastq file name, together with the size and modification time of the 
+       fastq file so that stale indexes can be detected."""
+    
+    SUFFIX = ".fqi"
+    INTERVAL = 100000
+    
+    def __init__(self, fname, interval, checkpoints, records):
+        self.fname = fname
+        self.interval = interval
+        self.checkpoints = checkpoints
+        self.records = records
+        
+    @classmethod
+    def build(cls, fname, interval=INTERVAL):
+        """Build the index for a fastq file by reading through it once
+        """
+        gzipped = fname.endswith(".gz")
+        if gzipped:
+            chunks = inflate_members(fname)
+        else:
+            chunks = _read_chunks(fname)
+        
+        checkpoints = [(0, 0, 0)]
+        # The number of newlines seen so far and the index of the newline preceding the next checkpoint
+        seen = 0
+        target = 4*interval - 1
+        member = 0
+        pos = 0
+        last = "\n"
+        for offset, data in chunks:
+            if offset != member:
+                member = offset
+                pos = 0
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+            while target < seen + len(newlines):
+                start = pos + int(newlines[target - seen]) + 1
+                record = (target + 1)/4
+                if gzipped:
+                    checkpoints.append((record, member, start))
+                else:
+                    checkpoints.append((record, member + start, 0))
+                target += 4*interval
+            seen += len(newlines)
+            pos += len(data)
+            last = data[-1]
+        
+        lines = seen
+        if last != "\n":
+            lines += 1
+        records = lines/4
+        return cls(fname, interval, [c for c in checkpoints if c[0] < records or c[0] == 0], records)
+    
+    @classmethod
+    def load(cls, fname, index_file=None):
+        """Load the index for a fastq file from the sidecar file. Raises ValueError
+        if the index does not match the current size and modification time of the file
+        """
+        if index_file is None:
+            index_file = "{}{}".format(fname, cls.SUFFIX)
+        with open(index_file) as fh:
+            rows = [row for row in csv.reader(fh, dialect=csv.excel_tab)]
+        _, interval, records, size, mtime = rows[0]
+        if [size, mtime] != cls._stat(fname):
+            raise ValueError("The index {} is out of date for {}".format(index_file, fname))
+        return cls(fname, int(interval), [tuple([int(c) for c in row]) for row in rows[2:]], int(records))
+    
+    @classmethod
+    def find(cls, fname):
+        """Return the index for a fastq file if an up-to-date sidecar file exists, otherwise None
+        """
+        try:
+            return cls.load(fname)
+        except (IOError, ValueError):
+            return None
+        
+    def save(self, index_file=None):
+        if index_file is None:
+            index_file = "{}{}".format(self.fname, self.SUFFIX)
+        with open(index_file, "w") as fh:
+            cw = csv.writer(fh, dialect=csv.excel_tab)
+            cw.writerow(["#FastQIndex", self.interval, self.records] + self._stat(self.fname))
+            cw.writerow(["record", "offset", "skip"])
+            cw.writerows(self.checkpoints)
+        return index_file
+    
+    def checkpoint(self, record):
+        """Return the last checkpoint at or before the record number
+        """
+        i = bisect.bisect_right([c[0] for c in self.checkpoints], record) - 1
+        return self.checkpoints[max(0, i)]
+    
+    @staticmethod
+    def _stat(fname):
+        st = os.stat(fname)
+        return [str(st.st_size), str(int(st.st_mtime))]
+
+def _read_chunks(fname, chunk_size=FastQParser.BLOCK_SIZE):
+    """Read an uncompressed file in chunks, yielding tuples (offset, data) where offset
+    is the position of the chunk in the file
+    """
+    with open(fname, "rb") as fh:
+        pos = 0
+        for data in iter(lambda: fh.read(chunk_size), ""):
+            yield pos, data
+            pos += len(data)
+
 class FastQWriter:
     """Writes fastq records, where each record is a list with 4 elements
        corresponding to 1) Header, 2) Nucleotide sequence, 3) Optional header, 
        4) Qualities. If the supplied filename ends with .gz, the output file 
-       will be compressed with gzip"""
+       will be compressed with gzip. 
+       
+       With compressor="threaded", the records are buffered in memory and 
+       compressed in independent blocks of block_size bytes on a pool of 
+       threads, see scilifelab.utils.gzip_utils.ThreadedGzipWriter"""
        
-    def __init__(self,file):
+    def __init__(self,file,compressor="gzip",compresslevel=9,block_size=BGZF_BLOCK_SIZE,threads=None):
         self.fname = file
-        fh = open(file,"wb")
         if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
+            self._fh = open_gzip_writer(file,compressor,compresslevel,block_size,threads)
         else:    
-            self._fh = fh
+            self._fh = open(file,"wb")
         self._records_written = 0
         
     def name(self):
@@ -89,17 +370,93 @@ class FastQWriter:
     def close(self):
         self._fh.close()
 
+class FastQWriterPool:
+    """Writes fastq records to a large number of files while keeping at most max_open
+       files open. The records for each file are buffered in memory and appended to
+       the file when the buffer exceeds buffer_size bytes. If max_open files are already
+       open, the least recently written file is closed first. Closed files are reopened
+       in append mode, so that a compressed file will consist of several gzip members.
+
+       The memory used for buffering is at most buffer_size bytes per output file.
+    """
+
+    MAX_OPEN = 128
+    BUFFER_SIZE = 64*1024
+
+    def __init__(self,max_open=MAX_OPEN,buffer_size=BUFFER_SIZE,compressor="gzip",compresslevel=9,threads=None):
+        if max_open < 1:
+            raise ValueError("The pool must be allowed to keep at least one file open")
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.compressor = compressor
+        self.compresslevel = compresslevel
+        self.threads = threads
+        # The open file handles, ordered from least to most recently written
+        self._open = collections.OrderedDict()
+        self._buffers = {}
+        self._buffered = {}
+        self._records_written = {}
+        # The files that have been opened, and will be appended to if reopened
+        self._opened = set()
+
+    def names(self):
+        """Return the names of the files that records have been written to
+        """
+        return self._records_written.keys()
+
+    def write(self,fname,record):
+        buf = self._buffers.get(fname)
+        if buf is None:
+            buf = self._buffers[fname] = []
+            self._buffered[fname] = 0
+            self._records_written[fname] = 0
+        data = "{}\n".format("\n".join([r.strip() for r in record]))
+        buf.append(data)
+        self._buffered[fname] += len(data)
+        self._records_written[fname] += 1
+        if self._buffered[fname] >= self.buffer_size:
+            self._flush(fname)
+
+    def rwritten(self,fname):
+        return self._records_written.get(fname,0)
+
+    def _flush(self,fname):
+        """Write the buffered data for a file, opening the file if necessary
+        """
+        fh = self._open.pop(fname,None)
+        if fh is None:
+            if len(self._open) >= self.max_open:
+                _, lru = self._open.popitem(last=False)
+                lru.close()
+            # The file is truncated the first time it is opened
+            mode = "ab" if fname in self._opened else "wb"
+            if fname.endswith(".gz"):
+                fh = open_gzip_writer(fname,self.compressor,self.compresslevel,threads=self.threads,mode=mode)
+            else:
+                fh = open(fname,mode)
+            self._opened.add(fname)
+        self._open[fname] = fh
+        fh.write("".join(self._buffers[fname]))
+        self._buffers[fname] = []
+        self._buffered[fname] = 0
+
+    def close(self):
+        """Write all buffered records and close all files
+        """
+        for fname, buffered in self._buffered.items():
+            if buffered > 0 or fname not in self._opened:
+                self._flush(fname)
+        for fh in self._open.values():
+            fh.close()
+        self._open.clear()
+
 class BarcodeExtractor():
     """Parse a FastQ-file and extract the barcode assumed to be at the 
        given offset and of specified length
     """
     
-    def __init__(self,  fqfile, casava18=True, offset=101, length=6):
-        fh = open(fqfile)
-        if os.path.splitext(fqfile)[1] == ".gz":
-            self.fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self.fh = fh
+    def __init__(self,  fqfile, casava18=True, offset=101, length=6, decompressor="auto", threads=None):
+        self.fh = open_fastq(fqfile, decompressor, threads)
         self.start = offset
         self.end = offset+length
         self.casava18 = casava18
@@ -125,19 +482,18 @@ class BarcodeExtractor():
 
 
 def avgQ(record,offset=33):
-    qual = record[3].strip()
-    l = len(qual)
-    s = sum([ord(c) for c in qual])
-    return round(float(s - l*offset)/l,1)
+    """Return the average quality of a record, see scilifelab.utils.quality_stats
+    for processing batches of records
+    """
+    mean, _ = read_quality([record[3].strip()],offset)
+    return round(float(mean[0]),1)
     
 def gtQ30(record,offset=33):
-    qual = record[3].strip()
-    cutoff = 30 + offset
-    g = 0
-    for c in qual:
-        if ord(c) >= cutoff:
-            g += 1
-    return round(100*float(g)/len(qual),1)
+    """Return the percentage of bases in a record with a quality of at least 30,
+    see scilifelab.utils.quality_stats for processing batches of records
+    """
+    _, pct = read_quality([record[3].strip()],offset,30)
+    return round(float(pct[0]),1)
 
 def parse_header(header):
     """Parses the FASTQ header as specified by CASAVA 1.8.2 and returns the fields in a dictionary
@@ -160,6 +516,78 @@ def parse_header(header):
             'control_number': int(control_number),
             'index': str(index)} # Note that MiSeq Reporter outputs a SampleSheet index rather than the index sequence
 
+def _split_field(pos, sep=":"):
+    """Return a function extracting the field at position pos, counted from the end
+    if negative, from each of a list of headers, splitting no more than necessary
+    """
+    if pos >= 0:
+        return lambda headers: [h.split(sep,pos+1)[pos] for h in headers]
+    return lambda headers: [h.rsplit(sep,-pos)[pos] for h in headers]
+
+# Functions extracting the raw value of a header field from a list of headers, for each header format.
+# MiSeq headers follow the CASAVA 1.8 format, but have the sample number in the index field
+HEADER_FIELDS = {
+    # @<instrument>:<run number>:<flowcell ID>:<lane>:<tile>:<x-pos>:<y-pos> <read>:<is filtered>:<control number>:<index sequence>
+    'casava18': {'instrument': _split_field(0),
+                 'run_number': _split_field(1),
+                 'flowcell_id': _split_field(2),
+                 'lane': _split_field(3),
+                 'tile': _split_field(4),
+                 'x_pos': _split_field(5),
+                 'y_pos': lambda headers: [h.split(":",7)[6].split(" ",1)[0] for h in headers],
+                 'read': lambda headers: [h.rsplit(":",4)[-4].rsplit(" ",1)[-1] for h in headers],
+                 'is_filtered': _split_field(-3),
+                 'control_number': _split_field(-2),
+                 'index': _split_field(-1)},
+    # @<instrument>:<lane>:<tile>:<x-pos>:<y-pos>#<index sequence>/<read>
+    'casava17': {'instrument': _split_field(0),
+                 'lane': _split_field(1),
+                 'tile': _split_field(2),
+                 'x_pos': _split_field(3),
+                 'y_pos': lambda headers: [h.split(":",5)[4].split("#",1)[0] for h in headers],
+                 'read': _split_field(-1,"/"),
+                 'index': lambda headers: [h.rsplit("#",1)[-1].split("/",1)[0] for h in headers]}}
+
+# Fields that parse_header converts to int
+INT_FIELDS = ['run_number', 'lane', 'tile', 'x_pos', 'y_pos', 'read', 'control_number']
+
+def header_format(header):
+    """Return the format of a FASTQ header, casava18 (also used by MiSeq) or casava17
+    """
+    if " " in header:
+        return 'casava18'
+    if "#" in header:
+        return 'casava17'
+    raise ValueError("Unrecognized FASTQ header format: {}".format(header))
+
+def _filter_values(field, values):
+    """Convert the filter values to the raw strings they will be compared with
+    """
+    if field == 'instrument':
+        return set(["@{}".format(v) for v in values])
+    if field == 'is_filtered':
+        return set([('Y' if v else 'N') for v in values])
+    if field in INT_FIELDS:
+        return set([str(int(v)) for v in values])
+    return set([str(v) for v in values])
+
+def compile_header_filter(filter, header):
+    """Compile a filter, a dict mapping header fields (as named by parse_header) to lists of 
+    accepted values, into a function taking a list of headers and returning a list with True
+    for each header that passes the filter. Only the filtered fields are extracted from the headers,
+    and they are compared as strings against precomputed value sets. The header format is 
+    determined from the supplied example header. Fields not present in the format are ignored.
+    """
+    fields = HEADER_FIELDS[header_format(header)]
+    tests = [(fields[k], _filter_values(k,v)) for k, v in filter.items() if k in fields]
+    
+    def _filter(headers):
+        keep = [True]*len(headers)
+        for extract, values in tests:
+            keep = [k and (v in values) for k, v in itertools.izip(keep,extract(headers))]
+        return keep
+    return _filter
+
 def is_read_pair(rec1, rec2, casava18=True):
     """Returns true if the two records belong to the same read pair, determined by matching the header strings and disregarding
        the read field
@@ -172,61 +600,109 @@ def is_read_pair(rec1, rec2, casava18=True):
     r2 = rec2[0].split(' ')
     return (len(r1) == 2 and len(r2) == 2 and r1[0] == r2[0] and r1[1][1:] == r2[1][1:])
 
-def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None):
+def lockstep_batches(parsers, size=FastQParser.BATCH_SIZE):
+    """Iterate over the batches (see FastQParser.batches) of paired fastq parsers in parallel, 
+    yielding a list with one batch per parser. Raise ValueError if the parsers hold different 
+    numbers of records. The parsers are closed when done.
+    """
+    for batches in itertools.izip_longest(*[p.batches(size) for p in parsers]):
+        if None in batches or len(set([len(b[0]) for b in batches])) > 1:
+            raise ValueError("The paired files {} contain different numbers of records".format(", ".join([p.name() for p in parsers])))
+        yield list(batches)
+    for p in parsers:
+        p.close()
+
+def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None, compressor="gzip", threads=None, processes=1, mismatches=0):
     """Demultiplex a bcl-converted illumina fastq file. Assumes it has the index sequence
-    in the header a la CASAVA 1.8+
+    in the header a la CASAVA 1.8+. The compressor and threads arguments are passed
+    on to the FastQWriter of each output file. 
+    
+    Paired files are read in a single pass, in lockstep. The lane and index are parsed 
+    from the read 1 header only and both mates are written to the same sample. If processes
+    is larger than 1, the lanes in the samplesheet are split between that many processes,
+    each passing over the input and writing the samples in its lanes.
+    
+    Indexes with up to the specified number of mismatches to a sample index in the same
+    lane are assigned to that sample, unless they are equally near another sample index
+    (see scilifelab.utils.index_matcher.IndexMatcher).
     """
-    outfiles = {}
-    counts = {}
     sdata = HiSeqRun.parse_samplesheet(samplesheet)
+    lanes = sorted(set([sd['Lane'] for sd in sdata]))
+    groups = [[sd for sd in sdata if sd['Lane'] in lanes[i::processes]] for i in xrange(min(processes,len(lanes)))]
+    args = [(outdir, group, fastq1, fastq2, compressor, threads, mismatches) for group in groups]
+    
+    if len(args) > 1:
+        pool = multiprocessing.Pool(len(args))
+        try:
+            results = pool.map(_demultiplex_lanes, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_demultiplex_lanes(a) for a in args]
+    
+    outfiles = {}
+    for result in results:
+        outfiles.update(result)
+    return outfiles
+
+def _demultiplex_lanes(args):
+    """Demultiplex the fastq file(s) into the lane-index combinations in the samplesheet data, 
+    in a single pass. Return a dict with the output file names for each lane and index
+    """
+    outdir, sdata, fastq1, fastq2, compressor, threads, mismatches = args
+    outfiles = {}
     reads = [1]
     if fastq2 is not None:
         reads.append(2)
         
-    # For each Lane-Index combination, create a file and open a filehandle
+    # For each Lane-Index combination, get the names of the temporary output files. The files 
+    # are written through a pool of writers, which limits the number of open files
     for sd in sdata:
         lane = sd['Lane']
         index = sd['Index']
         if lane not in outfiles:
             outfiles[lane] = {}
-            counts[lane] = {}
         outfiles[lane][index] = []
-        counts[lane][index] = 0
         for read in reads:
             fname = "tmp_{}_{}_L00{}_R{}_001.fastq.gz".format(sd['SampleID'],
                                                               index,
                                                               lane,
                                                               read)
-            outfiles[lane][index].append(FastQWriter(os.path.join(outdir,fname)))
+            outfiles[lane][index].append(os.path.join(outdir,fname))
+    matchers = dict([(lane, IndexMatcher(ix.keys(),mismatches)) for lane, ix in outfiles.items()])
+    writers = FastQWriterPool(compressor=compressor,threads=threads)
     
-    # Parse the input file(s) and write the records to the appropriate output files
-    fhs = [FastQParser(fastq1)]
+    # Parse the input file(s) in lockstep and write the record pairs to the appropriate output files
+    parsers = [FastQParser(fastq1)]
     if fastq2 is not None:
-        fhs.append(FastQParser(fastq2))
-        
-    for r, fh in enumerate(fhs):
-        for record in fh:
-            header = parse_header(record[0])
-            lane = str(header['lane'])
-            index = header['index']
-            if lane in outfiles and index in outfiles[lane]:
-                outfiles[lane][index][r].write(record)
-                counts[lane][index] += 1
-    
-    # Close filehandles and replace the handles with the file names
+        parsers.append(FastQParser(fastq2))
+    
+    fields = None
+    for batches in lockstep_batches(parsers):
+        headers = batches[0][0]
+        if fields is None:
+            fmt = header_format(headers[0])
+            fields = HEADER_FIELDS[fmt]
+        for i, (lane, index) in enumerate(itertools.izip(fields['lane'](headers),fields['index'](headers))):
+            if len(batches) > 1 and not is_read_pair((headers[i],),(batches[1][0][i],),fmt == 'casava18'):
+                raise ValueError("Read identifiers differ for paired reads ({} and {})".format(headers[i],batches[1][0][i]))
+            matcher = matchers.get(lane)
+            hit = matcher.match(index) if matcher is not None else None
+            if hit is not None and len(hit[0]) == 1:
+                for fname, batch in itertools.izip(outfiles[lane][hit[0][0]],batches):
+                    writers.write(fname,[batch[0][i],batch[1][i],batch[2][i],batch[3][i]])
+    writers.close()
+    
+    # Rename the temporary files to persistent names. Files are only created for 
+    # samples having sequences, the other samples are removed from the results
     for lane in outfiles.keys():
         for index in outfiles[lane].keys():
-            for r, fh in enumerate(outfiles[lane][index]):
-                fh.close()
-                fname = fh.name()
-                # If no sequences were written, remove the temporary file and the entry from the results
-                if counts[lane][index] == 0:
-                    os.unlink(fname)
-                    del outfiles[lane][index]
-                    break
-                
-                # Rename the temporary file to a persistent name
-                nname = fname.replace("tmp_","")
+            if writers.rwritten(outfiles[lane][index][0]) == 0:
+                del outfiles[lane][index]
+                continue
+            for r, fname in enumerate(outfiles[lane][index]):
+                nname = os.path.join(os.path.dirname(fname),os.path.basename(fname).replace("tmp_","",1))
                 os.rename(fname,nname)
                 outfiles[lane][index][r] = nname
     
@@ -0,0 +1,485 @@
+"""Utilities for reading and writing gzip-compressed data with different (de)compression backends"""
+import collections
+import gzip
+import multiprocessing
+import struct
+import subprocess
+import zlib
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+# The available decompression and compression backends
+DECOMPRESSORS = ["auto", "gzip", "threaded", "pipe"]
+COMPRESSORS = ["gzip", "threaded"]
+
+# The maximum amount of uncompressed data in a BGZF block, chosen so that
+# the compressed block is guaranteed to fit within the 64 kb limit
+BGZF_BLOCK_SIZE = 65280
+# The empty block marking the end of a BGZF file
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+# Thread pools shared by the writers, keyed by the number of threads
+_POOLS = {}
+
+# External decompressors reading from stdin, in order of preference, and how to call them
+PIPE_COMMANDS = [("pigz", lambda threads: ["pigz", "-d", "-c", "-p", str(threads)]),
+                 ("gzip", lambda threads: ["gzip", "-d", "-c"])]
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def is_bgzf(fname):
+    """Return True if the file starts with a BGZF block, i.e. a gzip member having
+    the 'BC' extra subfield that holds the compressed size of the block
+    """
+    with open(fname, "rb") as fh:
+        return _bgzf_block_size(fh.read(18)) is not None
+
+def _bgzf_block_size(header):
+    """Parse the total size of a BGZF block from its header. Return None if the
+    header is not a BGZF header
+    """
+    if len(header) < 18 or header[0:4] != "\x1f\x8b\x08\x04":
+        return None
+    xlen = struct.unpack("<H", header[10:12])[0]
+    if header[12:14] != "BC" or xlen < 6:
+        return None
+    return struct.unpack("<H", header[16:18])[0] + 1
+
+def shared_pool(threads=None):
+    """Return a thread pool with the specified number of threads that is shared
+    within the process, so that many open writers do not each start their own threads
+    """
+    threads = threads or cpu_count()
+    if threads not in _POOLS:
+        _POOLS[threads] = ThreadPool(threads)
+    return _POOLS[threads]
+
+def _pipe_command(threads):
+    """Return the command line for the preferred external decompressor available
+    """
+    for prog, cmd in PIPE_COMMANDS:
+        if find_executable(prog) is not None:
+            return cmd(threads)
+    return None
+
+def open_gzip(fname, decompressor="auto", threads=None, offset=0):
+    """Open a gzip-compressed file for reading, using the specified decompression backend:
+
+        gzip     - the single-threaded gzip.GzipFile
+        threaded - in-process decompression in a pool of threads. BGZF files are
+                   decompressed block-wise in parallel, other files are decompressed
+                   ahead of the reader in a background thread
+        pipe     - read the output of an external decompressor (pigz if available,
+                   otherwise gzip) running in a separate process
+        auto     - threaded for BGZF input, pipe if pigz is available and gzip otherwise
+
+    :param fname: path to the compressed file
+    :param decompressor: the decompression backend to use
+    :param threads: the number of threads to use for decompression, defaults to the number of cpus
+    :param offset: the position in the compressed file to start reading at, must be the start of a gzip member
+
+    :returns: a file-like object with read, readline and next methods
+    """
+    if decompressor not in DECOMPRESSORS:
+        raise ValueError("Unknown decompressor '{}', should be one of {}".format(decompressor, ", ".join(DECOMPRESSORS)))
+    if threads is None:
+        threads = cpu_count()
+
+    if decompressor == "auto":
+        if threads > 1 and is_bgzf(fname):
+            decompressor = "threaded"
+        elif find_executable("pigz") is not None:
+            decompressor = "pipe"
+        else:
+            decompressor = "gzip"
+
+    if decompressor == "threaded":
+        return ThreadedGzipReader(fname, threads, offset)
+    if decompressor == "pipe":
+        return PipeReader(fname, threads, offset)
+    fh = open(fname, "rb")
+    fh.seek(offset)
+    return gzip.GzipFile(fileobj=fh)
+
+def open_gzip_writer(fname, compressor="gzip", compresslevel=9, block_size=BGZF_BLOCK_SIZE, threads=None, mode="wb"):
+    """Open a file for writing gzip-compressed data, using the specified compression backend:
+
+        gzip     - the single-threaded gzip.GzipFile
+        threaded - buffer the data in memory and compress independent blocks in a
+                   pool of threads, see ThreadedGzipWriter
+
+    :param fname: path to the output file
+    :param compressor: the compression backend to use
+    :param compresslevel: the compression level, 1-9
+    :param block_size: the amount of uncompressed data in each block (threaded only)
+    :param threads: the number of threads to use for compression (threaded only)
+    :param mode: the mode to open the file in, "wb" or "ab". Appending adds new gzip members
+    after the existing ones
+
+    :returns: a file-like object with write and close methods
+    """
+    if compressor not in COMPRESSORS:
+        raise ValueError("Unknown compressor '{}', should be one of {}".format(compressor, ", ".join(COMPRESSORS)))
+    if compressor == "threaded":
+        return ThreadedGzipWriter(fname, compresslevel, block_size, threads, mode)
+    return gzip.GzipFile(fileobj=open(fname, mode), compresslevel=compresslevel)
+
+
+class _BufferedReader(object):
+    """Base class for the readers, providing file-like read access on top of
+    an iterator over decompressed chunks. The _open method of a subclass opens
+    the input and passes its iterator on to _open of this class
+    """
+
+    def __init__(self, fname):
+        self.name = fname
+        self.closed = False
+        self._open()
+
+    def _open(self, chunks):
+        self._buf = ""
+        self._lines = iter([])
+        self._chunk_iter = chunks
+
+    def _next_chunk(self):
+        try:
+            return self._chunk_iter.next()
+        except StopIteration:
+            return ""
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._lines.next()
+        except StopIteration:
+            pass
+        while True:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            data = self._buf + chunk
+            end = data.rfind("\n") + 1
+            if end > 0:
+                self._buf = data[end:]
+                self._lines = iter(data[0:end].splitlines(True))
+                return self._lines.next()
+            self._buf = data
+        # Return any final line lacking a newline
+        if self._buf:
+            line, self._buf = self._buf, ""
+            return line
+        raise StopIteration
+
+    def readline(self):
+        try:
+            return self.next()
+        except StopIteration:
+            return ""
+
+    def read(self, size=-1):
+        data = ["".join(self._lines), self._buf]
+        self._lines = iter([])
+        n = len(data[0]) + len(data[1])
+        while size < 0 or n < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            data.append(chunk)
+            n += len(chunk)
+        data = "".join(data)
+        if size < 0:
+            size = len(data)
+        self._buf = data[size:]
+        return data[0:size]
+
+    def seek(self, offset, whence=0):
+        """Only rewinding to where reading started is supported
+        """
+        if offset != 0 or whence != 0:
+            raise IOError("{} can only seek to the start of the file".format(self.__class__.__name__))
+        self._close()
+        self._open()
+
+    def _close(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self._close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PipeReader(_BufferedReader):
+    """Read the output from an external decompressor process
+    """
+
+    CHUNK_SIZE = 1024*1024
+
+    def __init__(self, fname, threads=None, offset=0):
+        self.cmd = _pipe_command(threads or cpu_count())
+        if self.cmd is None:
+            raise OSError("No external decompressor found, tried {}".format(", ".join([p for p, _ in PIPE_COMMANDS])))
+        self.offset = offset
+        super(PipeReader, self).__init__(fname)
+
+    def _open(self):
+        # The decompressor reads the file from stdin, positioned at the offset
+        with open(self.name, "rb") as fh:
+            fh.seek(self.offset)
+            self._proc = subprocess.Popen(self.cmd, stdin=fh, stdout=subprocess.PIPE)
+        super(PipeReader, self)._open(self._chunks())
+
+    def _chunks(self):
+        while True:
+            chunk = self._proc.stdout.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        if self._proc.wait() != 0:
+            raise IOError("{} exited with status {}".format(" ".join(self.cmd), self._proc.returncode))
+
+    def _close(self):
+        self._proc.stdout.close()
+        if self._proc.poll() is None:
+            self._proc.terminate()
+            self._proc.wait()
+
+
+class ThreadedGzipReader(_BufferedReader):
+    """Decompress a gzip file in a pool of threads. The blocks of a BGZF file
+    are independent and are decompressed in parallel. Other gzip files,
+    including multi-member files, are decompressed sequentially by a
+    background thread, ahead of the reader.
+    """
+
+    CHUNK_SIZE = 1024*1024
+    # Number of BGZF blocks (at most 64 kb each) to decompress in one task
+    BLOCKS_PER_TASK = 64
+
+    def __init__(self, fname, threads=None, offset=0):
+        self.threads = threads or cpu_count()
+        self.bgzf = is_bgzf(fname)
+        self.offset = offset
+        super(ThreadedGzipReader, self).__init__(fname)
+
+    def _open(self):
+        self._fh = open(self.name, "rb")
+        self._fh.seek(self.offset)
+        self._pool = ThreadPool(self.threads if self.bgzf else 1)
+        super(ThreadedGzipReader, self)._open(self._chunks())
+
+    def _chunks(self):
+        if self.bgzf:
+            tasks = ((_inflate_blocks, (blocks,)) for blocks in self._bgzf_blocks())
+        else:
+            inflater = _MemberInflater()
+            tasks = ((inflater.inflate, (data,)) for data in iter(lambda: self._fh.read(self.CHUNK_SIZE), ""))
+
+        # Keep a bounded number of tasks in flight and return the non-empty results in order
+        pending = collections.deque()
+        for fn, args in tasks:
+            pending.append(self._pool.apply_async(fn, args))
+            if len(pending) > 2*self.threads:
+                chunk = pending.popleft().get()
+                if chunk:
+                    yield chunk
+        while pending:
+            chunk = pending.popleft().get()
+            if chunk:
+                yield chunk
+        if not self.bgzf:
+            inflater.check_eof()
+
+    def _bgzf_blocks(self):
+        """Split the raw input into lists of complete BGZF blocks
+        """
+        data = ""
+        while True:
+            raw = self._fh.read(self.BLOCKS_PER_TASK*65536)
+            if not raw:
+                break
+            data += raw
+            blocks = []
+            start = 0
+            while True:
+                size = _bgzf_block_size(data[start:start+18])
+                if size is None or start + size > len(data):
+                    break
+                blocks.append(data[start:start+size])
+                start += size
+            data = data[start:]
+            if blocks:
+                yield blocks
+        if data:
+            raise IOError("Truncated or invalid BGZF block at the end of {}".format(self.name))
+
+    def _close(self):
+        self._pool.terminate()
+        self._fh.close()
+
+
+def inflate_members(fname, chunk_size=ThreadedGzipReader.CHUNK_SIZE):
+    """Decompress a gzip file, which may consist of several members, and yield 
+    the decompressed data in chunks as tuples (offset, data), where offset is the
+    position in the compressed file where the gzip member holding the data starts
+    """
+    with open(fname, "rb") as fh:
+        pos = 0
+        member = 0
+        d = None
+        for raw in iter(lambda: fh.read(chunk_size), ""):
+            pos += len(raw)
+            data = raw
+            while data:
+                if d is None:
+                    # Gzip files may be padded with zeros after the last member
+                    data = data.lstrip("\x00")
+                    if not data:
+                        break
+                    member = pos - len(data)
+                    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out = d.decompress(data)
+                if out:
+                    yield member, out
+                data = d.unused_data
+                if data:
+                    d = None
+
+def _inflate_blocks(blocks):
+    return "".join([zlib.decompress(block, 16 + zlib.MAX_WBITS) for block in blocks])
+
+
+class _MemberInflater(object):
+    """Incrementally decompress a stream of concatenated gzip members
+    """
+
+    def __init__(self):
+        self._d = None
+
+    def inflate(self, data):
+        out = []
+        while data:
+            if self._d is None:
+                # Gzip files may be padded with zeros after the last member
+                data = data.lstrip("\x00")
+                if not data:
+                    break
+                self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            out.append(self._d.decompress(data))
+            data = self._d.unused_data
+            if data:
+                self._d = None
+        return "".join(out)
+
+    def check_eof(self):
+        """Raise IOError if the last member is incomplete
+        """
+        if self._d is None:
+            return
+        # A finished stream stores any further input as unused data
+        d = self._d.copy()
+        d.decompress("\x00")
+        if len(d.unused_data) == 0:
+            raise IOError("Compressed file ended before the end-of-stream marker was reached")
+
+
+class ThreadedGzipWriter(object):
+    """Buffer the written data in memory and compress it in independent blocks
+    on a pool of threads shared by all writers. Blocks of at most BGZF_BLOCK_SIZE
+    bytes are written as BGZF blocks, larger blocks as regular gzip members. Either
+    way, the output is a multi-member gzip file readable by standard gzip tools.
+    """
+
+    def __init__(self, fname, compresslevel=9, block_size=BGZF_BLOCK_SIZE, threads=None, mode="wb"):
+        if block_size <= 0:
+            raise ValueError("The block size must be positive")
+        self.name = fname
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.bgzf = (block_size <= BGZF_BLOCK_SIZE)
+        self.closed = False
+        self._pool = shared_pool(threads)
+        self._max_pending = 2*(threads or cpu_count())
+        self._fh = open(fname, mode)
+        self._buf = []
+        self._buf_size = 0
+        self._pending = collections.deque()
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buf_size += len(data)
+        if self._buf_size >= self.block_size:
+            self._submit_blocks(False)
+
+    def _submit_blocks(self, final):
+        """Submit the full blocks in the buffer for compression, including
+        the last partial block if final is True
+        """
+        data = "".join(self._buf)
+        end = len(data)
+        if not final:
+            end -= end % self.block_size
+        for i in xrange(0, end, self.block_size):
+            self._pending.append(self._pool.apply_async(_compress_block,
+                                                        (data[i:i+self.block_size], self.compresslevel, self.bgzf)))
+            self._write_compressed(len(self._pending) > self._max_pending)
+        self._buf = [data[end:]]
+        self._buf_size = len(data) - end
+
+    def _write_compressed(self, wait=False):
+        """Write the compressed blocks that are done, in order. If wait is True,
+        wait for at least the first pending block
+        """
+        while len(self._pending) > 0 and (wait or self._pending[0].ready()):
+            self._fh.write(self._pending.popleft().get())
+            wait = False
+
+    def flush(self):
+        """Compress and write all buffered data. Note that this ends the current
+        block, so frequent flushing will reduce the compression ratio
+        """
+        self._submit_blocks(True)
+        while len(self._pending) > 0:
+            self._write_compressed(True)
+        self._fh.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        if self.bgzf:
+            self._fh.write(BGZF_EOF)
+        self._fh.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _compress_block(data, compresslevel, bgzf):
+    """Compress data into a complete gzip member, with the BGZF extra field if bgzf is True
+    """
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(data) + c.flush()
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    if bgzf:
+        header = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" + \
+            struct.pack("<H", len(cdata) + 25)
+    else:
+        header = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+    return header + cdata + footer
@@ -0,0 +1,88 @@
+"""Bounded-memory counting of the most frequent items in a stream"""
+import collections
+import heapq
+import itertools
+import math
+
+class HeavyHitterCounter(collections.Counter):
+    """A Counter that keeps at most capacity keys, using the Misra-Gries summary.
+    When the number of keys exceeds the capacity, the (capacity+1):th largest count
+    is subtracted from all counts and the keys whose counts drop to zero are removed.
+
+    The counts are lower bounds of the true counts. The true count of any key is at
+    most the count plus the accumulated error, which is bounded by total/(capacity+1),
+    where total is the number of counted items. Any key occurring more often than the
+    error is guaranteed to be kept. The counters are mergeable, i.e. the bounds hold
+    also when counters of disjoint parts of a stream are combined with update.
+
+    Until the number of distinct keys exceeds the capacity, the counts are exact.
+    With capacity None, the counter is an ordinary, exact Counter.
+    """
+
+    # Number of items counted at a time when updating from an iterable
+    CHUNK_SIZE = 100000
+
+    def __init__(self, iterable=None, capacity=None, error_rate=None, **kwds):
+        """
+        :param iterable: items or a mapping of counts to add
+        :param capacity: the maximum number of keys to keep
+        :param error_rate: the maximum error, as a fraction of the number of counted items,
+        used to set the capacity if capacity is not given
+        """
+        if capacity is None and error_rate is not None:
+            capacity = int(math.ceil(1./error_rate))
+        if capacity is not None and capacity < 1:
+            raise ValueError("The capacity must be at least 1")
+        self.capacity = capacity
+        self.error = 0
+        super(HeavyHitterCounter, self).__init__(iterable, **kwds)
+
+    def update(self, iterable=None, **kwds):
+        """Add counts from an iterable of items or a mapping of counts, e.g.
+        another HeavyHitterCounter, whose error is added to the error of this counter
+        """
+        if iterable is None or isinstance(iterable, collections.Mapping):
+            super(HeavyHitterCounter, self).update(iterable, **kwds)
+            self.error += getattr(iterable, "error", 0)
+            self._prune()
+            return
+        iterable = iter(iterable)
+        size = max(self.capacity or 0, self.CHUNK_SIZE)
+        while True:
+            chunk = list(itertools.islice(iterable, size))
+            if len(chunk) == 0:
+                break
+            super(HeavyHitterCounter, self).update(chunk)
+            self._prune()
+        if kwds:
+            self.update(kwds)
+
+    def _prune(self):
+        if self.capacity is None or len(self) <= self.capacity:
+            return
+        threshold = heapq.nlargest(self.capacity + 1, self.itervalues())[-1]
+        for key, count in self.items():
+            if count <= threshold:
+                del self[key]
+            else:
+                self[key] = count - threshold
+        self.error += threshold
+
+    def exact(self):
+        """Return True if the counts are exact
+        """
+        return self.error == 0
+
+    def bounds(self, key):
+        """Return the lower and upper bounds of the true count of key
+        """
+        return self[key], self[key] + self.error
+
+    def copy(self):
+        c = self.__class__(capacity=self.capacity)
+        dict.update(c, self)
+        c.error = self.error
+        return c
+
+    def __reduce__(self):
+        return (self.__class__, (None, self.capacity), {'error': self.error}, None, self.iteritems())
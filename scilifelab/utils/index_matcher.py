@@ -0,0 +1,162 @@
+"""Mismatch-tolerant lookup of index sequences"""
+import itertools
+import numpy as np
+
+# The bases a mismatch can substitute, N is included since it is frequent in index reads
+BASES = "ACGTN"
+# The separator between the parts of a dual index
+DUAL_INDEX_SEPARATOR = "-"
+
+def neighbours(seq, max_mismatches, bases=BASES):
+    """Generate all sequences within max_mismatches substitutions of seq
+
+    :param seq: the sequence
+    :param max_mismatches: the maximum number of substituted positions
+    :param bases: the bases that can be substituted
+
+    :returns: a generator of tuples (sequence, mismatches), where each sequence
+    appears once, with its actual number of mismatches against seq
+    """
+    yield seq, 0
+    for n in xrange(1, min(max_mismatches,len(seq)) + 1):
+        for positions in itertools.combinations(xrange(len(seq)), n):
+            choices = [[b for b in bases if b != seq[p]] for p in positions]
+            for substitutes in itertools.product(*choices):
+                s = list(seq)
+                for p, b in itertools.izip(positions, substitutes):
+                    s[p] = b
+                yield "".join(s), n
+
+class IndexMatcher(object):
+    """Match observed index sequences against a set of supplied indexes, allowing
+    for mismatches. A lookup table from every sequence within max_mismatches of a
+    supplied index is precomputed, so each observed sequence is matched with a
+    single dict lookup. A sequence is matched to the nearest supplied index. If
+    several indexes are equally near, the sequence is ambiguous and all of them
+    are returned.
+
+    Dual indexes are given with the parts separated by '-', e.g. ACGTAC-GTTACG,
+    and max_mismatches applies to each part separately.
+    """
+
+    def __init__(self, indexes, max_mismatches=1):
+        """
+        :param indexes: the supplied index sequences
+        :param max_mismatches: the maximum number of mismatches (per part for dual indexes)
+        """
+        self.indexes = sorted(set(indexes))
+        self.max_mismatches = max_mismatches
+        self.lengths = sorted(set([len(index) for index in self.indexes]), reverse=True)
+        self._table = {}
+        for index in self.indexes:
+            for seq, mismatches in self._neighbours(index):
+                hit = self._table.get(seq)
+                if hit is None or mismatches < hit[1]:
+                    self._table[seq] = ((index,), mismatches)
+                elif mismatches == hit[1]:
+                    self._table[seq] = (hit[0] + (index,), mismatches)
+
+    def _neighbours(self, index):
+        parts = index.split(DUAL_INDEX_SEPARATOR)
+        if len(parts) == 1:
+            return neighbours(index, self.max_mismatches)
+        combinations = itertools.product(*[list(neighbours(p, self.max_mismatches)) for p in parts])
+        return ((DUAL_INDEX_SEPARATOR.join([s for s, _ in c]), sum([m for _, m in c])) for c in combinations)
+
+    def ambiguous(self):
+        """Return the sequences that are equally near to more than one supplied
+        index, as a dict mapping each sequence to the indexes it is near
+        """
+        return dict([(seq, hit[0]) for seq, hit in self._table.items() if len(hit[0]) > 1])
+
+    def match(self, seq):
+        """Match an observed index sequence against the supplied indexes
+
+        :param seq: the observed index sequence
+
+        :returns: None if the sequence does not match any index, otherwise a tuple
+        (indexes, mismatches) with a tuple of the nearest supplied indexes, which
+        has more than one element if the match is ambiguous, and the number of mismatches
+        """
+        return self._table.get(seq)
+
+    def match_prefix(self, seq):
+        """Match the start of an observed sequence, e.g. an index read that
+        continues into a molecular tag, against the supplied indexes, which may
+        have different lengths. An exact match to a longer index takes precedence,
+        otherwise the nearest indexes of any length are returned
+
+        :returns: as for match
+        """
+        best = None
+        for length in self.lengths:
+            hit = self._table.get(seq[0:length])
+            if hit is None:
+                continue
+            if hit[1] == 0:
+                return hit
+            if best is None or hit[1] < best[1]:
+                best = hit
+            elif hit[1] == best[1]:
+                best = (best[0] + hit[0], best[1])
+        return best
+
+
+def _encode_parts(indexes):
+    """Encode the parts of the indexes as arrays of character codes, with one row
+    per index. Parts shorter than the longest are padded with a code that only
+    matches the padding, as are missing parts of single indexes among dual ones
+    """
+    parts = [index.split(DUAL_INDEX_SEPARATOR) for index in indexes]
+    nparts = max([len(p) for p in parts])
+    encoded = []
+    for i in xrange(nparts):
+        seqs = [p[i] if i < len(p) else "" for p in parts]
+        length = max([len(seq) for seq in seqs])
+        padded = "".join([seq.ljust(length, "\0") for seq in seqs])
+        encoded.append(np.frombuffer(padded, dtype=np.uint8).reshape(len(seqs), length))
+    return encoded
+
+def _hamming_matrix(codes):
+    """Compute the pairwise Hamming distances between the rows of an array of
+    character codes, by counting the matching positions as the product of the
+    one-hot encoded rows
+    """
+    symbols = np.unique(codes)
+    onehot = (codes[:, :, np.newaxis] == symbols).reshape(len(codes), -1).astype(np.float64)
+    return codes.shape[1] - np.dot(onehot, onehot.T).astype(np.int64)
+
+def index_distances(indexes):
+    """Compute the pairwise Hamming distances between indexes, for all pairs at once.
+    Indexes of different lengths are compared as if the shorter were padded with
+    characters not matching any base. Dual indexes are compared part by part
+
+    :param indexes: a list of index sequences, dual indexes with the parts separated by '-'
+
+    :returns: an array with the distances of each part, with shape (parts, indexes, indexes)
+    """
+    if len(indexes) == 0:
+        return np.zeros((0, 0, 0), dtype=np.int64)
+    return np.array([_hamming_matrix(codes) for codes in _encode_parts(indexes)])
+
+def index_collisions(indexes, max_mismatches=0):
+    """Find the pairs of indexes that can not be told apart when allowing max_mismatches
+    mismatches (per part for dual indexes), i.e. the indexes within max_mismatches of 
+    each other in all parts
+
+    :param indexes: a list of index sequences, dual indexes with the parts separated by '-'
+    :param max_mismatches: the maximum number of mismatches allowed
+
+    :returns: a tuple with the minimum distance between any two distinct indexes, summed 
+    over the parts, or None if there are fewer than two, and a list of tuples 
+    (i, j, distance) with the positions in indexes of the colliding pairs
+    """
+    indexes = list(indexes)
+    distances = index_distances(indexes)
+    if len(indexes) < 2:
+        return None, []
+    total = distances.sum(axis=0)
+    i1, i2 = np.triu_indices(len(indexes), 1)
+    collide = (distances[:, i1, i2] <= max_mismatches).all(axis=0)
+    collisions = [(int(a), int(b), int(total[a, b])) for a, b in zip(i1[collide], i2[collide])]
+    return int(total[i1, i2].min()), collisions
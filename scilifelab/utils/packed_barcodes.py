@@ -0,0 +1,234 @@
+"""Bulk counting of barcode sequences packed into integers, with 2 bits per base"""
+import collections
+import heapq
+import numpy as np
+
+# The bases that are packed, in the order of their 2-bit codes
+BASES = "ACGT"
+# The longest barcode that can be packed into a 64-bit integer
+MAX_LENGTH = 32
+# Barcodes up to this length are counted in an array with one element per possible barcode
+DENSE_MAX_LENGTH = 10
+# The number of pending counts to collect before they are merged, for longer barcodes
+MERGE_SIZE = 1000000
+
+_ESCAPE = 4
+_NEWLINE = ord("\n")
+# The code of each byte, where characters other than ACGT are escaped
+_CODES = np.zeros(256, dtype=np.uint8) + _ESCAPE
+for _i, _b in enumerate(BASES):
+    _CODES[ord(_b)] = _i
+
+def encode(barcodes, length):
+    """Pack barcodes of the given length, consisting of the bases ACGT only, into
+    64-bit integers. Barcodes of other lengths, or containing N or other characters,
+    are escaped, i.e. returned as they are
+
+    :param barcodes: a list of barcode strings
+    :param length: the length of the barcodes to pack, at most MAX_LENGTH
+
+    :returns: a tuple with an array of the codes of the packed barcodes and a list of
+    the escaped barcodes
+    """
+    codes, packed = _encode(barcodes, length)
+    if packed.all():
+        return codes, []
+    return codes, [barcodes[i] for i in np.flatnonzero(~packed)]
+
+def _encode(barcodes, length):
+    """Pack barcodes as for encode, returning the codes and a boolean array that is 
+    True for the barcodes that were packed
+    """
+    if length > MAX_LENGTH:
+        raise ValueError("Barcodes longer than {} bases can not be packed".format(MAX_LENGTH))
+    n = len(barcodes)
+    # Join the barcodes with newlines. If each barcode is followed by a newline at the 
+    # expected position, all barcodes have the right length
+    joined = "\n".join(barcodes) + "\n"
+    if len(joined) == n*(length + 1):
+        values = np.frombuffer(joined, dtype=np.uint8).reshape(n, length + 1)
+    if len(joined) == n*(length + 1) and (values[:, length] == _NEWLINE).all():
+        packed = np.ones(n, dtype=bool)
+    else:
+        packed = np.array(map(len, barcodes)) == length
+        barcodes = [b for b, p in zip(barcodes, packed) if p]
+        values = np.frombuffer("".join(barcodes), dtype=np.uint8).reshape(len(barcodes), length)
+    if len(barcodes) == 0 or length == 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(n, dtype=bool)
+    values = np.take(_CODES, values[:, 0:length])
+    valid = (values != _ESCAPE).all(axis=1)
+    if not valid.all():
+        packed[np.flatnonzero(packed)[~valid]] = False
+        values = values[valid]
+    codes = np.zeros(len(values), dtype=np.uint64)
+    two = np.uint64(2)
+    for i in xrange(length):
+        codes <<= two
+        codes |= values[:, i]
+    return codes, packed
+
+def decode(code, length):
+    """Unpack a barcode of the given length from its code
+    """
+    code = int(code)
+    bases = []
+    for i in xrange(length):
+        bases.append(BASES[code & 3])
+        code >>= 2
+    return "".join(reversed(bases))
+
+def _most_common_length(barcodes):
+    return collections.Counter([len(b) for b in barcodes]).most_common(1)[0][0]
+
+class BarcodeCounter(object):
+    """Count barcodes in bulk. The barcodes of the most common length, consisting of
+    ACGT only, are packed into integers and counted with numpy. Other barcodes, e.g.
+    containing N, are counted as strings. Counters can be merged, e.g. across files
+    and lanes, with update.
+    """
+
+    def __init__(self, length=None):
+        """
+        :param length: the length of the barcodes to pack. If not given, the most common
+        length in the first batch is used
+        """
+        self.length = None
+        self._escaped = collections.Counter()
+        if length is not None:
+            self._setup(length)
+
+    def _setup(self, length):
+        self.length = min(length, MAX_LENGTH)
+        self._dense = None
+        if self.length <= DENSE_MAX_LENGTH:
+            self._dense = np.zeros(4**self.length, dtype=np.int64)
+        # Sorted unique codes and their counts, and pending (codes, counts) to merge
+        self._codes = np.zeros(0, dtype=np.uint64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._pending = []
+        self._npending = 0
+
+    def add(self, barcodes):
+        """Count a batch of barcodes
+
+        :param barcodes: a list of barcode strings
+        """
+        if len(barcodes) == 0:
+            return
+        if self.length is None:
+            self._setup(_most_common_length(barcodes[0:1000]))
+        codes, packed = _encode(barcodes, self.length)
+        if not packed.all():
+            self._escaped.update([barcodes[i] for i in np.flatnonzero(~packed)])
+        if len(codes) == 0:
+            return
+        self._add_codes(codes)
+
+    def _add_counts(self, barcodes, counts):
+        """Add the counts for a list of distinct barcodes
+        """
+        if len(barcodes) == 0:
+            return
+        if self.length is None:
+            self._setup(_most_common_length(barcodes))
+        codes, packed = _encode(barcodes, self.length)
+        counts = np.asarray(counts, dtype=np.int64)
+        for i in np.flatnonzero(~packed):
+            self._escaped[barcodes[i]] += int(counts[i])
+        if len(codes) > 0:
+            self._add_codes(codes, counts[packed])
+
+    def _add_codes(self, codes, counts=None):
+        """Add counts for codes, by default one count per code. The codes are collected
+        and counted in one go when there are enough of them
+        """
+        if counts is None:
+            counts = np.ones(len(codes), dtype=np.int64)
+        self._pending.append((codes, counts))
+        self._npending += len(codes)
+        if self._npending >= (MERGE_SIZE if self._dense is None else len(self._dense)/8):
+            self._merge()
+
+    def _merge(self):
+        """Merge the pending codes into the dense array, or the pending counts into 
+        the sorted unique codes
+        """
+        if len(self._pending) == 0:
+            return
+        codes = [c for c, _ in self._pending]
+        counts = [n for _, n in self._pending]
+        self._pending = []
+        self._npending = 0
+        if self._dense is not None:
+            self._dense += np.bincount(np.concatenate(codes).astype(np.int64), weights=np.concatenate(counts),
+                                       minlength=len(self._dense)).astype(np.int64)
+            return
+        self._codes, inverse = np.unique(np.concatenate([self._codes] + codes), return_inverse=True)
+        self._counts = np.bincount(inverse, weights=np.concatenate([self._counts] + counts)).astype(np.int64)
+
+    def _arrays(self):
+        """Return arrays of the counted codes and their counts
+        """
+        if self.length is None:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        self._merge()
+        if self._dense is not None:
+            codes = np.flatnonzero(self._dense)
+            return codes.astype(np.uint64), self._dense[codes]
+        return self._codes, self._counts
+
+    def update(self, other):
+        """Add the counts from another BarcodeCounter, or from a mapping of barcodes to counts
+        """
+        if isinstance(other, BarcodeCounter) and other.length is not None and other.length == self.length:
+            codes, counts = other._arrays()
+            if len(codes) > 0:
+                self._add_codes(codes, counts)
+            self._escaped.update(other._escaped)
+            return
+        items = other.items()
+        self._add_counts([b for b, _ in items], [n for _, n in items])
+
+    def __getitem__(self, barcode):
+        if self.length is not None:
+            codes, _ = encode([barcode], self.length)
+            if len(codes) > 0:
+                self._merge()
+                if self._dense is not None:
+                    return int(self._dense[int(codes[0])])
+                i = np.searchsorted(self._codes, codes[0])
+                if i < len(self._codes) and self._codes[i] == codes[0]:
+                    return int(self._counts[i])
+                return 0
+        return self._escaped[barcode]
+
+    def total(self):
+        """The total number of counted barcodes
+        """
+        return int(self._arrays()[1].sum()) + sum(self._escaped.values())
+
+    def items(self):
+        """Return a list of (barcode, count) tuples for all counted barcodes
+        """
+        codes, counts = self._arrays()
+        items = [(decode(c, self.length), int(n)) for c, n in zip(codes, counts)]
+        return items + self._escaped.items()
+
+    def most_common(self, n=None):
+        """Return a list of the n most common barcodes and their counts, from the most
+        common to the least, as for collections.Counter
+        """
+        codes, counts = self._arrays()
+        if n is not None and n < len(codes):
+            top = np.argpartition(-counts, n)[0:n]
+            codes, counts = codes[top], counts[top]
+        items = [(decode(c, self.length), int(k)) for c, k in zip(codes, counts)]
+        items.extend(self._escaped.most_common(n))
+        if n is None:
+            return sorted(items, key=lambda x: x[1], reverse=True)
+        return heapq.nlargest(n, items, key=lambda x: x[1])
+
+    def counter(self):
+        """Return the counts as a collections.Counter
+        """
+        return collections.Counter(dict(self.items()))
@@ -0,0 +1,145 @@
+"""Vectorized quality statistics for batches of fastq records"""
+import numpy as np
+
+# The highest Phred score tracked in the per-cycle histograms, higher scores are counted as this
+MAX_QUALITY = 93
+
+def quality_array(quals, offset=33):
+    """Convert a list of quality strings to a 2-dimensional array of Phred scores,
+    one row per read. Shorter reads are padded and the padding is masked out.
+
+    :param quals: list of quality strings
+    :param offset: the Phred quality score offset
+
+    :returns: a tuple with the array of scores, a boolean mask that is True for the
+    actual (non-padded) positions and an array with the read lengths
+    """
+    n = len(quals)
+    if n == 0:
+        return np.zeros((0,0), dtype=np.int16), np.zeros((0,0), dtype=bool), np.zeros(0, dtype=np.int64)
+    lengths = np.fromiter((len(q) for q in quals), dtype=np.int64, count=n)
+    width = int(lengths.max())
+    if lengths.min() == width:
+        # All reads are of equal length, so the concatenated string can be reshaped directly
+        raw = np.frombuffer("".join(quals), dtype=np.uint8).reshape(n, width)
+        mask = np.ones((n, width), dtype=bool)
+    else:
+        # A fixed-width string array pads the shorter reads with null bytes
+        raw = np.array(quals, dtype="S{}".format(width)).view(np.uint8).reshape(n, width)
+        mask = np.arange(width) < lengths[:, np.newaxis]
+    scores = raw.astype(np.int16) - offset
+    scores[~mask] = 0
+    return scores, mask, lengths
+
+def read_quality(quals, offset=33, cutoff=30):
+    """Calculate the mean quality and the percentage of bases having at least the
+    cutoff quality for each read in a list of quality strings
+
+    :returns: a tuple of two float arrays, with the mean quality and the percentage
+    of bases with quality >= cutoff, respectively
+    """
+    scores, mask, lengths = quality_array(quals, offset)
+    mean = scores.sum(axis=1) / lengths.astype(float)
+    pct = 100*((scores >= cutoff) & mask).sum(axis=1) / lengths.astype(float)
+    return mean, pct
+
+def tile_keys(headers):
+    """Extract the lane and tile of each read from the headers, which can be
+    on the CASAVA 1.8+ or the CASAVA 1.7 format, as strings on the form lane:tile
+    """
+    if len(headers) == 0:
+        return []
+    if " " in headers[0]:
+        # @<instrument>:<run number>:<flowcell ID>:<lane>:<tile>:<x-pos>:<y-pos> <read>:...
+        return [":".join(h.split(":", 5)[3:5]) for h in headers]
+    # @<instrument>:<lane>:<tile>:<x-pos>:<y-pos>#<index>/<read>
+    return [":".join(h.split(":", 3)[1:3]) for h in headers]
+
+class QualityStats(object):
+    """Accumulate quality statistics over batches of reads, as returned by
+    scilifelab.utils.fastq_utils.FastQParser.batches. Each batch is processed
+    in a single pass, giving the per-read mean quality and percentage of bases
+    >= Q30, and updating the per-cycle quality histograms and the per-tile
+    quality sums.
+    """
+
+    def __init__(self, offset=33, cutoff=30):
+        self.offset = offset
+        self.cutoff = cutoff
+        self.reads = 0
+        self.bases = 0
+        self.bases_over_cutoff = 0
+        self.quality_sum = 0
+        # Number of bases with each quality (columns) in each cycle (rows)
+        self.cycle_histogram = np.zeros((0, MAX_QUALITY + 1), dtype=np.int64)
+        # The sum of qualities and number of bases, for each (lane, tile)
+        self.tiles = {}
+
+    def add(self, quals, headers=None):
+        """Add a batch of reads to the statistics. If headers are given, the
+        per-tile statistics are updated as well
+
+        :param quals: list of quality strings
+        :param headers: list of read headers, used to get lane and tile
+
+        :returns: a tuple of two float arrays, with the mean quality and the percentage
+        of bases with quality >= cutoff for each read, respectively
+        """
+        scores, mask, lengths = quality_array(quals, self.offset)
+        over = (scores >= self.cutoff) & mask
+        read_sums = scores.sum(axis=1)
+        read_over = over.sum(axis=1)
+
+        self.reads += len(quals)
+        self.bases += int(lengths.sum())
+        self.bases_over_cutoff += int(read_over.sum())
+        self.quality_sum += int(read_sums.sum())
+        self._add_cycles(scores, mask)
+        if headers is not None:
+            self._add_tiles(headers, read_sums, lengths)
+
+        flengths = lengths.astype(float)
+        return read_sums/flengths, 100*read_over/flengths
+
+    def _add_cycles(self, scores, mask):
+        ncycles, nq = scores.shape[1], MAX_QUALITY + 1
+        if ncycles > self.cycle_histogram.shape[0]:
+            grown = np.zeros((ncycles, nq), dtype=np.int64)
+            grown[0:self.cycle_histogram.shape[0]] = self.cycle_histogram
+            self.cycle_histogram = grown
+        # Count the (cycle, quality) combinations in one go
+        cells = np.arange(ncycles)*nq + np.clip(scores, 0, MAX_QUALITY)
+        counts = np.bincount(cells[mask], minlength=ncycles*nq)
+        self.cycle_histogram[0:ncycles] += counts.reshape(ncycles, nq)
+
+    def _add_tiles(self, headers, read_sums, lengths):
+        keys, inverse = np.unique(np.array(tile_keys(headers)), return_inverse=True)
+        sums = np.bincount(inverse, weights=read_sums)
+        bases = np.bincount(inverse, weights=lengths)
+        for i, key in enumerate(keys):
+            lane, tile = key.split(":")
+            s = self.tiles.setdefault((int(lane), int(tile)), [0, 0])
+            s[0] += int(sums[i])
+            s[1] += int(bases[i])
+
+    def mean_quality(self):
+        """The mean quality over all bases
+        """
+        return float(self.quality_sum)/self.bases if self.bases > 0 else 0.
+
+    def pct_over_cutoff(self):
+        """The percentage of all bases having a quality >= cutoff
+        """
+        return 100*float(self.bases_over_cutoff)/self.bases if self.bases > 0 else 0.
+
+    def cycle_mean_quality(self):
+        """The mean quality in each cycle, as an array
+        """
+        counts = self.cycle_histogram.sum(axis=1)
+        sums = (self.cycle_histogram*np.arange(MAX_QUALITY + 1)).sum(axis=1)
+        return sums/np.maximum(counts, 1).astype(float)
+
+    def tile_mean_quality(self):
+        """The mean quality in each tile, as a dict keyed by (lane, tile)
+        """
+        return dict([(k, float(s)/n) for k, (s, n) in self.tiles.items() if n > 0])
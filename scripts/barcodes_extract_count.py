@@ -6,25 +6,34 @@ import ConfigParser
 import re
 import os
 import traceback
-from scilifelab.utils.fastq_utils import BarcodeExtractor
+from functools import partial
+from scilifelab.utils.fastq_mapreduce import map_reduce, count_barcodes, merge_counters
 from scilifelab.utils.string import hamming_distance
 from scilifelab.illumina.hiseq import HiSeqRun
 from scilifelab.illumina import map_index_name
-from collections import Counter
-from itertools import imap
+from scilifelab.utils.heavy_hitters import HeavyHitterCounter
+
+# The default maximum error of the barcode counts, as a fraction of the number of reads
+ERROR_RATE = 1e-5
  
-def extract_barcodes(fqfile1, lane, fqfile2=None, nindex=25, casava18=True, offset=101, bclen=6, expected=[], mismatch=True):
-    """Parse the fastq file and extract barcodes. Return a dict structure suitable for upload to StatusDB
+def extract_barcodes(fqfile1, lane, fqfile2=None, nindex=25, casava18=True, offset=101, bclen=6, expected=[], mismatch=True, processes=1, error_rate=ERROR_RATE):
+    """Parse the fastq file and extract barcodes. Return a dict structure suitable for upload to StatusDB.
+    The barcodes are counted in chunks of the input on the specified number of processes.
+    
+    To bound the memory used, at most 1/error_rate barcodes are kept and the counts may be
+    underestimated by at most error_rate times the number of reads, see HeavyHitterCounter. 
+    The counts are exact as long as there are fewer distinct barcodes, or if error_rate is None
     """
     
-    bcx = BarcodeExtractor(fqfile1, casava18, offset, bclen)
-    c = {}
-
-    if fqfile2 is None:
-        c = Counter(bcx)
-    else:
-        bcx2 = BarcodeExtractor(fqfile2, casava18, offset, bclen)
-        c = Counter(imap(lambda x, y: x+y, bcx, bcx2))
+    inputs = [fqfile1]
+    if fqfile2 is not None:
+        inputs = [(fqfile1, fqfile2)]
+    c = HeavyHitterCounter(error_rate=error_rate)
+    c = map_reduce(inputs, 
+                   partial(count_barcodes, casava18=casava18, offset=offset, length=bclen, capacity=c.capacity), 
+                   merge_counters, 
+                   c, 
+                   processes)
 
     c = remove_expected(c,expected,mismatch)
     counts = []
@@ -132,6 +141,14 @@ def main():
     parser.add_argument('--db', action='store_true', default=False,
                         help='Will try fetch the expected barcode from StatusDB. Useful when sample has no index in samplesheet')
     parser.add_argument('--config', action='store', help="Path to PM configuration file, used to connec to StatusDB")
+    parser.add_argument('-p','--processes', action='store', type=int, default=1,
+                        help="The number of processes to use for counting the barcodes. Default is 1. "\
+                        "Single-member gzip input (as written by CASAVA) is decompressed serially by the main process")
+    parser.add_argument('-e','--error-rate', dest='error_rate', action='store', type=float, default=ERROR_RATE,
+                        help="The maximum error of the counts, as a fraction of the number of reads. " \
+                        "At most 1/error-rate barcodes are kept in memory. Default is {}".format(ERROR_RATE))
+    parser.add_argument('--exact', dest='error_rate', action='store_const', const=None,
+                        help="Count all barcodes exactly, regardless of the memory needed")
     parser.add_argument('infile1', action='store',
                         help="The input FastQ file to process. Can be gzip compressed")
     parser.add_argument('infile2', action='store', default=None, nargs='?',
@@ -160,7 +177,7 @@ def main():
         except Exception:
             traceback.print_exc()
 
-    header, counts = extract_barcodes(args.infile1, args.lane, args.infile2, int(args.nindex), args.casava18, int(args.offset), bc_length, expected, args.mismatch)
+    header, counts = extract_barcodes(args.infile1, args.lane, args.infile2, int(args.nindex), args.casava18, int(args.offset), bc_length, expected, args.mismatch, args.processes, args.error_rate)
     write_metrics(header, counts)
     
 if __name__ == "__main__":
@@ -1,7 +1,12 @@
 import os
 import sys
+import shutil
+import itertools
 import scilifelab.utils.fastq_utils as fastq_utils
+import scilifelab.utils.quality_stats as quality_stats
 import argparse
+from functools import partial
+from scilifelab.utils.fastq_mapreduce import map_reduce
 
 def main():
     
@@ -16,13 +21,16 @@ def main():
                         help="the Phred quality score offset. Default is 33 (Sanger)")
     parser.add_argument('--1.7', dest='casava17', action='store_true', default=False, 
                         help="the fastq files were generated by a Casava version < 1.8")
+    parser.add_argument('--processes', action='store', type=int, default=1, 
+                        help="the number of processes to use. Default is 1. The reads are parsed and binned by the processes, "\
+                        "but single-member gzip input (as written by CASAVA) is decompressed serially by the main process")
     parser.add_argument('fastq1', action='store', default=None, 
                         help="the first sequence file of the pair")
     parser.add_argument('fastq2', action='store', default=None, 
                         help="the second sequence file of the pair")
     
     args = parser.parse_args()
-    process_fastq(args.fastq1, args.fastq2, [int(args.threshold)], int(args.phred), args.casava17)
+    process_fastq(args.fastq1, args.fastq2, [int(args.threshold)], int(args.phred), args.casava17, args.processes)
 
 def print_average_quals(qualities):
     
@@ -34,32 +42,76 @@ def print_average_quals(qualities):
         avg_quality.insert(0,bin)
         print ",".join([str(i) for i in avg_quality])
         
-def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17):
+def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17, processes=1):
     
-    fh_r1 = fastq_utils.FastQParser(fastq_r1)
-    fh_r2 = fastq_utils.FastQParser(fastq_r2)
-    oh1 = {}
-    oh2 = {}
+    outputs = {}
     root1, ext1 = os.path.splitext(fastq_r1)
     root2, ext2 = os.path.splitext(fastq_r2)
     for b in bins:
-        oh1[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root1,b,ext1))
-        oh2[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root2,b,ext2))
+        outputs[b] = ["%s.Q%d%s" % (root1,b,ext1), "%s.Q%d%s" % (root2,b,ext2)]
     
-    for r1 in fh_r1:
-        r2 = fh_r2.next()
-        assert fastq_utils.is_read_pair(r1,r2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(r1[0],r2[0])
-
-        bin = min(int(round(fastq_utils.avgQ(r1,phred_offset))),int(round(fastq_utils.avgQ(r2,phred_offset))))
+    # Bin the chunks of the input in parallel, each chunk is written to separate part files
+    parts = map_reduce([(fastq_r1, fastq_r2)],
+                       partial(bin_chunk, outputs=outputs, bins=bins, phred_offset=phred_offset, casava17=casava17),
+                       merge_parts,
+                       {},
+                       processes)
+    
+    # Concatenate the part files, in order, into the output files. Every bin gets its
+    # output files, which are written empty if there are no parts
+    for b in bins:
+        for out in outputs[b]:
+            part_files = parts.get(out,[])
+            if len(part_files) == 0:
+                fastq_utils.FastQWriter(out).close()
+                continue
+            with open(out,"wb") as oh:
+                for part in part_files:
+                    with open(part,"rb") as ih:
+                        shutil.copyfileobj(ih,oh)
+                    os.unlink(part)
+    
+def bin_chunk(chunk, outputs, bins, phred_offset, casava17):
+    """Write the read pairs in the chunk whose average qualities are above the bin
+    thresholds to part files. Return a dict with the part file for each output file
+    """
+    oh1 = {}
+    oh2 = {}
+    for b in bins:
+        oh1[b], oh2[b] = [fastq_utils.FastQWriter(_part_name(out, chunk.number)) for out in outputs[b]]
+    
+    # Compute the average qualities for a batch of reads at a time
+    for b1, b2 in chunk.batches():
+        q1, _ = quality_stats.read_quality(b1[3],phred_offset)
+        q2, _ = quality_stats.read_quality(b2[3],phred_offset)
         
-        for b in bins:
-            if bin >= b:
-                oh1[b].write(r1)
-                oh2[b].write(r2)
+        for i, (r1, r2) in enumerate(itertools.izip(itertools.izip(*b1),itertools.izip(*b2))):
+            assert fastq_utils.is_read_pair(r1,r2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(r1[0],r2[0])
+    
+            bin = min(int(round(round(q1[i],1))),int(round(round(q2[i],1))))
+            
+            for b in bins:
+                if bin >= b:
+                    oh1[b].write(r1)
+                    oh2[b].write(r2)
         
     for oh in oh1.values() + oh2.values():
         oh.close()
+    
+    parts = {}
+    for b in bins:
+        for out in outputs[b]:
+            parts[out] = [_part_name(out, chunk.number)]
+    return parts
+
+def merge_parts(p1, p2):
+    for out, part_files in p2.items():
+        p1[out] = p1.get(out,[]) + part_files
+    return p1
 
+def _part_name(out, number):
+    root, ext = os.path.splitext(out)
+    return "%s.part%05d%s" % (root,number,ext)
 
 def quality_average(quality_str, phred_offset):
     sum = 0.
@@ -1,6 +1,7 @@
 import sys, optparse
-import gzip
 from operator import itemgetter
+from scilifelab.utils.fastq_utils import FastQParser
+from scilifelab.utils.packed_barcodes import BarcodeCounter
 
 illumina_idx = {'ATCACG':'index1', 
                 'ATCACGA':'index1', 
@@ -53,14 +54,16 @@ illumina_idx = {'ATCACG':'index1',
                 }
 
 usage = """
-Count the barcodes occurring in a FASTQ file.
+Count the barcodes occurring in one or more FASTQ files.
 Usage:
 
-python count_barcodes.py <FASTQ file (can be gzipped; make sure the file extension is .gz> [-o for "old" FASTQ files from OLB] [-s <nucleotide where the barcode starts>] [-l <length of barcode>]
+python count_barcodes.py <FASTQ file(s) (can be gzipped; make sure the file extension is .gz> [-o for "old" FASTQ files from OLB] [-s <nucleotide where the barcode starts>] [-l <length of barcode>]
 
 -o, --olb: The FASTQ file is generated by OLB or otherwise does not include the barcode in the header. Forces specification of start and length of barcode
 -s, --start: Starting position of barcode (default 101)
 -l, --length: Length of barcode (default 6)
+-d, --decompressor: Backend used for decompressing gzipped files: auto, gzip, threaded or pipe (default auto)
+-t, --threads: Number of threads used for decompression (default number of cpus)
 """
 
 if len(sys.argv) < 2:
@@ -71,38 +74,29 @@ parser = optparse.OptionParser()
 parser.add_option('-o', '--olb', action="store_true", dest="old", default="False", help="Use if the FASTQ file is generated by OLB or otherwise does not include the barcode in the header.")
 parser.add_option('-s', '--start', action="store", dest="bcstart", default="101", help="Specify starting position of barcode (default 101)")
 parser.add_option('-l', '--length', action="store", dest="bclen", default="6", help="Specify length of barcode (default 6")
+parser.add_option('-d', '--decompressor', action="store", dest="decompressor", default="auto", help="Backend used for decompressing gzipped files: auto, gzip, threaded or pipe (default auto)")
+parser.add_option('-t', '--threads', action="store", dest="threads", default=None, help="Number of threads used for decompression (default number of cpus)")
 
 (opts, args) = parser.parse_args()
     
-bcodes = {} # collect counts for all observed barcodes
+# Collect counts for all observed barcodes, in all files. The barcodes are counted 
+# in batches of reads, packed into integers
+bcodes = BarcodeCounter()
 
-gz = False
-if sys.argv[1][-2:] == 'gz': gz = True
-
-cntr = 0
-last_was_header = False
 pos = int(opts.bcstart)
 lgth = int(opts.bclen)
 
-if gz: fh = gzip.open(sys.argv[1])
-else: fh = open(sys.argv[1])
-
-if opts.old == True:    
-    for line in fh: 
-        if not last_was_header:
-            if line[0]=="@": last_was_header=True
-            continue
-        bcode = line[pos:(pos+lgth)].strip()
-        if bcodes.has_key(bcode): bcodes[bcode] += 1
-        else: bcodes[bcode] = 1
-        if last_was_header: last_was_header = False
+threads = None
+if opts.threads is not None: threads = int(opts.threads)
 
-else:
-    for line in fh:
-        if line[0:4] == "@HWI": # Header 
-            bcode = line.strip().split(':')[-1]
-            if bcodes.has_key(bcode): bcodes[bcode] += 1
-            else: bcodes[bcode] = 1
+for fname in args:
+    fqp = FastQParser(fname, decompressor=opts.decompressor, threads=threads)
+    for batch in fqp.batches():
+        if opts.old == True:
+            bcodes.add([seq[pos:(pos+lgth)] for seq in batch[1]])
+        else:
+            bcodes.add([header.split(':')[-1] for header in batch[0]])
+    fqp.close()
 
 for e in sorted(bcodes.items(), key=itemgetter(1)):
     illum = '(no exact match to Illumina)'
@@ -20,9 +20,9 @@ import sys
 import time
 
 #from Bio import Seq, pairwise2
-from scilifelab.utils.fastq_utils import FastQParser, FastQWriter
+from scilifelab.utils.fastq_utils import FastQParser, FastQWriterPool
+from scilifelab.utils.index_matcher import IndexMatcher, index_collisions
 
-# TODO memoize sequence corrections? optimize somehow if possible
 # TODO ensure read 1,2 files are paired (SciLifeLab code)
 # TODO add directory processing
 
@@ -105,103 +105,53 @@ def parse_readset_byindexdict(read_1_fq, read_2_fq, read_index_fq, index_dict, o
     print(" complete.", file=sys.stderr)
     if not progress_interval: progress_interval = 1000
     if progress_interval > (total_lines_in_file / 4): progress_interval = (total_lines_in_file / 4)
-    index_fh_dict = collections.defaultdict(list)
+    writers = FastQWriterPool()
     print("Demultiplexing...", file=sys.stderr)
     time_started = datetime.datetime.now()
+    # Precompute the lookup of every sequence within max_mismatches of the supplied indexes
+    matcher = IndexMatcher(index_dict.keys(), max_mismatches)
     for read_1, read_2, read_ind in itertools.izip(fqp_1, fqp_2, fqp_ind):
         read_ind_seq = read_ind[1]
-        matches_dict = collections.defaultdict(list)
-        # Sort indexes by descending length to match longer indexes first
-        for supplied_index in sorted(index_dict.keys(), key=lambda x: (-len(x))):
-            mismatches = find_dist(supplied_index, read_ind_seq, max_mismatches)
-            matches_dict[mismatches].append(supplied_index)
-            if mismatches == 0:
-                break
-        for x in range(0, max_mismatches+1):
-            if matches_dict.get(x):
-                if len(matches_dict.get(x)) == 1:
-                    # Single unamibiguous match
-                    index_seq       = matches_dict[x][0]
-                    index_len       = len(index_seq)
-                    molecular_tag   = read_ind_seq[index_len:]
-                    modify_reads( (read_1, read_2), index_seq, molecular_tag)
-                    sample_name     = index_dict[index_seq] if index_dict[index_seq] else index_seq
-                    data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, index_seq)
-                    num_match      += 1
-                    if not x == 0:
-                        num_corrected += 1
-                    break
-                else:
-                    # Ambiguous match
-                    sample_name     = "Ambiguous"
-                    index_seq_list  = ",".join(matches_dict.get(x))
-                    modify_reads( (read_1, read_2), index_seq_list, read_ind_seq)
-                    data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, sample_name)
-                    num_ambigmatch += 1
-                    break
-        else:
+        match = matcher.match_prefix(read_ind_seq)
+        if match is None:
             # No match
             sample_name     = "Undetermined"
             modify_reads( (read_1, read_2), "", read_ind_seq)
-            data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, sample_name)
+            data_write_loop(read_1, read_2, sample_name, output_directory, writers)
             num_nonmatch   += 1
+        elif len(match[0]) == 1:
+            # Single unamibiguous match
+            index_seq       = match[0][0]
+            index_len       = len(index_seq)
+            molecular_tag   = read_ind_seq[index_len:]
+            modify_reads( (read_1, read_2), index_seq, molecular_tag)
+            sample_name     = index_dict[index_seq] if index_dict[index_seq] else index_seq
+            data_write_loop(read_1, read_2, sample_name, output_directory, writers)
+            num_match      += 1
+            if match[1] > 0:
+                num_corrected += 1
+        else:
+            # Ambiguous match
+            sample_name     = "Ambiguous"
+            index_seq_list  = ",".join(match[0])
+            modify_reads( (read_1, read_2), index_seq_list, read_ind_seq)
+            data_write_loop(read_1, read_2, sample_name, output_directory, writers)
+            num_ambigmatch += 1
         reads_processed    += 1
         if reads_processed % progress_interval == 0:
             print_progress(reads_processed, (total_lines_in_file / 4), time_started=time_started)
+    writers.close()
     return reads_processed, num_match, num_ambigmatch, num_nonmatch, num_corrected
 
 
-def data_write_loop(read_1, read_2, sample_name, output_directory, index_fh_dict, index):
+def data_write_loop(read_1, read_2, sample_name, output_directory, writers):
     """
-    Writes data using FastQAppender, closing files if we open too many.
+    Writes data using the pool of writers, which keeps a bounded number of files open.
     """
     for read_num, read in enumerate([read_1, read_2]):
-        try:
-            index_fh_dict[index][read_num].write(read)
-        except IndexError:
-            file_path   = os.path.join(output_directory, "{sample_name}_R{read_num}.fastq".format( \
-                                                           sample_name=sample_name, read_num=read_num+1))
-            try:
-                index_fh_dict[index].append(FastQAppender(file_path))
-            except IOError as e:
-                # Too many open filehandles
-                if e.errno == 24:
-                    for fh1, fh2 in index_fh_dict.values():
-                        map(file.close, [ fh1, fh2 ] )
-                    index_fh_dict[index].append(FastQAppender(file_path))
-                    index_fh_dict[index][read_num].write(read)
-                else:
-                    raise IOError(e)
-            except ValueError:
-                # File was closed previously
-                index_fh_dict[index][read_num].reopen()
-
-# TODO make this faster
-# TODO compare to Bio.align.pairwise2 for speed
-# TODO possibly @memoize somehow
-def find_dist(str_01, str_02, max_mismatches=None, approach="shorten"):
-    """
-    Find the number of mismatches between two strings. The longer string is truncated
-    to the length of the shorter unless approach is "lengthen".
-    """
-    if len(str_01) > len(str_02):
-        if approach == "lengthen":
-            str_02 = "{:<{length}}".format(str_02, length=len(str_01))
-        else:
-            str_01 = str_01[:len(str_02)]
-    elif len(str_02) > len(str_01):
-        if approach == "lengthen":
-            str_01 = "{:<{length}}".format(str_01, length=len(str_02))
-        else:
-            str_02 = str_02[:len(str_01)]
-    mismatches = 0
-    for a, b in itertools.izip(str_01, str_02):
-        if a != b:
-            mismatches += 1
-            if max_mismatches and mismatches > max_mismatches:
-                break
-    return mismatches
-
+        file_path   = os.path.join(output_directory, "{sample_name}_R{read_num}.fastq".format( \
+                                                       sample_name=sample_name, read_num=read_num+1))
+        writers.write(file_path, read)
 
 def print_progress(processed, total, type='text', time_started=None, leading_text=""):
     """
@@ -293,9 +243,11 @@ def check_index_distances(index_list, max_mismatches):
     """
     Determines if too many mismatches are allowed for this set of indexes to resolve unambiguously.
     """
-    for i1, i2 in  itertools.combinations(index_list, r=2):
-        if find_dist(i1, i2, max_mismatches, approach="lengthen") <= max_mismatches:
-            print("Warning: indexes \"{}\" and \"{}\" are insufficiently different for the specified number of mismatches ({}). Reads matching either index will be classified as ambiguous.".format(i1, i2, max_mismatches), file=sys.stderr)
+    index_list = list(index_list)
+    _, collisions = index_collisions(index_list, max_mismatches)
+    for i, j, _ in collisions:
+        i1, i2 = index_list[i], index_list[j]
+        print("Warning: indexes \"{}\" and \"{}\" are insufficiently different for the specified number of mismatches ({}). Reads matching either index will be classified as ambiguous.".format(i1, i2, max_mismatches), file=sys.stderr)
 
 
 # TODO This doesn't really belong here and should probably be its own module
@@ -359,26 +311,6 @@ def iter_sample_fast(iterable, samplesize, total_size):
     return results
 
 
-class FastQAppender(FastQWriter):
-    """
-    A good deal like the FastQWriter but appends instead of writing.
-    Also allows file re-opening.
-    """
-    def __init__(self, file):
-        self.fname = file
-        fh = open(file,"ab")
-        if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
-        else:
-            self._fh = fh
-        self._records_written = 0
-
-    def reopen(self):
-        _records_written = self._records_written
-        self.__init__(self.fname)
-        self._records_written = _records_written
-
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
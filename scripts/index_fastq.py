@@ -0,0 +1,25 @@
+"""
+Build random-access indexes for fastq files, stored in sidecar files next to the fastq files
+"""
+import sys
+import argparse
+from scilifelab.utils.fastq_utils import FastQIndex
+
+def main():
+    
+    parser = argparse.ArgumentParser(description="Build an index of record checkpoints for each of the supplied "\
+                                     "fastq files, which can be uncompressed or gzip-compressed. The index is written "\
+                                     "to a file named as the input with the extension {} appended. Note that "\
+                                     "gzip-compressed files must be BGZF or multi-member files to allow random access".format(FastQIndex.SUFFIX))
+    parser.add_argument('-i','--interval', action='store', type=int, default=FastQIndex.INTERVAL, 
+                        help="the number of records between checkpoints. Default is {}".format(FastQIndex.INTERVAL))
+    parser.add_argument('fastq', action='store', nargs='+', 
+                        help="the fastq file(s) to index")
+    
+    args = parser.parse_args()
+    for fastq in args.fastq:
+        index = FastQIndex.build(fastq, args.interval)
+        print "{}\t{} records\t{} checkpoints\t{}".format(fastq, index.records, len(index.checkpoints), index.save())
+
+if __name__ == "__main__":
+    sys.exit(main())
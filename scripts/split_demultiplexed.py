@@ -7,11 +7,11 @@ import csv
 import re
 import operator
 from scilifelab.miseq import (MiSeqSampleSheet, group_fastq_files)
-from scilifelab.utils.fastq_utils import (FastQParser, FastQWriter)
+from scilifelab.utils.fastq_utils import (FastQParser, FastQWriterPool)
  
 from optparse import OptionParser
 
-def main(fastq_files, outdir, samplesheet):
+def main(fastq_files, outdir, samplesheet, compressor="gzip", threads=None):
     
     samples = {}
     if samplesheet:
@@ -21,9 +21,9 @@ def main(fastq_files, outdir, samplesheet):
         for i,name in enumerate(names):
             samples[str(i)] = name
             
-    _split_fastq_batches(group_fastq_files(fastq_files),outdir,samples)
+    _split_fastq_batches(group_fastq_files(fastq_files),outdir,samples,compressor,threads)
         
-def _split_fastq_batches(inputs, outdir, samples={}):
+def _split_fastq_batches(inputs, outdir, samples={}, compressor="gzip", threads=None):
             
     # Loop over the fastq files
     for fastq_files in inputs:
@@ -31,34 +31,34 @@ def _split_fastq_batches(inputs, outdir, samples={}):
         prefix = os.path.commonprefix(fastq_names).strip("_")
         suffix = os.path.commonprefix([f[::-1] for f in fastq_names])[::-1]
             
-        counts = _split_fastq(fastq_files,outdir,prefix,suffix,samples)
+        counts = _split_fastq(fastq_files,outdir,prefix,suffix,samples,compressor,threads)
             
     # Write the multiplex metrics
     prefix = os.path.commonprefix([os.path.basename(f) for f in reduce(operator.add,inputs)]).strip("_")
     metrics_file = _write_metrics(counts,outdir,prefix,samples)
     
-def _split_fastq(fastq_input, outdir, outprefix, outsuffix, samples):
+def _split_fastq(fastq_input, outdir, outprefix, outsuffix, samples, compressor="gzip", threads=None):
 
     if not os.path.exists(outdir):
         os.mkdir(outdir) 
     
-    out_handles = {}    
+    # The output is written through a pool of writers, which limits the number of open files
+    writers = FastQWriterPool(compressor=compressor,threads=threads)
+    out_files = {}
     for file in fastq_input:
         iter = FastQParser(file)
         for record in iter:
             index = record[0].rfind(":")
             i = record[0][index+1:].strip()
-            # open a file handle to the index file if it's not already available
-            if i not in out_handles:
-                out_file = os.path.join(outdir,"%s_%s%s" % (outprefix,samples.get(i,i),outsuffix))
-                out_handles[i] = FastQWriter(out_file)
-            out_handles[i].write(record)
+            if i not in out_files:
+                out_files[i] = os.path.join(outdir,"%s_%s%s" % (outprefix,samples.get(i,i),outsuffix))
+            writers.write(out_files[i],record)
+    writers.close()
     
-    # summarize the written records and close the file handles
+    # summarize the written records
     counts = {}
-    for i,oh in out_handles.items():
-        counts[i] = oh.rwritten()
-        oh.close()
+    for i,out_file in out_files.items():
+        counts[i] = writers.rwritten(out_file)
         
     return counts
     
@@ -80,6 +80,10 @@ if __name__ == "__main__":
     parser = OptionParser()
     parser.add_option("-o", "--outdir", dest="outdir", default=os.getcwd())
     parser.add_option("-s", "--samplesheet", dest="samplesheet", default={})
+    parser.add_option("-c", "--compressor", dest="compressor", default="gzip",
+                      help="Backend used for compressing gzipped output: gzip or threaded")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=None,
+                      help="Number of threads used by the threaded compressor")
     options, args = parser.parse_args()
     
-    main(args,options.outdir,options.samplesheet)
+    main(args,options.outdir,options.samplesheet,options.compressor,options.threads)
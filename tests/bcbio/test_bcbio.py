@@ -2,8 +2,12 @@ import os
 import tempfile
 import shutil
 import unittest
+import zipfile
+import numpy as np
 from ..data import data_files
-from scilifelab.bcbio.qc import RunInfoParser
+from scilifelab.bcbio.qc import interop
+from scilifelab.io.picard import read_picard_metrics
+from scilifelab.bcbio.qc import ExtendedPicardMetricsParser, RunInfoParser, SampleRunMetricsParser, FlowcellRunMetricsParser, RunDirectoryIndex, MetricsManifest, MetricsCache, DemultiplexStatsParser
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
 
@@ -13,8 +17,11 @@ class TestBcbioQC(unittest.TestCase):
     """Test for bcbio qc module"""
     def setUp(self):
         self.rootdir = tempfile.mkdtemp(prefix="test_bcbio_qc_")
+        self.cache_path = MetricsCache.default_path
+        MetricsCache.configure(path=os.path.join(self.rootdir, "cache", "metrics_cache.sqlite"))
         
     def tearDown(self):
+        MetricsCache.configure(path=self.cache_path)
         shutil.rmtree(self.rootdir)
     
     def test_parse_runinfo(self):
@@ -28,3 +35,262 @@ class TestBcbioQC(unittest.TestCase):
         self.assertEqual(res["Instrument"], "SN0002")
         self.assertEqual(res["Date"], "120924")
 
+
+    def test_find_files(self):
+        """Index the metrics files of a run by type and lane"""
+        files = ["1_120924_AC003CCCXX_nophix_3-sort-dup.align_metrics",
+                 "1_120924_AC003CCCXX_3_nophix-sort-dup.insert_metrics",
+                 "11_120924_AC003CCCXX_nophix_3-sort-dup.align_metrics",
+                 "1_120924_AC003CCCXX_nophix_3_1_screen.txt",
+                 "1_120924_AC003CCCXX_nophix.bc_metrics",
+                 "01_bcbb_checkpoint.txt",
+                 "bcbb_software_versions.txt",
+                 os.path.join("fastqc","1_120924_AC003CCCXX_nophix_3-sort-dup_fastqc","fastqc_data.txt"),
+                 os.path.join("tx","1_120924_AC003CCCXX_nophix_3-sort-dup.dup_metrics")]
+        for f in files:
+            f = os.path.join(self.rootdir, "120924_AC003CCCXX", f)
+            if not os.path.exists(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+            open(f, "w").close()
+        parser = SampleRunMetricsParser(os.path.join(self.rootdir, "120924_AC003CCCXX"))
+        names = lambda x: sorted([os.path.basename(f) for f in x])
+        self.assertEqual(len(files) - 1, len(parser.files),
+                         "The files in the ignored directory should not be collected")
+        self.assertListEqual(names([files[0], files[1]]), names(parser.find_files("picard", 1)),
+                             "The picard metrics of the lane did not match expected")
+        self.assertListEqual(names(files[2:3]), names(parser.find_files("picard", 11)),
+                             "The picard metrics of lane 11 did not match expected")
+        self.assertListEqual(names(files[0:1]), names(parser.find_files("picard", "1", "align_metrics")),
+                             "The files were not filtered on the pattern")
+        self.assertListEqual([files[5]], names(parser.find_files("checkpoint")))
+        self.assertListEqual([files[6]], names(parser.find_files(name="bcbb_software_versions.txt")))
+        self.assertListEqual(["fastqc_data.txt"], names(parser.find_files("fastqc", 1)))
+        self.assertListEqual([], parser.find_files("bc", 2))
+
+    def test_shared_index(self):
+        """Share one index of a run directory between parsers"""
+        fcdir = os.path.join(self.rootdir, "120924_AC003CCCXX")
+        files = ["1_120924_AC003CCCXX_nophix_3-sort-dup.align_metrics",
+                 os.path.join("Data","reports","Summary","read1.xml")]
+        for f in files:
+            f = os.path.join(fcdir, f)
+            if not os.path.exists(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+            open(f, "w").close()
+        index = RunDirectoryIndex(fcdir)
+        fc_parser = FlowcellRunMetricsParser(fcdir, index)
+        parser = SampleRunMetricsParser(fcdir, index)
+        self.assertIs(fc_parser.index, parser.index)
+        self.assertListEqual([os.path.join(fcdir, files[1])], parser.find_files(ext=".xml"))
+        self.assertListEqual([os.path.join(fcdir, files[0])], parser.find_files("picard", 1))
+        with self.assertRaises(ValueError):
+            SampleRunMetricsParser(os.path.join(fcdir, "Data"), index)
+
+    def test_manifest(self):
+        """Parse unchanged files and push unchanged documents only once"""
+        f = os.path.join(self.rootdir, "1_120924_AC003CCCXX_nophix.bc_metrics")
+        with open(f, "w") as fh:
+            fh.write("1\t100\n")
+        parsed = []
+        def parse(files):
+            parsed.append(files)
+            with open(files[0]) as fh:
+                return {"count": int(fh.read().split()[1])}
+        manifest_file = os.path.join(self.rootdir, "manifest", "120924_AC003CCCXX.json")
+        manifest = MetricsManifest(manifest_file)
+        self.assertEqual({"count": 100}, manifest.parse("bc_metrics", [f], parse))
+        self.assertEqual({"count": 100}, manifest.parse("bc_metrics", [f], parse))
+        self.assertEqual(1, len(parsed))
+        doc = {"_id": "1", "entity_type": "sample_run_metrics", "name": "1_120924_AC003CCCXX_TGACCA", "bc_count": 100}
+        self.assertTrue(manifest.changed(doc))
+        manifest.pushed(doc)
+        manifest.save()
+
+        # Reload the manifest; a document with a new _id but the same contents is unchanged
+        manifest = MetricsManifest(manifest_file)
+        doc["_id"] = "2"
+        self.assertFalse(manifest.changed(doc))
+        # A new modification time, but the same contents, does not require parsing
+        os.utime(f, (0, 0))
+        self.assertEqual({"count": 100}, manifest.parse("bc_metrics", [f], parse))
+        self.assertEqual(1, len(parsed))
+        # Changed contents are parsed again
+        with open(f, "w") as fh:
+            fh.write("1\t200\n")
+        self.assertEqual({"count": 200}, manifest.parse("bc_metrics", [f], parse))
+        self.assertEqual(2, len(parsed))
+        doc["bc_count"] = 200
+        self.assertTrue(manifest.changed(doc))
+
+    def test_illumina_metrics(self):
+        """Parse the RTA xml files in Data/reports, with the chart values as arrays"""
+        fcdir = os.path.join(self.rootdir, "120924_AC003CCCXX")
+        reports = os.path.join(fcdir, "Data", "reports")
+        for d in ["Summary", "ErrorRate"]:
+            if not os.path.exists(os.path.join(reports, d)):
+                os.makedirs(os.path.join(reports, d))
+        with open(os.path.join(reports, "Summary", "read1.xml"), "w") as fh:
+            fh.write('<Summary Read="1" ReadType="Sequencing"><Lane key="1" ErrRatePhiX="0.25"/><Lane key="2" ErrRatePhiX="0.30"/></Summary>')
+        with open(os.path.join(reports, "NumClusters By Lane.xml"), "w") as fh:
+            fh.write('<Data><Lane key="1" ClustersRaw="100"/></Data>')
+        for cycle, values in [(1, ["0.1", "NaN"]), (2, ["0.2", "0.3"])]:
+            with open(os.path.join(reports, "ErrorRate", "Chart_{}.xml".format(cycle)), "w") as fh:
+                fh.write('<Chart><FlowCellData NumLanes="2" /><Layout RowsPerLane="1" ColsPerLane="2" />'
+                         '<TL Key="1_1" Val="{}"/><TL Key="2_2" Val="{}"/></Chart>'.format(*values))
+        with open(os.path.join(fcdir, "Data", "ignored.xml"), "w") as fh:
+            fh.write('<Summary/>')
+        parser = FlowcellRunMetricsParser(fcdir)
+        metrics = parser.parse_illumina_metrics()
+        self.assertEqual("0.25", metrics["Summary"]["read1"]["1"]["ErrRatePhiX"])
+        self.assertEqual("Sequencing", metrics["Summary"]["read1"]["ReadType"])
+        self.assertEqual("100", metrics["NumClusters"]["NumClusters By Lane"]["1"]["ClustersRaw"])
+        self.assertNotIn("ErrorRate", metrics)
+        for processes in [1, 2]:
+            metrics = parser.parse_illumina_metrics(fullRTA=True, processes=processes)
+            chart = metrics["ErrorRate"]
+            self.assertListEqual(["1", "2"], chart.charts)
+            self.assertEqual((2, 2), chart.lanes[1].shape)
+            self.assertListEqual([0.1, 0.2], list(chart.lanes[1][0]))
+            self.assertTrue(np.isnan(chart.lanes[1][1]).all())
+            self.assertTrue(np.isnan(chart.lanes[2][1][0]))
+            self.assertEqual({"1": None, "2": 0.3}, chart.as_dict()["2_2"])
+            self.assertIsNone(metrics["FWHM"])
+
+    def test_interop_metrics(self):
+        """Aggregate the InterOp binary metrics by lane and read"""
+        fcdir = os.path.join(self.rootdir, "120924_AC003CCCXX")
+        os.makedirs(os.path.join(fcdir, "InterOp"))
+        def write(name, header, records):
+            with open(os.path.join(fcdir, "InterOp", name), "wb") as fh:
+                fh.write(bytearray(header))
+                records.tofile(fh)
+        # Two tiles of lane 1, with the error rates and quality scores of read 1 (cycles 1-2) and the index read (cycle 3)
+        errors = np.zeros(6, dtype=interop.ERROR_DTYPES[3])
+        errors["lane"] = 1
+        errors["tile"] = [1101, 1101, 1101, 1102, 1102, 1102]
+        errors["cycle"] = [1, 2, 3, 1, 2, 3]
+        errors["error_rate"] = [0.1, 0.3, 1.0, 0.2, float("nan"), 3.0]
+        write(interop.ERROR_METRICS, [3, 30], errors)
+        quality = np.zeros(2, dtype=np.dtype(interop._CYCLE + [("counts", "<u4", (50,))]))
+        quality["lane"] = 1
+        quality["cycle"] = [1, 3]
+        quality["counts"][0, 39] = 3
+        quality["counts"][0, 19] = 1
+        quality["counts"][1, 29] = 2
+        write(interop.QUALITY_METRICS, [4, 206], quality)
+        tiles = np.zeros(4, dtype=interop.TILE_DTYPES[2])
+        tiles["lane"] = 1
+        tiles["code"] = [interop.CLUSTER_DENSITY, interop.CLUSTER_DENSITY, interop.CLUSTER_COUNT, interop.CLUSTER_COUNT_PF]
+        tiles["value"] = [500, 700, 1000, 900]
+        write(interop.TILE_METRICS, [2, 10], tiles)
+        reads = [{"Number": "1", "NumCycles": "2", "IsIndexedRead": "N"}, {"Number": "2", "NumCycles": "1", "IsIndexedRead": "Y"}]
+        parser = FlowcellRunMetricsParser(fcdir)
+        self.assertEqual(6, len(parser.interop_metrics(reads).error_metrics))
+        metrics = parser.parse_interop_metrics(reads)
+        self.assertAlmostEqual(600.0, metrics["1"]["ClusterDensity"])
+        self.assertAlmostEqual(90.0, metrics["1"]["PercentPF"])
+        self.assertAlmostEqual(0.2, metrics["1"]["Reads"]["1"]["ErrorRate"], places=5)
+        self.assertAlmostEqual(2.0, metrics["1"]["Reads"]["2"]["ErrorRate"], places=5)
+        self.assertAlmostEqual(75.0, metrics["1"]["Reads"]["1"]["PercentQ30"])
+        self.assertAlmostEqual(100.0, metrics["1"]["Reads"]["2"]["PercentQ30"])
+        self.assertEqual("Y", metrics["1"]["Reads"]["2"]["IsIndexedRead"])
+        self.assertEqual({}, FlowcellRunMetricsParser(self.rootdir).parse_interop_metrics(reads))
+        # Empty files and files of unsupported versions are skipped with a warning
+        write(interop.ERROR_METRICS, [], np.zeros(0, dtype=interop.ERROR_DTYPES[3]))
+        with self.assertRaises(interop.InterOpError):
+            parser.interop_metrics(reads).error_metrics
+        self.assertEqual({}, parser.parse_interop_metrics(reads))
+        write(interop.ERROR_METRICS, [3, 30], errors)
+        write(interop.TILE_METRICS, [3, 10], tiles)
+        with self.assertRaises(interop.InterOpError):
+            parser.interop_metrics(reads).tile_metrics
+        self.assertEqual({}, parser.parse_interop_metrics(reads))
+
+    def test_picard_metrics(self):
+        """Parse picard metrics with typed columns and a view of the cells as read"""
+        f = os.path.join(self.rootdir, "1_120924_AC003CCCXX_nophix_3-sort-dup.insert_metrics")
+        with open(f, "w") as fh:
+            fh.write("## net.sf.picard.metrics.StringHeader\n"
+                     "# net.sf.picard.analysis.CollectInsertSizeMetrics INPUT=in.bam\n\n"
+                     "## METRICS CLASS\tnet.sf.picard.analysis.InsertSizeMetrics\n"
+                     "MEDIAN_INSERT_SIZE\tMEAN_INSERT_SIZE\tPAIR_ORIENTATION\tSAMPLE\n"
+                     "180\t183,5\tFR\t\n\n"
+                     "## HISTOGRAM\tjava.lang.Integer\n"
+                     "insert_size\tAll_Reads.fr_count\n"
+                     "100\t1\n101\t3\n\n")
+        metrics = read_picard_metrics(f)
+        self.assertEqual("# net.sf.picard.analysis.CollectInsertSizeMetrics INPUT=in.bam", metrics.command)
+        self.assertListEqual([{"MEDIAN_INSERT_SIZE": 180, "MEAN_INSERT_SIZE": 183.5, "PAIR_ORIENTATION": "FR", "SAMPLE": ""}],
+                             metrics.records())
+        self.assertEqual(np.int64, metrics.histogram["All_Reads.fr_count"].dtype)
+        self.assertListEqual([100, 101], list(metrics.histogram["insert_size"]))
+        with open(f) as fh:
+            parsed = ExtendedPicardMetricsParser()._parse_insert_metrics(fh)
+        self.assertEqual("183,5", parsed["metrics"]["MEAN_INSERT_SIZE"])
+        self.assertDictEqual({"insert_size": ["100", "101"], "All_Reads.fr_count": ["1", "3"]}, parsed["hist"])
+        self.assertEqual(metrics.command, parsed["command"])
+
+    def test_fastqc_zip(self):
+        """Read the FastQC metrics of a sample from a zip archive without extracting it"""
+        fcdir = os.path.join(self.rootdir, "120924_AC003CCCXX")
+        os.makedirs(os.path.join(fcdir, "fastqc"))
+        fastqc_zip = os.path.join(fcdir, "fastqc", "1_120924_AC003CCCXX_nophix_3-sort-dup_fastqc.zip")
+        with zipfile.ZipFile(fastqc_zip, "w") as zf:
+            zf.writestr("1_120924_AC003CCCXX_nophix_3-sort-dup_fastqc/fastqc_data.txt",
+                        "##FastQC\t0.10.1\n>>Basic Statistics\tpass\n#Measure\tValue\t\nTotal Sequences\t1000\n"
+                        "Sequence length\t101\n>>END_MODULE\n>>Kmer Content\tpass\n>>END_MODULE\n"
+                        ">>Per base N content\tpass\n#Base\tN-Count\n1\t0.0\n2\t0.1\n>>END_MODULE\n")
+        parser = SampleRunMetricsParser(fcdir)
+        self.assertListEqual([fastqc_zip], parser.find_files("fastqc", 1))
+        stats = parser.read_fastqc_metrics("P001_101_index3", "J.Doe_00_01", "1", "120924_AC003CCCXX", "3")["stats"]
+        self.assertDictEqual({"Measure": ["Total Sequences", "Sequence length"], "Value": ["1000", "101"]}, stats["Basic Statistics"])
+        self.assertDictEqual({"Base": ["1", "2"], "N-Count": ["0.0", "0.1"]}, stats["Per base N content"])
+        self.assertDictEqual({}, stats["Kmer Content"])
+        self.assertDictEqual({}, stats["Sequence Duplication Levels"])
+
+    def test_metrics_cache(self):
+        """Parse unchanged files once, evicting the least recently used results"""
+        f = os.path.join(self.rootdir, "1_120924_AC003CCCXX_nophix.bc_metrics")
+        with open(f, "w") as fh:
+            fh.write("1\t100\n")
+        parsed = []
+        def parse(files):
+            parsed.append(files)
+            with open(files[0]) as fh:
+                return {"count": int(fh.read().split()[1])}
+        cache = MetricsCache(os.path.join(self.rootdir, "cache", "test.sqlite"), max_size=40)
+        self.assertEqual({"count": 100}, cache.parse("bc_metrics", [f], parse))
+        self.assertEqual({"count": 100}, MetricsCache(cache.path).parse("bc_metrics", [f], parse))
+        self.assertEqual(1, len(parsed))
+        # A new modification time requires parsing
+        os.utime(f, (0, 0))
+        self.assertEqual({"count": 100}, cache.parse("bc_metrics", [f], parse))
+        self.assertEqual(2, len(parsed))
+        # The results of another parser are stored apart, and evict the least recently used result
+        self.assertEqual({"count": 100}, cache.parse("filter_metrics", [f], parse))
+        self.assertEqual({"count": 100}, cache.parse("other_metrics", [f], parse))
+        self.assertEqual(4, len(parsed))
+        self.assertEqual({"count": 100}, cache.parse("other_metrics", [f], parse))
+        self.assertEqual({"count": 100}, cache.parse("bc_metrics", [f], parse))
+        self.assertEqual(5, len(parsed))
+
+        # The parsers use the shared cache, unless it is disabled
+        parser = FlowcellRunMetricsParser(self.rootdir)
+        parser.parse_bc_metrics("AC003CCCXX")
+        self.assertTrue(os.path.exists(MetricsCache.default_path))
+        MetricsCache.configure(enabled=False)
+        self.assertIsNone(MetricsCache.shared())
+        MetricsCache.configure(enabled=True)
+        self.assertIsNotNone(MetricsCache.shared())
+
+    def test_demultiplex_stats_parser(self):
+        """Collect the cells of the tables in a Demultiplex_Stats.htm document"""
+        temp = tempfile.TemporaryFile(mode="w+t")
+        temp.write("""<html><body><table><col width="4%"><tr><th>Lane</th><th>% of &gt;= Q30</th></tr></table>
+<table><tr><td>1</td><td><b>90.05</b></td></tr><tr><td></td><td>a<br>b</td></tr></table>
+<table><tr><th>Sample<p></p>ID</th></tr></table></body></html>""")
+        temp.seek(0)
+        parser = DemultiplexStatsParser().parse(temp)
+        self.assertListEqual([["Lane", "% of >= Q30"], ["None"]], parser.header_rows)
+        self.assertListEqual([[]], parser.tables[0])
+        self.assertListEqual([["1", "90.05"], ["None", "None"]], parser.tables[1])
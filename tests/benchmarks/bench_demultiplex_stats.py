@@ -0,0 +1,88 @@
+"""Benchmark the parsing of a large Demultiplex_Stats.htm file, comparing the
+single pass DemultiplexStatsParser with the previous BeautifulSoup implementation
+
+usage:
+    python tests/benchmarks/bench_demultiplex_stats.py [number of samples per lane]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from bs4 import BeautifulSoup
+from scilifelab.bcbio.qc import FlowcellRunMetricsParser
+import tests.generate_test_data as td
+
+BC_HEADER = ['Lane', 'Sample ID', 'Sample Ref', 'Index', 'Description', 'Control', 'Project', 'Yield (Mbases)', '% PF', '# Reads', '% of raw clusters per lane', '% Perfect Index Reads', '% One Mismatch Reads (Index)', '% of &gt;= Q30 Bases (PF)', 'Mean Quality Score (PF)']
+SMP_HEADER = ['Sample<p></p>ID', 'Recipe', 'Operator', 'Directory']
+
+def _table(header, rows):
+    cols = "\n".join(["<col>" for h in header])
+    head = "<div ID=\"ScrollableTableHeaderDiv\"><table width=\"100%\">\n{}\n<tr>\n{}\n</tr>\n</table></div>\n".format(cols, "\n".join(["<th>{}</th>".format(h) for h in header]))
+    body = "\n".join(["<tr>\n{}\n</tr>".format("\n".join(["<td>{}</td>".format(c) for c in row])) for row in rows])
+    return head + "<div ID=\"ScrollableTableBodyDiv\"><table width=\"100%\">\n{}\n{}\n</table></div>\n".format(cols, body)
+
+def generate_demultiplex_stats(fname, nsamples, nlanes=8):
+    """Write a Demultiplex_Stats.htm file with nsamples samples in each of nlanes lanes
+    """
+    bc_rows = []
+    smp_rows = []
+    for lane in xrange(1, nlanes+1):
+        for n in xrange(nsamples):
+            sample = "P001_{}".format(101 + n)
+            index = td.generate_barcode()
+            reads = random.randint(0, 100000000)
+            bc_rows.append([lane, sample, "hg19", index, "J__Doe_00_01", "N", "J__Doe_00_01", "{:,}".format(reads/100000),
+                            "100.00", "{:,}".format(reads), "0.50", "98.12", "1.88", "91.03", "36.01"])
+            smp_rows.append([sample, "R1", "NN", "/srv/illumina/Unaligned/Project_J__Doe_00_01/Sample_{}".format(sample)])
+    with open(fname, "w") as fh:
+        fh.write("<!DOCTYPE html PUBLIC \"-//W3C//DTD HTML 4.01 Transitional//EN\">\n<html>\n<body>\n<h1>Flowcell: AC003CCCXX</h1>\n")
+        fh.write("<h2>Barcode lane statistics</h2>\n")
+        fh.write(_table(BC_HEADER, bc_rows))
+        fh.write("<p></p>\n<h2>Sample information</h2>\n")
+        fh.write(_table(SMP_HEADER, smp_rows))
+        fh.write("<p>bcl2fastq-1.8.3</p>\n</body>\n</html>\n")
+
+def read_soup(htm_file):
+    """The previous implementation, building a BeautifulSoup tree for the headers and for each table
+    """
+    metrics = {}
+    with open(htm_file) as fh:
+        htm_doc = fh.read()
+    soup = BeautifulSoup(htm_doc)
+    allrows = soup.findAll("tr")
+    headers = [h for h in (row.findAll("th") for row in allrows) if h]
+    bc_header = [str(x.string) for x in headers[0]]
+    smp_header = [str(x.string) for x in headers[1]]
+    smp_header[0] = "Sample ID"
+    soup = BeautifulSoup(htm_doc)
+    rows = soup.findAll("table")[1].findAll("tr")
+    parse_row = lambda row: {bc_header[i]:str(row[i].string) for i in range(0, len(bc_header)) if row}
+    metrics["Barcode_lane_statistics"] = map(parse_row, (row.findAll("td") for row in rows))
+    soup = BeautifulSoup(htm_doc)
+    rows = soup.findAll("table")[3].findAll("tr")
+    parse_row = lambda row: {smp_header[i]:str(row[i].string) for i in range(0, len(smp_header)) if row}
+    metrics["Sample_information"] = map(parse_row, (row.findAll("td") for row in rows))
+    return metrics
+
+def read_parser(htm_file):
+    return FlowcellRunMetricsParser(None)._read_demultiplex_stats_htm(htm_file)
+
+def main(nsamples=1000):
+    tmpdir = tempfile.mkdtemp(prefix="bench_demultiplex_stats_")
+    try:
+        fname = os.path.join(tmpdir, "Demultiplex_Stats.htm")
+        generate_demultiplex_stats(fname, nsamples)
+        results = []
+        for name, fn in [("BeautifulSoup", read_soup), ("DemultiplexStatsParser", read_parser)]:
+            start = time.time()
+            results.append(fn(fname))
+            elapsed = time.time() - start
+            print "{:<25} {:>8} rows {:>8.2f} s".format(name, len(results[-1]["Barcode_lane_statistics"]), elapsed)
+        assert results[0] == results[1], "The parsed metrics differ"
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,81 @@
+"""Benchmark the throughput of FastQParser on plain and gzipped fastq files
+
+usage:
+    python tests/benchmarks/bench_fastq_parser.py [number of records]
+"""
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+import scilifelab.utils.fastq_utils as fu
+import tests.generate_test_data as td
+
+def generate_fastq(fname, nrecords):
+    """Write nrecords synthetic records, repeating a pool of random records
+    """
+    pool = ["\n".join(td.generate_fastq_record()) for n in xrange(1000)]
+    with open(fname,"wb") as fh:
+        if fname.endswith(".gz"):
+            fh = gzip.GzipFile(fileobj=fh)
+        for n in xrange(nrecords):
+            fh.write("{}\n".format(pool[n % len(pool)]))
+        fh.close()
+
+class LineParser:
+    """The previous FastQParser implementation, reading one line at a time
+    """
+    def __init__(self, fname):
+        fh = open(fname,"rb")
+        if fname.endswith(".gz"):
+            fh = gzip.GzipFile(fileobj=fh)
+        self._fh = fh
+        self._records_read = 0
+        
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        self._records_read += 1
+        return [self._fh.next().strip() for n in range(4)]
+    
+def read_lines(fname):
+    fqp = LineParser(fname)
+    for record in fqp:
+        pass
+    return fqp._records_read - 1
+
+def read_records(fname, decompressor="gzip"):
+    fqp = fu.FastQParser(fname, decompressor=decompressor)
+    for record in fqp:
+        pass
+    return fqp.rread()
+
+def read_batches(fname, decompressor="gzip"):
+    fqp = fu.FastQParser(fname, decompressor=decompressor)
+    for batch in fqp.batches():
+        pass
+    return fqp.rread()
+
+def main(nrecords=1000000):
+    tmpdir = tempfile.mkdtemp(prefix="bench_fastq_parser_")
+    try:
+        for ext in [".fastq", ".fastq.gz"]:
+            fname = os.path.join(tmpdir,"bench{}".format(ext))
+            generate_fastq(fname, nrecords)
+            benchmarks = [("line-by-line", read_lines, []),
+                          ("FastQParser.next", read_records, []),
+                          ("FastQParser.batches", read_batches, [])]
+            if ext.endswith(".gz"):
+                benchmarks += [("FastQParser.batches [{}]".format(d), read_batches, [d]) for d in ["threaded", "pipe"]]
+            for name, fn, args in benchmarks:
+                start = time.time()
+                n = fn(fname, *args)
+                elapsed = time.time() - start
+                print "{:<10} {:<30} {:>10} records {:>8.2f} s {:>12.0f} records/s".format(ext, name, n, elapsed, n/elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
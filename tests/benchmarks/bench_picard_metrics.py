@@ -0,0 +1,157 @@
+"""Benchmark the parsing of the hs, insert and dup picard metrics of a project,
+comparing PicardMetrics with the previous line by line parsers of
+ExtendedPicardMetricsParser and scilifelab.io.pandas.picard
+
+usage:
+    python tests/benchmarks/bench_picard_metrics.py [number of samples]
+"""
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from scilifelab.io.picard import PicardMetrics
+
+HS_HEADER = ['BAIT_SET', 'GENOME_SIZE', 'BAIT_TERRITORY', 'TARGET_TERRITORY', 'BAIT_DESIGN_EFFICIENCY', 'TOTAL_READS', 'PF_READS',
+             'PF_UNIQUE_READS', 'PCT_PF_READS', 'PCT_PF_UQ_READS', 'PF_UQ_READS_ALIGNED', 'PCT_PF_UQ_READS_ALIGNED', 'PF_UQ_BASES_ALIGNED',
+             'ON_BAIT_BASES', 'NEAR_BAIT_BASES', 'OFF_BAIT_BASES', 'ON_TARGET_BASES', 'PCT_SELECTED_BASES', 'PCT_OFF_BAIT',
+             'ON_BAIT_VS_SELECTED', 'MEAN_BAIT_COVERAGE', 'MEAN_TARGET_COVERAGE', 'PCT_USABLE_BASES_ON_BAIT', 'PCT_USABLE_BASES_ON_TARGET',
+             'FOLD_ENRICHMENT', 'ZERO_CVG_TARGETS_PCT', 'FOLD_80_BASE_PENALTY', 'PCT_TARGET_BASES_2X', 'PCT_TARGET_BASES_10X',
+             'PCT_TARGET_BASES_20X', 'PCT_TARGET_BASES_30X', 'HS_LIBRARY_SIZE', 'HS_PENALTY_10X', 'HS_PENALTY_20X', 'HS_PENALTY_30X',
+             'AT_DROPOUT', 'GC_DROPOUT', 'SAMPLE', 'LIBRARY', 'READ_GROUP']
+INSERT_HEADER = ['MEDIAN_INSERT_SIZE', 'MEDIAN_ABSOLUTE_DEVIATION', 'MIN_INSERT_SIZE', 'MAX_INSERT_SIZE', 'MEAN_INSERT_SIZE',
+                 'STANDARD_DEVIATION', 'READ_PAIRS', 'PAIR_ORIENTATION', 'WIDTH_OF_10_PERCENT', 'WIDTH_OF_20_PERCENT',
+                 'WIDTH_OF_30_PERCENT', 'WIDTH_OF_40_PERCENT', 'WIDTH_OF_50_PERCENT', 'WIDTH_OF_60_PERCENT', 'WIDTH_OF_70_PERCENT',
+                 'WIDTH_OF_80_PERCENT', 'WIDTH_OF_90_PERCENT', 'WIDTH_OF_99_PERCENT', 'SAMPLE', 'LIBRARY', 'READ_GROUP']
+DUP_HEADER = ['LIBRARY', 'UNPAIRED_READS_EXAMINED', 'READ_PAIRS_EXAMINED', 'UNMAPPED_READS', 'UNPAIRED_READ_DUPLICATES',
+              'READ_PAIR_DUPLICATES', 'READ_PAIR_OPTICAL_DUPLICATES', 'PERCENT_DUPLICATION', 'ESTIMATED_LIBRARY_SIZE']
+
+def _value(column):
+    if column in ("SAMPLE", "LIBRARY", "READ_GROUP"):
+        return ""
+    if column in ("BAIT_SET",):
+        return "agilent_sureselect"
+    if column == "PAIR_ORIENTATION":
+        return "FR"
+    if column.startswith("PCT") or column.startswith("MEAN") or column.startswith("PERCENT") or column in ("FOLD_ENRICHMENT", "STANDARD_DEVIATION"):
+        return "{:.6f}".format(random.random()).replace(".", ",")
+    return str(random.randint(0, 100000000))
+
+def _write_metrics(fname, command, metrics_class, header, histogram=None):
+    with open(fname, "w") as fh:
+        fh.write("## net.sf.picard.metrics.StringHeader\n# {} INPUT=sample.bam\n".format(command))
+        fh.write("## net.sf.picard.metrics.StringHeader\n# Started on: Mon Sep 24 10:00:00 CEST 2012\n\n")
+        fh.write("## METRICS CLASS\t{}\n{}\n{}\n\n".format(metrics_class, "\t".join(header), "\t".join([_value(h) for h in header])))
+        if histogram is not None:
+            fh.write("## HISTOGRAM\tjava.lang.Integer\n{}\n".format("\t".join(histogram[0])))
+            fh.write("".join(["{}\n".format("\t".join(row)) for row in histogram[1]]))
+            fh.write("\n")
+
+def generate_project(outdir, nsamples):
+    """Write the hs, insert and dup metrics of nsamples samples, returning the file names"""
+    files = []
+    for n in xrange(nsamples):
+        prefix = os.path.join(outdir, "1_120924_AC003CCCXX_{}-sort-dup".format(n + 1))
+        _write_metrics(prefix + ".hs_metrics", "net.sf.picard.analysis.directed.CalculateHsMetrics",
+                       "net.sf.picard.analysis.directed.HsMetrics", HS_HEADER)
+        _write_metrics(prefix + ".insert_metrics", "net.sf.picard.analysis.CollectInsertSizeMetrics",
+                       "net.sf.picard.analysis.InsertSizeMetrics", INSERT_HEADER,
+                       (["insert_size", "All_Reads.fr_count"], [[str(i), str(random.randint(0, 100000))] for i in xrange(20, 1000)]))
+        _write_metrics(prefix + ".dup_metrics", "net.sf.picard.sam.MarkDuplicates",
+                       "net.sf.picard.sam.DuplicationMetrics", DUP_HEADER,
+                       (["BIN", "VALUE"], [["{}.0".format(i), "{:.6f}".format(random.random() * i)] for i in xrange(1, 101)]))
+        files.extend([prefix + ext for ext in (".hs_metrics", ".insert_metrics", ".dup_metrics")])
+    return files
+
+## The previous implementations
+def _readline_metrics(in_handle):
+    while 1:
+        line = in_handle.readline()
+        if line.startswith("# net.sf.picard.analysis") or line.startswith("# net.sf.picard.sam"):
+            break
+    command = line.rstrip("\n")
+    while 1:
+        line = in_handle.readline()
+        if line.startswith("## METRICS"):
+            break
+    header = in_handle.readline().rstrip("\n").split("\t")
+    info = in_handle.readline().rstrip("\n").split("\t")
+    vals = dict([(header[i], info[i]) for i in range(len(header))])
+    while 1:
+        line = in_handle.readline()
+        if line.startswith("## HISTOGRAM"):
+            break
+        if not line:
+            return dict(command=command, metrics=vals, hist=None)
+    labels = in_handle.readline().rstrip("\n").split("\t")
+    hist = dict([[x, []] for x in labels])
+    while 1:
+        info = in_handle.readline().rstrip("\n").split("\t")
+        if len(info) < len(labels):
+            break
+        for i in range(0, len(labels)):
+            hist[labels[i]].append(info[i])
+    return dict(command=command, metrics=vals, hist=hist)
+
+def _convert_input(x):
+    if re.match("^[0-9]+$", x):
+        return int(x)
+    elif re.match("^[0-9,.]+$", x):
+        return float(x.replace(",", "."))
+    else:
+        return str(x)
+
+def _convert_rows(f):
+    with open(f) as fh:
+        data = fh.readlines()
+    i = [n for n, x in enumerate(data) if "## HISTOGRAM" in x]
+    i = i[0] if i else len(data)
+    metrics = [[_convert_input(y) for y in x.rstrip("\n").split("\t")] for x in data[0:i] if not re.match("^[ #\n]", x)]
+    hist = [[_convert_input(y) for y in x.rstrip("\n").split("\t")] for x in data[i:] if not re.match("^[ #\n]", x)]
+    return metrics, hist
+
+def read_statusdb_readline(f):
+    with open(f) as fh:
+        return _readline_metrics(fh)
+
+def read_statusdb_picard(f):
+    with open(f) as fh:
+        metrics = PicardMetrics().parse(fh)
+    return dict(command=metrics.command, metrics=metrics.metrics_dicts()[0], hist=metrics.histogram_dict())
+
+def read_typed_cells(f):
+    return _convert_rows(f)
+
+def read_typed_picard(f):
+    with open(f) as fh:
+        metrics = PicardMetrics().parse(fh)
+    return metrics.metrics_columns(), metrics.histogram
+
+def _time(fn, files):
+    start = time.time()
+    results = [fn(f) for f in files]
+    return results, time.time() - start
+
+def main(nsamples=96):
+    tmpdir = tempfile.mkdtemp(prefix="bench_picard_metrics_")
+    try:
+        files = generate_project(tmpdir, nsamples)
+        for name, old, new in [("statusdb documents", read_statusdb_readline, read_statusdb_picard),
+                               ("typed columns", read_typed_cells, read_typed_picard)]:
+            old_results, old_elapsed = _time(old, files)
+            new_results, new_elapsed = _time(new, files)
+            print "{:<20} {:>6} files  line by line {:>8.3f} s  PicardMetrics {:>8.3f} s".format(name, len(files), old_elapsed, new_elapsed)
+            if name == "statusdb documents":
+                assert old_results == new_results, "The parsed documents differ"
+            else:
+                for (metrics, hist), (columns, histogram) in zip(old_results, new_results):
+                    assert metrics[1] == [columns[h][0].item() for h in metrics[0]], "The parsed metrics differ"
+                    if hist:
+                        assert [row[-1] for row in hist[1:]] == list(histogram[hist[0][-1]]), "The parsed histograms differ"
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
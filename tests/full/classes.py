@@ -3,6 +3,7 @@ import os
 from cement.core import backend, handler, output
 from cement.utils import test
 from scilifelab.pm import PmApp
+from scilifelab.bcbio.qc import MetricsCache
 
 filedir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
 
@@ -13,7 +14,7 @@ config_defaults['project']['root']  = os.path.join(filedir, "data", "projects")
 config_defaults['project']['repos']  = os.path.join(filedir, "data", "repos")
 config_defaults['runqc']['root']  = os.path.join(filedir, "data", "archive")
 config_defaults['runqc']['production']  = os.path.join(filedir, "data", "production")
-config_defaults['runqc']['rsync_sample_opts'] = "-amnv  --include=*/ --include='[0-9][0-9]_\*.txt' --include='bcbb_software_versions.txt' --include='*.yaml*' --include='*screen.txt' --include='*summary.txt' --include='*fastqc_data.txt' --include='*metrics' --exclude='tmp' --exclude='*'"
+config_defaults['runqc']['rsync_sample_opts'] = "-amnv  --include=*/ --include='[0-9][0-9]_\*.txt' --include='bcbb_software_versions.txt' --include='*.yaml*' --include='*screen.txt' --include='*summary.txt' --include='*fastqc_data.txt' --include='*_fastqc.zip' --include='*metrics' --exclude='tmp' --exclude='*'"
 config_defaults['config']['ignore'] = ["slurm*", "tmp*"]
 config_defaults['log']['level']  = "INFO"
 config_defaults['log']['file']  = os.path.join(filedir, "data", "log", "pm.log")
@@ -24,6 +25,9 @@ config_defaults['db']['samples'] = "samples-test"
 config_defaults['db']['flowcells'] = "flowcells-test"
 config_defaults['db']['projects'] = "projects-test"
 
+## Keep the parsed metrics cache out of the home directory
+MetricsCache.configure(path=os.path.join(filedir, "data", "cache", "metrics_cache.sqlite"))
+
 ## Output handler for tests
 class PmTestOutputHandler(output.CementOutputHandler):
     class Meta:
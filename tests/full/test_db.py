@@ -130,6 +130,15 @@ class TestQCUpload(PmFullTest):
         self.assertIsNone(s["project_sample_name"])
         self.assertEqual(s["project_id"], "P003")
         
+    def test_qc_upload_processes(self):
+        """Test running qc upload with the sample metrics collected in a pool of processes"""
+        s = self.s_con.get_entry("4_120924_AC003CCCXX_CGTTAA")
+        self.app = self.make_app(argv = ['qc', 'upload-qc', flowcells[1], '--mtime',  '100', '--processes', '2'], extensions=['scilifelab.pm.ext.ext_qc',  'scilifelab.pm.ext.ext_couchdb'])
+        self._run_app()
+        s_new = self.s_con.get_entry("4_120924_AC003CCCXX_CGTTAA")
+        for k in ["picard_metrics", "fastq_scr", "bc_count", "fastqc", "bcbb_checkpoints", "software_versions"]:
+            self.assertEqual(s[k], s_new[k])
+        
     def test_qc_update(self):
         """Test running qc update of a project id"""
         s = self.s_con.get_entry("4_120924_AC003CCCXX_CGTTAA")
@@ -7,7 +7,7 @@ import random
 import string
 import bcbio.utils as utils
 import tests.generate_test_data as td
-from scilifelab.illumina.hiseq import HiSeqRun
+from scilifelab.illumina.hiseq import HiSeqRun, HiSeqSampleSheet
 
 class TestHiSeqRun(unittest.TestCase):
     
@@ -114,4 +114,22 @@ class TestHiSeqRun(unittest.TestCase):
             self.assertListEqual(sorted(sample),sorted(HiSeqRun.get_project_sample_ids(ssheet,proj)),
                                  "The returned list of samples did not match the original")
    
-    
\ No newline at end of file
+    
+    def test_index_collisions(self):
+        """Check the indexes in each lane of a samplesheet for collisions
+        """
+        data = td.generate_samplesheet_data(no_lanes=2)
+        # Let the first two samples in the first lane have indexes one mismatch apart
+        data[1][4] = data[0][4][0:-1] + ("A" if data[0][4][-1] != "A" else "C")
+        fh, ssheet = tempfile.mkstemp(dir=self.rootdir, suffix=".csv")
+        os.close(fh)
+        td._write_samplesheet(data,ssheet)
+        
+        collisions = HiSeqSampleSheet(ssheet).index_collisions(1)
+        self.assertListEqual(sorted(["1","2"]),sorted(collisions.keys()),
+                             "The collisions were not reported per lane")
+        min_distance, pairs = collisions["1"]
+        self.assertEqual(1,min_distance,
+                         "The minimum distance in the lane did not match expected")
+        self.assertIn((data[0][2],data[1][2],1),pairs,
+                      "The colliding samples were not reported")
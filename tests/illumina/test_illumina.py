@@ -10,11 +10,14 @@ import tests.generate_test_data as td
 import scilifelab.illumina as illumina
 from scilifelab.illumina import IlluminaRun
 from scilifelab.illumina import map_index_name
+from scilifelab.bcbio.qc import MetricsCache
         
 class TestIlluminaRun(unittest.TestCase):
     
     def setUp(self): 
         self.rootdir = tempfile.mkdtemp(prefix="test_illumina_run_")
+        self.cache_path = MetricsCache.default_path
+        MetricsCache.configure(path=os.path.join(self.rootdir, "cache", "metrics_cache.sqlite"))
         
         # Create a fcdir
         self.exp_fcid = td.generate_fc_barcode()
@@ -41,6 +44,7 @@ class TestIlluminaRun(unittest.TestCase):
         self.run = IlluminaRun(self.exp_fcdir)
         
     def tearDown(self):
+        MetricsCache.configure(path=self.cache_path)
         shutil.rmtree(self.rootdir)
 
     def test_map_index_name(self):
@@ -54,6 +58,22 @@ class TestIlluminaRun(unittest.TestCase):
         for name in random_keys:
             self.assertIn(name,map_index_name(BASIC_LOOKUP[name],0),
                           "Exact mapping did not return expected index name")
+
+    def test_map_index_name_mismatch(self):
+        """Map index sequences with mismatches to names
+        """
+        from scilifelab.illumina.index_definitions import BASIC_LOOKUP
+        from scilifelab.utils.string import hamming_distance
+        sequences = [s.replace('-','') for s in random.sample(BASIC_LOOKUP.values(),25)]
+        for mismatch in [0,1,2,3]:
+            for sequence in sequences:
+                index = list(sequence)
+                for p in random.sample(xrange(len(index)),mismatch):
+                    index[p] = random.choice("ACGTN")
+                index = "".join(index)
+                expected = [name for name, s in BASIC_LOOKUP.items() if len(s.replace('-','')) == len(index) and hamming_distance(index,s.replace('-','')) <= mismatch]
+                self.assertListEqual(expected,map_index_name(index,mismatch),
+                                     "Mapping {} with {} mismatches did not return the expected names".format(index,mismatch))
       
     def test_get_flowcell(self):
         """Get flowcell from analysis directory
@@ -173,4 +193,44 @@ class TestIlluminaRun(unittest.TestCase):
                                  sorted(self.run.get_unmatched_reads(lanes=[lane])[0]),
                                  "Did not get expected undetermined indexes reads")
 
-             
\ No newline at end of file
+             
+
+    def test_write_undemultiplexed_stats(self):
+        """Count the barcodes of the undetermined indexes reads of each lane
+        """
+        from collections import Counter
+        from scilifelab.illumina.index_definitions import BASIC_LOOKUP
+        from scilifelab.utils.fastq_utils import FastQWriter
+        from scilifelab.bcbio.qc import FlowcellRunMetricsParser
+        
+        # Create undetermined indexes reads for two lanes, in two sequence directories
+        known = sorted([s for s in BASIC_LOOKUP.values() if len(s) == 6])[0:5]
+        expected = {}
+        for lane, seqdir in [(1,self.exp_unmatched_directory[0]),(6,self.exp_unmatched_directory[1])]:
+            fdir = os.path.join(seqdir,"Sample_lane{:d}".format(lane))
+            os.makedirs(fdir)
+            barcodes = [random.choice(known + [td.generate_barcode(6)]) for n in xrange(500)]
+            expected[lane] = Counter(barcodes)
+            for n, part in enumerate([barcodes[0:200],barcodes[200:]]):
+                records = [td.generate_fastq_record(pair=True, index=bc) for bc in part]
+                for read in [1,2]:
+                    fqw = FastQWriter(os.path.join(fdir,"lane{l:d}_Undetermined_L00{l:d}_R{r:d}_00{n:d}.fastq.gz".format(l=lane,r=read,n=n+1)))
+                    for record in records:
+                        fqw.write(record[4*(read-1):4*read])
+                    fqw.close()
+        
+        metrics_files = self.run.write_undemultiplexed_stats(nindex=3, processes=2)
+        self.assertEqual(2,len(metrics_files),
+                         "A metrics file should be written for each sequence directory")
+        parser = FlowcellRunMetricsParser(self.exp_fcdir)
+        metrics = parser.parse_undemultiplexed_barcode_metrics(os.path.basename(self.exp_fcdir).split("_")[-1])
+        self.assertListEqual(["1","6"],sorted(metrics.keys()),
+                             "The parsed metrics did not contain the expected lanes")
+        for lane, counter in expected.items():
+            barcodes = metrics[str(lane)]['undemultiplexed_barcodes']
+            self.assertListEqual(sorted([n for _, n in counter.most_common(3)]),sorted([int(n) for n in barcodes['count']]),
+                                 "The counts for lane {} did not match expected".format(lane))
+            for bc, name in zip(barcodes['sequence'],barcodes['index_name']):
+                self.assertEqual(",".join(map_index_name(bc,1)),name,
+                                 "The index names were not reported")
+
@@ -0,0 +1,121 @@
+"""Test suite for the fastq_mapreduce module
+"""
+
+import tempfile
+import os
+import shutil
+import unittest
+import scilifelab.utils.fastq_utils as fu
+import scilifelab.utils.fastq_mapreduce as fm
+import tests.generate_test_data as td
+from collections import Counter
+
+def _headers(chunk):
+    """Map function returning the headers of the records in a chunk
+    """
+    headers = None
+    for batches in chunk.batches():
+        headers = _extend(headers or [[] for b in batches], [b[0] for b in batches])
+    return headers
+
+def _extend(h1, h2):
+    """Reduce function concatenating the headers for each file
+    """
+    return [a + b for a, b in zip(h1, h2)]
+
+class TestMapReduce(unittest.TestCase):
+    """Test map-reduce processing of fastq files
+    """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_fastq_mapreduce_")
+        records = [td.generate_fastq_record(pair=True, index=td.generate_barcode()) for n in xrange(1000)]
+        self.records = records
+        self.pairs = {}
+        for suffix, compressor in [(".fastq","gzip"),(".fastq.gz","gzip"),(".bgzf.fastq.gz","threaded")]:
+            files = []
+            for read in [1,2]:
+                fname = os.path.join(self.rootdir,"sample_R{}{}".format(read,suffix))
+                fqw = fu.FastQWriter(fname,compressor=compressor,block_size=4000)
+                for record in records:
+                    fqw.write(record[4*(read-1):4*read])
+                fqw.close()
+                files.append(fname)
+            self.pairs[suffix] = files
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_map_reduce(self):
+        """Map-reduce single and paired fastq files
+        """
+        expected = [r[0] for r in self.records]
+        for suffix, files in self.pairs.items():
+            for processes in [1,2]:
+                for build_index in [False,True]:
+                    # Single file, the map results are lists of headers per chunk
+                    result = fm.map_reduce([files[0]], _headers, _extend, processes=processes,
+                                           chunk_records=64, build_index=build_index)
+                    self.assertListEqual(expected,result[0],
+                                         "The map-reduced records in {} did not match expected".format(os.path.basename(files[0])))
+
+                    # Paired files are processed in lockstep
+                    result = fm.map_reduce([tuple(files)], _headers, _extend, processes=processes,
+                                           chunk_records=64, build_index=build_index)
+                    self.assertListEqual(expected,result[0],
+                                         "The map-reduced read 1 records did not match expected")
+                    self.assertListEqual([r[4] for r in self.records],result[1],
+                                         "The map-reduced read 2 records did not match expected")
+
+    def test_split_chunks(self):
+        """Split fastq files into chunks read by the workers, if possible
+        """
+        for suffix, files in self.pairs.items():
+            chunks = list(fm.split_chunks(files,100))
+            self.assertTrue(all([c._data is not None for c in chunks]),
+                            "Without an index, the records should be passed in the chunks")
+            self.assertEqual(10,len(chunks),
+                             "The number of chunks did not match expected")
+            self.assertListEqual([r[0] for r in self.records[100:200]],
+                                 [h for batches in chunks[1].batches() for h in batches[0][0]],
+                                 "The records passed in a chunk did not match expected")
+            chunks = list(fm.split_chunks(files,100,build_index=True))
+            self.assertEqual(10,len(chunks),
+                             "The number of chunks did not match expected")
+            self.assertEqual(suffix == ".fastq.gz",chunks[0]._data is not None,
+                             "Only single-member gzip files should have the records passed in the chunks")
+
+    def test_unequal_pairs(self):
+        """Paired files with different numbers of records should raise an error
+        """
+        fname = os.path.join(self.rootdir,"short_R2.fastq")
+        fqw = fu.FastQWriter(fname)
+        for record in self.records[0:-1]:
+            fqw.write(record[4:])
+        fqw.close()
+        with self.assertRaises(ValueError):
+            fm.map_reduce([(self.pairs[".fastq"][0],fname)], _headers, _extend, processes=1)
+
+    def test_count_barcodes(self):
+        """Count barcodes in chunks of a fastq file
+        """
+        fname = self.pairs[".bgzf.fastq.gz"][0]
+        expected = Counter([bc for bc in fu.BarcodeExtractor(fname)])
+        counts = fm.map_reduce([fname], fm.count_barcodes, fm.merge_counters, Counter(), processes=2, chunk_records=100)
+        self.assertDictEqual(expected,counts,
+                             "The barcode counts did not match expected")
+
+    def test_empty_input(self):
+        """Map-reduce empty fastq files
+        """
+        fname = os.path.join(self.rootdir,"empty_R1.fastq")
+        open(fname,"w").close()
+        for build_index in [False,True]:
+            for processes in [1,2]:
+                counts = fm.map_reduce([fname], fm.count_barcodes, fm.merge_counters, processes=processes, build_index=build_index)
+                self.assertDictEqual({},counts,
+                                     "Counting the barcodes of an empty file should give no counts")
+                self.assertEqual(1,len(list(fm.split_chunks(fname,100,build_index=build_index))),
+                                 "An empty file should give a single empty chunk")
+        self.assertIsNone(fm.map_reduce([], fm.count_barcodes, fm.merge_counters),
+                          "Map-reducing no inputs without an initial value should give None")
@@ -71,6 +71,156 @@ class TestFastQParser(unittest.TestCase):
         self.assertEqual(expected,fqr.rread(),
                          "The returned number of filtered reads based on lanes did not match expected number")
         
+    def test_compiled_filter(self):
+        """Filter headers on each field using the compiled filter
+        """
+        headers = [td.generate_fastq_header(lane=random.randint(1,8),
+                                            read=random.randint(1,2),
+                                            is_filtered=random.choice("YN")) for n in xrange(200)]
+        parsed = [fu.parse_header(h) for h in headers]
+        for field in parsed[0].keys():
+            values = list(set([p[field] for p in parsed]))[0:2]
+            expected = [p[field] in values for p in parsed]
+            observed = fu.compile_header_filter({field: values},headers[0])(headers)
+            self.assertListEqual(expected,observed,
+                                 "Compiled filter on {} did not give the expected result".format(field))
+        
+        # Combine filters on several fields
+        fltr = {'lane': [1,2,3], 'read': [2], 'is_filtered': [False]}
+        expected = [p['lane'] in fltr['lane'] and p['read'] == 2 and not p['is_filtered'] for p in parsed]
+        self.assertListEqual(expected,fu.compile_header_filter(fltr,headers[0])(headers),
+                             "Compiled filter on several fields did not give the expected result")
+        
+        # MiSeq headers have the sample number in the index field
+        headers = ["@M00123:45:000000000-A1B2C:1:1101:15589:1333 1:N:0:{}".format(n) for n in [1,2,3,2]]
+        self.assertListEqual([False,True,False,True],fu.compile_header_filter({'index': ['2']},headers[0])(headers),
+                             "Compiled filter on MiSeq sample number did not give the expected result")
+        
+        # Casava 1.7 headers
+        headers = ["@HWUSI-EAS100R:{}:73:941:1973#{}/{}".format(l,i,r) for l, i, r in [(1,"ACGT",1),(2,"ACGT",2),(1,"TTTT",2),(1,"ACGT",2)]]
+        fltr = {'lane': [1], 'index': ["ACGT"], 'read': [2], 'control_number': [1]}
+        self.assertListEqual([False,False,False,True],fu.compile_header_filter(fltr,headers[0])(headers),
+                             "Compiled filter on Casava 1.7 headers did not give the expected result")
+        
+    def test_batches(self):
+        """Parse records in batches
+        """
+        
+        # Parse the file one record at a time
+        fqr = fu.FastQParser(self.example_fq)
+        records = [r for r in fqr]
+        
+        # Parse the file in batches, using a small block size to force records to span blocks
+        fqr = fu.FastQParser(self.example_fq,block_size=1000)
+        batches = [b for b in fqr.batches(7)]
+        self.assertTrue(all([len(b[0]) == 7 for b in batches[0:-1]]),
+                        "All but the last batch should be of the requested size")
+        self.assertEqual(len(records),fqr.rread(),
+                         "The number of records read in batches did not match the number of records in the file")
+        self.assertListEqual(records,
+                             [list(r) for b in batches for r in zip(*b)],
+                             "Records parsed in batches did not match the records parsed one at a time")
+        
+        # Filter the batches on lane
+        fltr = {'lane': range(1,5)}
+        expected = sum([sum(self.example_counts[l].values()) for l in fltr['lane']])
+        fqr = fu.FastQParser(self.example_fq,filter=fltr)
+        observed = sum([len(b[0]) for b in fqr.batches(100)])
+        self.assertEqual(expected,observed,
+                         "The number of filtered records parsed in batches did not match expected number")
+        
+    def test_mixed_next_and_batches(self):
+        """Parse records one at a time and in batches from the same parser
+        """
+        fqr = fu.FastQParser(self.example_fq)
+        records = [r for r in fqr]
+        
+        fqr = fu.FastQParser(self.example_fq,block_size=1000)
+        first = fqr.next()
+        batches = fqr.batches(10)
+        batch = batches.next()
+        self.assertEqual(10,len(batch[0]),
+                         "The records buffered by next should be yielded in batches of the requested size")
+        self.assertEqual(11,fqr.rread())
+        second = fqr.next()
+        rest = [list(r) for b in batches for r in zip(*b)]
+        self.assertListEqual(records,
+                             [first] + [list(r) for r in zip(*batch)] + [second] + rest,
+                             "Records parsed with next and batches did not match the records in the file")
+        self.assertEqual(len(records),fqr.rread())
+        
+    def test_decompressors(self):
+        """Parse a gzipped file using the different decompression backends
+        """
+        expected = [r for r in fu.FastQParser(self.example_fq,decompressor="gzip")]
+        for decompressor in ["auto","threaded","pipe"]:
+            fqr = fu.FastQParser(self.example_fq,decompressor=decompressor,threads=2)
+            self.assertListEqual(expected,[r for r in fqr],
+                                 "Records parsed using the {} backend did not match expected".format(decompressor))
+        
+class TestFastQIndex(unittest.TestCase):
+    """Test random access to fastq files using the index
+    """
+    
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_FastQIndex_")
+        self.records = [td.generate_fastq_record(sequence_length=random.randint(50,101)) for n in xrange(1000)]
+        self.fastq_files = []
+        for fname, compressor in [("plain.fastq","gzip"),("single.fastq.gz","gzip"),("bgzf.fastq.gz","threaded")]:
+            fname = os.path.join(self.rootdir,fname)
+            fqw = fu.FastQWriter(fname,compressor=compressor,block_size=4000)
+            for record in self.records:
+                fqw.write(record)
+            fqw.close()
+            self.fastq_files.append(fname)
+            
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+        
+    def test_build_index(self):
+        """Build, save and load an index
+        """
+        for fname in self.fastq_files:
+            index = fu.FastQIndex.build(fname,interval=64)
+            self.assertEqual(len(self.records),index.records,
+                             "The number of indexed records did not match expected")
+            self.assertListEqual(range(0,len(self.records),64),[c[0] for c in index.checkpoints],
+                                 "The indexed records did not match expected")
+            self.assertIsNone(fu.FastQIndex.find(fname),
+                              "Finding a non-existing index should return None")
+            index.save()
+            loaded = fu.FastQIndex.find(fname)
+            self.assertListEqual(index.checkpoints,loaded.checkpoints,
+                                 "The loaded index did not match the saved index")
+            
+            # A modified file should invalidate the index
+            os.utime(fname,(0,0))
+            self.assertIsNone(fu.FastQIndex.find(fname),
+                              "An out-of-date index should not be used")
+        
+    def test_start_at_record(self):
+        """Parse a shard of a fastq file, starting at a record
+        """
+        for fname in self.fastq_files:
+            index = fu.FastQIndex.build(fname,interval=64)
+            for start in [0, 1, 63, 64, 500, 999, 1000]:
+                for max_records in [None, 1, 100]:
+                    fqp = fu.FastQParser(fname,start=start,max_records=max_records,index=index)
+                    end = len(self.records) if max_records is None else start + max_records
+                    self.assertListEqual(self.records[start:end],[r for r in fqp],
+                                         "Records parsed from {} starting at record {} did not match expected".format(os.path.basename(fname),start))
+            
+            # Start at the offset of a checkpoint
+            record, offset, skip = index.checkpoint(200)
+            fqp = fu.FastQParser(fname,offset=(offset,skip),max_records=10)
+            self.assertListEqual(self.records[record:record+10],[r for r in fqp],
+                                 "Records parsed from a checkpoint offset did not match expected")
+            
+            # Without an index, the preceding records are skipped
+            fqp = fu.FastQParser(fname,start=500)
+            self.assertListEqual(self.records[500:],[r for r in fqp],
+                                 "Records parsed without an index did not match expected")
+            
 class TestFastQWriter(unittest.TestCase):
     """Test the FastQWriter functionality
     """
@@ -84,7 +234,42 @@ class TestFastQWriter(unittest.TestCase):
     def test_write_fastq(self):
         """Write a fastq file
         """
-        
+        records = [td.generate_fastq_record() for n in xrange(1000)]
+        for compressor in ["gzip","threaded"]:
+            fname = os.path.join(self.rootdir,"{}.fastq.gz".format(compressor))
+            fqw = fu.FastQWriter(fname,compressor=compressor,compresslevel=1,block_size=5000,threads=2)
+            for record in records:
+                fqw.write(record)
+            fqw.close()
+            self.assertEqual(len(records),fqw.rwritten(),
+                             "The number of written records did not match expected")
+            self.assertListEqual(records,[r for r in fu.FastQParser(fname)],
+                                 "Records written using the {} compressor could not be parsed back".format(compressor))
+
+    def test_writer_pool(self):
+        """Write to more fastq files than the pool keeps open
+        """
+        records = [td.generate_fastq_record() for n in xrange(2000)]
+        for suffix, compressor in [(".fastq","gzip"),(".fastq.gz","gzip"),(".fastq.gz","threaded")]:
+            fnames = [os.path.join(self.rootdir,"{}_{}{}".format(compressor,n,suffix)) for n in xrange(10)]
+            # An existing file should be overwritten
+            with open(fnames[0],"w") as fh:
+                fh.write("existing content\n")
+            pool = fu.FastQWriterPool(max_open=3,buffer_size=2000,compressor=compressor,threads=2)
+            expected = dict([(f,[]) for f in fnames])
+            for record in records:
+                fname = random.choice(fnames)
+                pool.write(fname,record)
+                expected[fname].append(record)
+                self.assertTrue(len(pool._open) <= 3,
+                                "The pool should not keep more than the maximum number of files open")
+            pool.close()
+            for fname in fnames:
+                self.assertEqual(len(expected[fname]),pool.rwritten(fname),
+                                 "The number of written records did not match expected")
+                self.assertListEqual(expected[fname],[r for r in fu.FastQParser(fname)],
+                                     "Records written through the pool could not be parsed back")
+
 
 class TestFastQUtils(unittest.TestCase):
     
@@ -189,7 +374,67 @@ class TestFastQUtils(unittest.TestCase):
                              "The number of demultiplexed reads in file does not match expected")
             self.assertListEqual(sorted(headers),sorted(self.indexes[index]),
                                  "The parsed headers from demultiplexed fastq file do not match the expected")
-            
+
+    def test_demultiplex_fastq_processes(self):
+        """Demultiplex a test fastq file with the lanes split between processes
+        """
+        expected = {}
+        for index, outfiles in fu.demultiplex_fastq(self.rootdir,self.samplesheet,self.fastq_1,self.fastq_2)["1"].items():
+            expected[index] = [[r for r in fu.FastQParser(f)] for f in outfiles]
+
+        outdir = tempfile.mkdtemp(dir=self.rootdir)
+        outfiles = fu.demultiplex_fastq(outdir,self.samplesheet,self.fastq_1,self.fastq_2,processes=2)
+        self.assertEqual(0,sum([len(ix) for lane, ix in outfiles.items() if lane != "1"]),
+                         "Demultiplexing should not return results for empty lane")
+        observed = {}
+        for index, files in outfiles["1"].items():
+            observed[index] = [[r for r in fu.FastQParser(f)] for f in files]
+        self.assertDictEqual(expected,observed,
+                             "Demultiplexing in several processes did not give the same result")
+        self.assertEqual(sum([len(f) for f in outfiles["1"].values()]),len(os.listdir(outdir)),
+                         "Temporary files for empty samples were not removed")
+
+    def test_demultiplex_fastq_mismatches(self):
+        """Demultiplex a test fastq file with mismatches in the indexes
+        """
+        # Substitute the first base of the index in the read headers
+        for fname in [self.fastq_1,self.fastq_2]:
+            records = [r for r in fu.FastQParser(fname)]
+            fqw = fu.FastQWriter(fname)
+            for record in records:
+                header, index = record[0].rsplit(":",1)
+                record[0] = "{}:N{}".format(header,index[1:])
+                fqw.write(record)
+            fqw.close()
+
+        outfiles = fu.demultiplex_fastq(self.rootdir,self.samplesheet,self.fastq_1,self.fastq_2)
+        self.assertEqual(0,sum([len(ix) for ix in outfiles.values()]),
+                         "No reads should be demultiplexed without allowing mismatches")
+
+        outfiles = fu.demultiplex_fastq(self.rootdir,self.samplesheet,self.fastq_1,self.fastq_2,mismatches=1)["1"]
+        sdata = hi.HiSeqRun.parse_samplesheet(self.samplesheet)
+        indexes = [s["Index"] for s in sdata if s["Lane"] == "1"]
+        for index in indexes:
+            # Reads are ambiguous if another index differs only in the first base
+            if len([ix for ix in indexes if ix[1:] == index[1:]]) > 1:
+                self.assertNotIn(index,outfiles,
+                                 "Ambiguous reads should not be demultiplexed")
+                continue
+            headers = [r[0] for r in fu.FastQParser(outfiles[index][0])]
+            self.assertEqual(len(self.indexes[index]),len(headers),
+                             "The number of demultiplexed reads with mismatches did not match expected")
+
+    def test_demultiplex_unpaired_fastq(self):
+        """Demultiplexing fastq files with reads out of order should raise an error
+        """
+        records = [r for r in fu.FastQParser(self.fastq_2)]
+        fqw = fu.FastQWriter(self.fastq_2)
+        for record in records[1:] + records[0:1]:
+            fqw.write(record)
+        fqw.close()
+        with self.assertRaises(ValueError):
+            fu.demultiplex_fastq(self.rootdir,self.samplesheet,self.fastq_1,self.fastq_2)
+
 
 class TestBarcodeExtractor(unittest.TestCase):
     """Test class for the functionality
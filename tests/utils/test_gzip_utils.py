@@ -0,0 +1,105 @@
+"""Test suite for the gzip_utils module
+"""
+
+import gzip
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+import scilifelab.utils.gzip_utils as gu
+import tests.generate_test_data as td
+
+class TestGzipReaders(unittest.TestCase):
+    """Test the decompression backends
+    """
+    
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_gzip_utils_")
+        self.data = "".join(["{}\n".format("\n".join(td.generate_fastq_record())) for n in xrange(1000)])
+        
+        # A multi-member gzip file, padded with zeros
+        self.multi_gz = os.path.join(self.rootdir,"multi.fastq.gz")
+        with open(self.multi_gz,"wb") as fh:
+            half = len(self.data)/2
+            for chunk in [self.data[0:half], self.data[half:]]:
+                gz = gzip.GzipFile(fileobj=fh, mode="wb")
+                gz.write(chunk)
+                gz.close()
+            fh.write("\x00"*16)
+        
+        self.bgzf = os.path.join(self.rootdir,"bgzf.fastq.gz")
+        fh = gu.ThreadedGzipWriter(self.bgzf, block_size=10000, threads=2)
+        fh.write(self.data)
+        fh.close()
+        
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+        
+    def test_is_bgzf(self):
+        """Detect BGZF files
+        """
+        self.assertTrue(gu.is_bgzf(self.bgzf), "BGZF file was not detected")
+        self.assertFalse(gu.is_bgzf(self.multi_gz), "Regular gzip file was detected as BGZF")
+        
+    def test_decompressors(self):
+        """Read compressed files with each decompression backend
+        """
+        for fname in [self.multi_gz, self.bgzf]:
+            for decompressor in gu.DECOMPRESSORS:
+                fh = gu.open_gzip(fname, decompressor, threads=3)
+                self.assertEqual(self.data, fh.read(1234) + fh.read(),
+                                 "Data read with {} backend did not match the original".format(decompressor))
+                fh.seek(0)
+                self.assertListEqual(self.data.splitlines(True), [line for line in fh],
+                                     "Lines read with {} backend did not match the original".format(decompressor))
+                fh.close()
+                
+    def test_truncated_input(self):
+        """Raise an error on truncated input
+        """
+        fname = os.path.join(self.rootdir,"truncated.fastq.gz")
+        for src in [self.multi_gz, self.bgzf]:
+            with open(src,"rb") as fh:
+                data = fh.read()
+            # Truncate inside the first member or block, the file would be valid if truncated between them
+            size = gu._bgzf_block_size(data[0:18]) if src == self.bgzf else len(data)/2
+            with open(fname,"wb") as fh:
+                fh.write(data[0:size/2])
+            fh = gu.ThreadedGzipReader(fname, threads=2)
+            with self.assertRaises(IOError):
+                fh.read()
+            fh.close()
+        
+    def test_unknown_decompressor(self):
+        """Raise an error for an unknown backend
+        """
+        with self.assertRaises(ValueError):
+            gu.open_gzip(self.bgzf, "unknown")
+
+class TestThreadedGzipWriter(unittest.TestCase):
+    """Test the block-compressing writer
+    """
+    
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_gzip_utils_")
+        self.records = ["{}\n".format("\n".join(td.generate_fastq_record())) for n in xrange(1000)]
+        
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+        
+    def test_write(self):
+        """Write BGZF and multi-member gzip output readable by gzip tools
+        """
+        fname = os.path.join(self.rootdir,"out.fastq.gz")
+        for block_size, bgzf in [(1000, True), (gu.BGZF_BLOCK_SIZE, True), (gu.BGZF_BLOCK_SIZE + 1, False)]:
+            fh = gu.open_gzip_writer(fname, "threaded", compresslevel=1, block_size=block_size, threads=3)
+            for record in self.records:
+                fh.write(record)
+            fh.close()
+            self.assertEqual(bgzf, gu.is_bgzf(fname),
+                             "Unexpected output format for block size {}".format(block_size))
+            self.assertEqual("".join(self.records), gzip.GzipFile(fname).read(),
+                             "Data read with gzip.GzipFile did not match the written data")
+            self.assertEqual("".join(self.records), subprocess.check_output(["gzip", "-d", "-c", fname]),
+                             "Data read with gzip -d did not match the written data")
@@ -0,0 +1,67 @@
+"""Test suite for the heavy_hitters module
+"""
+
+import cPickle
+import random
+import unittest
+from collections import Counter
+from scilifelab.utils.heavy_hitters import HeavyHitterCounter
+import tests.generate_test_data as td
+
+class TestHeavyHitterCounter(unittest.TestCase):
+    """Test bounded-memory counting of frequent items
+    """
+
+    def setUp(self):
+        # A skewed stream with a few frequent barcodes among many rare ones
+        frequent = [td.generate_barcode(8) for n in xrange(10)]
+        self.stream = [random.choice(frequent) if random.random() < 0.5 else td.generate_barcode(8) for n in xrange(50000)]
+        random.shuffle(self.stream)
+        self.exact = Counter(self.stream)
+
+    def _check_bounds(self, counter, total):
+        self.assertTrue(counter.error <= total/(counter.capacity + 1.),
+                        "The error exceeds the theoretical bound")
+        self.assertTrue(len(counter) <= counter.capacity,
+                        "The counter should not hold more keys than its capacity")
+        for key, count in self.exact.items():
+            lower, upper = counter.bounds(key)
+            self.assertTrue(lower <= count <= upper,
+                            "The true count of {} is outside the bounds".format(key))
+            if count > counter.error:
+                self.assertIn(key,counter,
+                              "A key occurring more often than the error should be kept")
+
+    def test_exact(self):
+        """Count exactly when the distinct items fit in the capacity
+        """
+        counter = HeavyHitterCounter(self.stream,capacity=len(self.exact))
+        self.assertTrue(counter.exact(),
+                        "The counts should be exact")
+        self.assertDictEqual(dict(self.exact),dict(counter),
+                             "The counts did not match the exact counts")
+        counter = HeavyHitterCounter(self.stream)
+        self.assertDictEqual(dict(self.exact),dict(counter),
+                             "A counter without capacity should be exact")
+
+    def test_bounded(self):
+        """Count with a bounded number of keys
+        """
+        counter = HeavyHitterCounter(capacity=100)
+        for n in xrange(0,len(self.stream),1000):
+            counter.update(self.stream[n:n+1000])
+        self._check_bounds(counter,len(self.stream))
+        self.assertSetEqual(set([k for k, _ in self.exact.most_common(10)]),set([k for k, _ in counter.most_common(10)]),
+                             "The most frequent items did not match")
+        self.assertEqual(1000,HeavyHitterCounter(error_rate=0.001).capacity,
+                         "The capacity was not set from the error rate")
+
+    def test_merge(self):
+        """Merge counters of parts of a stream
+        """
+        parts = [HeavyHitterCounter(self.stream[n:n+5000],capacity=100) for n in xrange(0,len(self.stream),5000)]
+        merged = HeavyHitterCounter(capacity=100)
+        for part in parts:
+            # Counters are passed between processes
+            merged.update(cPickle.loads(cPickle.dumps(part,cPickle.HIGHEST_PROTOCOL)))
+        self._check_bounds(merged,len(self.stream))
@@ -0,0 +1,113 @@
+"""Test suite for the index_matcher module
+"""
+
+import random
+import unittest
+import scilifelab.utils.index_matcher as im
+import tests.generate_test_data as td
+from scilifelab.utils.string import hamming_distance
+
+def _nearest(seq, indexes, max_mismatches):
+    """Reference implementation, comparing the start of seq to each index
+    """
+    distances = {}
+    for index in sorted(indexes, key=lambda x: -len(x)):
+        d = hamming_distance(index, seq[0:len(index)]) if len(seq) >= len(index) else max_mismatches + 1
+        if d == 0:
+            return ((index,), 0)
+        if d <= max_mismatches:
+            distances.setdefault(d, []).append(index)
+    if len(distances) == 0:
+        return None
+    d = min(distances.keys())
+    return (tuple(distances[d]), d)
+
+class TestIndexMatcher(unittest.TestCase):
+    """Test mismatch-tolerant index matching
+    """
+
+    def test_neighbours(self):
+        """Generate the sequences within a number of mismatches
+        """
+        seq = "ACGTAC"
+        for max_mismatches, expected in [(0,1),(1,1+6*4),(2,1+6*4+15*16)]:
+            seqs = list(im.neighbours(seq,max_mismatches))
+            self.assertEqual(expected,len(seqs),
+                             "The number of sequences within {} mismatches did not match expected".format(max_mismatches))
+            self.assertEqual(expected,len(set([s for s, _ in seqs])),
+                             "Each sequence should be generated once")
+            self.assertTrue(all([hamming_distance(seq,s) == m for s, m in seqs]),
+                            "The number of mismatches was not correct")
+
+    def test_match(self):
+        """Match sequences against indexes with mismatches
+        """
+        matcher = im.IndexMatcher(["AAAAAA","AAAATT","CCCCCC"],1)
+        self.assertEqual((("AAAAAA",),0),matcher.match("AAAAAA"),
+                         "An exact match should have no mismatches")
+        self.assertEqual((("CCCCCC",),1),matcher.match("CCNCCC"),
+                         "A single mismatch should be tolerated")
+        self.assertEqual((("AAAAAA","AAAATT"),1),matcher.match("AAAAAT"),
+                         "A sequence equally near two indexes should be ambiguous")
+        self.assertIsNone(matcher.match("AAAGGG"),
+                          "A sequence with too many mismatches should not match")
+        self.assertEqual(["AAAAAT","AAAATA"],sorted(matcher.ambiguous().keys()),
+                         "The ambiguous sequences did not match expected")
+
+    def test_match_dual_index(self):
+        """Match dual indexes with mismatches in each part
+        """
+        matcher = im.IndexMatcher(["ACGTAC-GGGTTT","ACGTAC-CCCAAA"],1)
+        self.assertEqual((("ACGTAC-GGGTTT",),2),matcher.match("ACGTAA-GGGTTA"),
+                         "A mismatch in each part should be tolerated")
+        self.assertIsNone(matcher.match("ACGGGC-GGGTTT"),
+                          "Two mismatches in one part should not match")
+
+    def test_match_prefix(self):
+        """Match the start of random sequences against indexes of different lengths
+        """
+        indexes = list(set([td.generate_barcode(random.choice([4,6,8])) for n in xrange(20)]))
+        for max_mismatches in [0,1,2]:
+            matcher = im.IndexMatcher(indexes,max_mismatches)
+            for n in xrange(500):
+                seq = td.generate_barcode(12)
+                if random.random() < 0.5:
+                    # Start the sequence with a (possibly mutated) index
+                    index = random.choice(indexes)
+                    mutated = list(index)
+                    for p in random.sample(xrange(len(index)),random.randint(0,2)):
+                        mutated[p] = random.choice("ACGTN")
+                    seq = "".join(mutated) + seq[len(index):]
+                expected = _nearest(seq,indexes,max_mismatches)
+                observed = matcher.match_prefix(seq)
+                if expected is not None:
+                    observed = (tuple(sorted(observed[0])),observed[1])
+                    expected = (tuple(sorted(expected[0])),expected[1])
+                self.assertEqual(expected,observed,
+                                 "The match for {} did not agree with the reference".format(seq))
+
+    def test_index_collisions(self):
+        """Compute the distances between indexes and find collisions
+        """
+        indexes = [td.generate_barcode(random.choice([6,8])) for n in xrange(50)]
+        indexes += ["{}-{}".format(td.generate_barcode(8),td.generate_barcode(8)) for n in xrange(50)]
+        indexes += [indexes[-1][0:-1] + "N", indexes[0]]
+        distances = im.index_distances(indexes)
+        parts = [[(index.split("-") + [""])[p] for index in indexes] for p in xrange(2)]
+        for i in xrange(len(indexes)):
+            for j in xrange(len(indexes)):
+                for p in xrange(2):
+                    a, b = parts[p][i], parts[p][j]
+                    expected = hamming_distance(a.ljust(8," "),b.ljust(8," "))
+                    self.assertEqual(expected,distances[p,i,j],
+                                     "The distance between {} and {} did not match expected".format(indexes[i],indexes[j]))
+        for max_mismatches in [0,1,2]:
+            min_distance, collisions = im.index_collisions(indexes,max_mismatches)
+            self.assertEqual(0,min_distance,
+                             "The minimum distance of a duplicated index should be 0")
+            expected = [(i, j) for i in xrange(len(indexes)) for j in xrange(i+1,len(indexes)) if (distances[:,i,j] <= max_mismatches).all()]
+            self.assertListEqual(expected,[(i, j) for i, j, _ in collisions],
+                                 "The collisions did not match expected")
+            if max_mismatches > 0:
+                self.assertIn((len(indexes)-3,len(indexes)-2,1),collisions,
+                              "The dual indexes differing by one base should collide")
@@ -0,0 +1,75 @@
+"""Test suite for the packed_barcodes module
+"""
+
+import cPickle
+import random
+import unittest
+from collections import Counter
+import scilifelab.utils.packed_barcodes as pb
+import tests.generate_test_data as td
+
+class TestBarcodeCounter(unittest.TestCase):
+    """Test counting of packed barcodes
+    """
+
+    def _barcodes(self, length, n=5000):
+        frequent = [td.generate_barcode(length) for i in xrange(20)]
+        barcodes = [random.choice(frequent) for i in xrange(n)]
+        # Add some barcodes with N and of other lengths, which are escaped
+        for i in xrange(0,n,50):
+            barcodes[i] = "N" + barcodes[i][1:]
+        for i in xrange(0,n,333):
+            barcodes[i] = barcodes[i][0:-1]
+        return barcodes
+
+    def test_encode(self):
+        """Pack and unpack barcodes
+        """
+        barcodes = ["ACGTAC","TTTTTT","AAAAAA","ACGNAC","ACGTA","GATTACA"]
+        codes, escaped = pb.encode(barcodes,6)
+        self.assertListEqual(["ACGNAC","ACGTA","GATTACA"],sorted(escaped),
+                             "The escaped barcodes did not match expected")
+        self.assertListEqual(barcodes[0:3],[pb.decode(c,6) for c in codes],
+                             "The unpacked barcodes did not match the packed")
+        self.assertEqual(0,int(codes[2]),
+                         "The code for AAAAAA should be 0")
+        codes, _ = pb.encode(["T"*32],32)
+        self.assertEqual(2**64-1,int(codes[0]),
+                         "A barcode of 32 bases should fill 64 bits")
+
+    def test_count(self):
+        """Count barcodes in batches
+        """
+        for length in [6,8,12]:
+            barcodes = self._barcodes(length)
+            expected = Counter(barcodes)
+            counter = pb.BarcodeCounter()
+            for n in xrange(0,len(barcodes),1000):
+                counter.add(barcodes[n:n+1000])
+            self.assertEqual(length,counter.length,
+                             "The barcode length was not set from the most common length")
+            self.assertDictEqual(dict(expected),dict(counter.counter()),
+                                 "The counts for {} bp barcodes did not match expected".format(length))
+            self.assertEqual(len(barcodes),counter.total(),
+                             "The total count did not match expected")
+            self.assertListEqual([n for _, n in expected.most_common(5)],[n for _, n in counter.most_common(5)],
+                                 "The most common counts did not match expected")
+            for bc in expected.keys()[0:10] + ["X"]:
+                self.assertEqual(expected[bc],counter[bc],
+                                 "The count for {} did not match expected".format(bc))
+
+    def test_merge(self):
+        """Merge counters across files
+        """
+        for length in [8,12]:
+            parts = [self._barcodes(length) for n in xrange(3)]
+            merged = pb.BarcodeCounter()
+            for part in parts:
+                counter = pb.BarcodeCounter()
+                counter.add(part)
+                merged.update(cPickle.loads(cPickle.dumps(counter,cPickle.HIGHEST_PROTOCOL)))
+            # Counts can also be merged from a mapping
+            merged.update(Counter(parts[0]))
+            expected = Counter(parts[0] + parts[0] + parts[1] + parts[2])
+            self.assertDictEqual(dict(expected),dict(merged.counter()),
+                                 "The merged counts did not match expected")
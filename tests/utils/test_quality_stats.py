@@ -0,0 +1,73 @@
+"""Test suite for the quality_stats module
+"""
+
+import random
+import unittest
+import numpy as np
+import scilifelab.utils.fastq_utils as fu
+import scilifelab.utils.quality_stats as qs
+import tests.generate_test_data as td
+
+class TestQualityStats(unittest.TestCase):
+    """Test the vectorized quality statistics against per-base calculations
+    """
+    
+    def setUp(self):
+        self.records = []
+        for n in xrange(500):
+            self.records.append(td.generate_fastq_record(lane=random.randint(1,2),
+                                                         tile=random.choice([1101,1102,2101]),
+                                                         sequence_length=random.choice([50,75,101])))
+        self.batch = [list(f) for f in zip(*self.records)]
+        
+    def _reference(self, qual, offset=33):
+        scores = [ord(c) - offset for c in qual]
+        return float(sum(scores))/len(scores), 100*float(len([q for q in scores if q >= 30]))/len(scores)
+        
+    def test_read_quality(self):
+        """Calculate per-read mean quality and percentage >= Q30
+        """
+        mean, pct = qs.read_quality(self.batch[3])
+        for i, qual in enumerate(self.batch[3]):
+            exp_mean, exp_pct = self._reference(qual)
+            self.assertAlmostEqual(exp_mean, mean[i], 10, "Mean quality did not match expected")
+            self.assertAlmostEqual(exp_pct, pct[i], 10, "Percentage >= Q30 did not match expected")
+            
+    def test_avgq_gtq30(self):
+        """The single-record wrappers give the rounded values
+        """
+        for record in self.records[0:50]:
+            exp_mean, exp_pct = self._reference(record[3])
+            self.assertEqual(round(exp_mean,1), fu.avgQ(record), "avgQ did not match expected")
+            self.assertEqual(round(exp_pct,1), fu.gtQ30(record), "gtQ30 did not match expected")
+        
+    def test_quality_stats(self):
+        """Accumulate per-cycle and per-tile statistics over batches
+        """
+        stats = qs.QualityStats()
+        for i in range(0,len(self.records),128):
+            stats.add(self.batch[3][i:i+128], self.batch[0][i:i+128])
+        
+        quals = self.batch[3]
+        self.assertEqual(len(quals), stats.reads, "The number of reads did not match expected")
+        self.assertEqual(sum([len(q) for q in quals]), stats.bases, "The number of bases did not match expected")
+        
+        # Verify the per-cycle histogram for a couple of cycles
+        for cycle in [0, 60, 100]:
+            expected = np.zeros(qs.MAX_QUALITY + 1, dtype=int)
+            for q in quals:
+                if cycle < len(q):
+                    expected[ord(q[cycle]) - 33] += 1
+            self.assertListEqual(list(expected), list(stats.cycle_histogram[cycle]),
+                                 "Quality histogram for cycle {} did not match expected".format(cycle))
+        
+        # Verify the per-tile mean qualities
+        tiles = {}
+        for header, qual in zip(self.batch[0],quals):
+            key = tuple([int(f) for f in header.split(":")[3:5]])
+            tiles.setdefault(key,[]).extend([ord(c) - 33 for c in qual])
+        observed = stats.tile_mean_quality()
+        self.assertListEqual(sorted(tiles.keys()), sorted(observed.keys()), "The observed tiles did not match expected")
+        for key, scores in tiles.items():
+            self.assertAlmostEqual(float(sum(scores))/len(scores), observed[key], 10,
+                                   "Mean quality for tile {} did not match expected".format(key))